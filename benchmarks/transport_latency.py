@@ -0,0 +1,122 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Benchmark of CoAP request latency and CPU time over Unix domain sockets and loopback UDP.
+
+Both transports receive with the same blocking loop, so the difference comes from the socket family alone.
+Run from the repository root: python -m benchmarks.transport_latency [-n REQUESTS]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from ipaddress import ip_address
+
+from piccata import message
+from piccata import resource
+from piccata.constants import *
+from piccata.core import Coap
+from transport.tsocket import SocketTransport
+from transport.tunix import UnixSocketTransport, unix_endpoint
+
+SERVER_PORT = 5683
+PAYLOAD = b"x" * 64
+
+
+class _PayloadResource(resource.CoapResource):
+
+    def render_GET(self, request):
+        return message.Message(code=CONTENT, payload=PAYLOAD)
+
+
+def _create_server(transport):
+    root = resource.CoapResource()
+    root.put_child(b"payload", _PayloadResource())
+    protocol = Coap(transport)
+    transport.register_receiver(protocol)
+    protocol.register_request_handler(resource.ResourceManager(resource.CoapEndpoint(root)))
+    return protocol
+
+
+def measure(server_transport, client_transport, remote, requests, warmup=100):
+    """Send sequential confirmable GET requests and measure them.
+
+    Args:
+        server_transport (transport.base.TransportBase): A closed transport of the server.
+        client_transport (transport.base.TransportBase): A closed transport of the client.
+        remote (piccata.types.Endpoint): An address of the server as seen by the client.
+        requests (int): A number of requests measured.
+        warmup (int): A number of requests sent before measuring.
+
+    Returns:
+        dict: Mean, median and 99th percentile latency in microseconds and CPU time per request in microseconds.
+    """
+    _create_server(server_transport)
+    client = Coap(client_transport)
+    client_transport.register_receiver(client)
+    server_transport.open()
+    client_transport.open()
+
+    done = threading.Event()
+    results = []
+
+    def handle_response(result, request, response):
+        results.append(result)
+        done.set()
+
+    def send():
+        done.clear()
+        request = message.Message(mtype=CON, code=GET)
+        request.opt.uri_path = (b"payload", )
+        request.remote = remote
+        client.request(request, handle_response)
+        if not done.wait(MAX_TRANSMIT_WAIT):
+            raise RuntimeError("No response from server")
+
+    try:
+        for _ in range(warmup):
+            send()
+        del results[:]
+
+        latencies = []
+        cpu_start = time.process_time()
+        for _ in range(requests):
+            start = time.perf_counter()
+            send()
+            latencies.append(time.perf_counter() - start)
+        cpu = time.process_time() - cpu_start
+    finally:
+        client_transport.close()
+        server_transport.close()
+
+    if any(result != RESULT_SUCCESS for result in results):
+        raise RuntimeError("Requests failed")
+
+    latencies.sort()
+    return {'mean': 1e6 * sum(latencies) / len(latencies),
+            'p50': 1e6 * latencies[len(latencies) // 2],
+            'p99': 1e6 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'cpu': 1e6 * cpu / requests}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument("-n", "--requests", type=int, default=5000, help="number of requests per transport")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "server.sock")
+        unix = measure(UnixSocketTransport(path), UnixSocketTransport(os.path.join(directory, "client.sock")),
+                       unix_endpoint(path), args.requests)
+    udp = measure(SocketTransport(SERVER_PORT), SocketTransport(), (ip_address(u"127.0.0.1"), SERVER_PORT),
+                  args.requests)
+
+    print("%-10s %10s %10s %10s %12s" % ("transport", "mean [us]", "p50 [us]", "p99 [us]", "cpu/req [us]"))
+    for name, stats in (("unix", unix), ("udp", udp)):
+        print("%-10s %10.1f %10.1f %10.1f %12.1f" % (name, stats['mean'], stats['p50'], stats['p99'], stats['cpu']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Admission control of incoming requests.
+"""
+import threading
+import time
+
+from piccata.constants import *
+from piccata.message import Message
+
+
+def is_continuation(request):
+    """Check if a request continues a transaction that was already admitted.
+
+    Block-wise transfers past the first block and observation deregistrations are continuations.
+
+    Args:
+        request (piccata.message.Message): A request.
+
+    Returns:
+        bool: True if the request continues an admitted transaction.
+    """
+    block1 = request.opt.block1
+    block2 = request.opt.block2
+    return ((block1 is not None and block1[0] > 0) or
+            (block2 is not None and block2[0] > 0) or
+            request.opt.observe == 1)
+
+
+class AdmissionController(object):
+    """Sheds load when requests are handled slower than they arrive.
+
+    A request is rejected with 5.03 Service Unavailable and Max-Age telling the client when to retry,
+    if too many requests are pending or the average handling time is over the limit. Requests
+    continuing an admitted transaction are always admitted, so transfers in progress can complete.
+    ACK and RST messages are handled by the message layer and never reach admission control.
+    """
+
+    def __init__(self, max_pending=64, max_latency=1.0, retry_after=2, smoothing=0.2):
+        """Initialize.
+
+        Args:
+            max_pending (int): A maximum number of requests admitted and not handled yet, waiting or being handled.
+            max_latency (float): A maximum average time of handling a request in seconds. May be None for no limit.
+            retry_after (int): A time in seconds after which rejected clients may retry (sent as Max-Age).
+            smoothing (float): A weight of the latest sample in the average handling time.
+        """
+        if max_pending < 1:
+            raise ValueError("At least one pending request shall be allowed")
+
+        self.max_pending = max_pending
+        self.max_latency = max_latency
+        self.retry_after = retry_after
+        self.smoothing = smoothing
+
+        self.pending = 0
+        self.latency = 0.0
+        self.admitted = 0
+        self.shed = 0
+        self.shed_pending = 0
+        self.shed_latency = 0
+
+        self._lock = threading.Lock()
+        self._last_sample = None
+
+    def admit(self, request, now=None):
+        """Decide whether a request shall be handled. Admitted requests shall be reported with finished.
+
+        Args:
+            request (piccata.message.Message): A request received.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            bool: True if the request is admitted, False if it shall be rejected.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not is_continuation(request):
+                if self.pending >= self.max_pending:
+                    self.shed += 1
+                    self.shed_pending += 1
+                    return False
+                if (self.max_latency is not None and self.latency > self.max_latency and
+                        now - self._last_sample < self.retry_after):
+                    # Once in a while a request is let through to measure the handling time again.
+                    self.shed += 1
+                    self.shed_latency += 1
+                    return False
+            self.pending += 1
+            self.admitted += 1
+            return True
+
+    def finished(self, started, now=None):
+        """Report an admitted request was handled.
+
+        Args:
+            started (float): A time the request was admitted at, in seconds.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.pending -= 1
+            self.latency += self.smoothing * ((now - started) - self.latency)
+            self._last_sample = now
+
+    def reject(self, request):
+        """Create a response to a request that was not admitted.
+
+        Args:
+            request (piccata.message.Message): A request rejected.
+
+        Returns:
+            piccata.message.Message: A 5.03 Service Unavailable response.
+        """
+        response = Message.AckMessage(request, code=SERVICE_UNAVAILABLE)
+        response.opt.max_age = self.retry_after
+        return response
+
+    def stats(self):
+        """Get admission statistics.
+
+        Returns:
+            dict: Numbers of admitted and shed requests, pending requests and the average handling time.
+        """
+        return {'admitted': self.admitted, 'shed': self.shed, 'shed_pending': self.shed_pending,
+                'shed_latency': self.shed_latency, 'pending': self.pending, 'latency': self.latency}
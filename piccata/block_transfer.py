@@ -5,6 +5,8 @@ Copyright (c) 2012 Maciej Wasilak <http://sixpinetrees.blogspot.com/>
 CoAP block transfer helper functions.
 """
 
+import collections
+
 import piccata
 
 from piccata.constants import *
@@ -30,24 +32,62 @@ def extract_block(data, number, size_exp):
 def size_exp_to_size(size_exp):
     return 2 ** (size_exp + 4)
 
-def create_block_1_request(data, number, uri_path, mtype=CON, code=PUT, size_exp=DEFAULT_BLOCK_SIZE_EXP):
+def size_to_size_exp(size):
+    """Get the largest block size exponent which block size does not exceed the given size.
+
+    Args:
+        size (int): A size limit in bytes.
+
+    Returns:
+        int: A size exponent, clamped to MIN_BLOCK_SIZE_EXP..MAX_BLOCK_SIZE_EXP range.
+    """
+    size_exp = MAX_BLOCK_SIZE_EXP
+    while size_exp > MIN_BLOCK_SIZE_EXP and size_exp_to_size(size_exp) > size:
+        size_exp -= 1
+    return size_exp
+
+def _adapted_block(number, size_exp, controller, remote):
+    """Rescale a block to the size chosen by a controller for a peer, keeping the offset of the block.
+
+    The block size grows only if the offset is a multiple of the larger size.
+
+    Returns:
+        tuple: A (number, size_exp) tuple.
+    """
+    chosen = controller.size_exp(remote)
+    offset = number * size_exp_to_size(size_exp)
+    if chosen < size_exp or offset % size_exp_to_size(chosen) == 0:
+        return offset // size_exp_to_size(chosen), chosen
+    return number, size_exp
+
+def create_block_1_request(data, number, uri_path, mtype=CON, code=PUT, size_exp=DEFAULT_BLOCK_SIZE_EXP,
+                           controller=None, remote=None):
     """Generate a block 1 request
 
+    If a block size controller is given, the block is rescaled to the size it chooses for the remote.
+    The number and size exponent of the block sent are in the Block1 option of the request.
+
     Args:
         number (int): Block number to send.
         uri_path (tuple): A tuple containing strings representing target resource URI path.
         type (int): Type of the request (CON/NON).
         code (int): Code of the request (PUT/POST).
+        size_exp (int): A size exponent the block number is given in.
+        controller (piccata.block_transfer.BlockSizeController): A controller choosing the block size. May be None.
+        remote (piccata.types.Endpoint): A destination of the request, required with a controller.
 
     Returns:
         piccata.message.Message: A request contating specific block 1 option and payload.
     """
+    if controller is not None:
+        number, size_exp = _adapted_block(number, size_exp, controller, remote)
+
     data_block, more = extract_block(data, number, size_exp)
 
     if data_block == None:
         raise ValueError("Block 1 request number out of bound.")
 
-    if type not in (CON, NON):
+    if mtype not in (CON, NON):
         raise ValueError("Block 1 request should be of type CON or NON")
 
     if code not in (PUT, POST):
@@ -56,6 +96,8 @@ def create_block_1_request(data, number, uri_path, mtype=CON, code=PUT, size_exp
     request = Message(mtype=mtype, code=code, payload=data_block, token=piccata.message.random_token())
     request.opt.uri_path = uri_path
     request.opt.block1 = (number, more, size_exp)
+    if remote is not None:
+        request.remote = remote
     return request
 
 def create_block_1_response(request):
@@ -69,35 +111,58 @@ def create_block_1_response(request):
     """
     raise NotImplemented("Feature is not yet implemented")
 
-def create_block_2_request(number, uri_path, mtype=CON, size_exp=DEFAULT_BLOCK_SIZE_EXP):
+def create_block_2_request(number, uri_path, mtype=CON, size_exp=DEFAULT_BLOCK_SIZE_EXP, controller=None, remote=None):
     """Generate a block 2 request
 
+    If a block size controller is given, the block is rescaled to the size it chooses for the remote.
+
     Args:
         uri_path (tuple): A tuple containing strings representing target resource URI path.
         number (int): Requested block number.
         type (int): Type of the request (CON/NON).
+        size_exp (int): A size exponent the block number is given in.
+        controller (piccata.block_transfer.BlockSizeController): A controller choosing the block size. May be None.
+        remote (piccata.types.Endpoint): A destination of the request, required with a controller.
 
     Returns:
         piccata.message.Message: A request contating specific block 2 option.
     """
-    if type not in (CON, NON):
+    if mtype not in (CON, NON):
         raise ValueError("Block 2 request should be of type CON or NON")
 
+    if controller is not None:
+        number, size_exp = _adapted_block(number, size_exp, controller, remote)
+
     request = Message(mtype=mtype, code=GET, token=piccata.message.random_token())
     request.opt.uri_path = uri_path
     request.opt.block2 = (number, False, size_exp)
+    if remote is not None:
+        request.remote = remote
     return request
 
-def create_block_2_response(data, request):
+def create_block_2_response(data, request, size_exp=None, controller=None):
     """Generate a block 2 response for a specific request.
 
+    The server may answer with smaller blocks than the client asked for. In such case
+    the requested block number is rescaled, so the response starts at the same offset.
+
     Args:
         request (piccata.message.Message): A request received.
+        size_exp (int): A size exponent preferred by the server. May be None to use the one requested.
+        controller (piccata.block_transfer.BlockSizeController): A controller choosing the block size for
+            the requesting peer, used if no size exponent is given. May be None.
 
     Returns:
         piccata.message.Message: A response generated.
     """
-    data_block, more = extract_block(data, request.opt.block2.num, request.opt.block2.szx)
+    if size_exp is None and controller is not None:
+        size_exp = controller.size_exp(request.remote)
+    number, _, szx = request.opt.block2
+    if size_exp is not None and size_exp < szx:
+        number = number << (szx - size_exp)
+        szx = size_exp
+
+    data_block, more = extract_block(data, number, szx)
 
     if data_block == None:
         raise ValueError("Block 2 request number out of bound.")
@@ -107,5 +172,171 @@ def create_block_2_response(data, request):
     else:
         response = Message(mtype=NON, code=CONTENT, payload=data_block, token=request.token)
 
-    response.opt.block2 = (request.opt.block2.num, more, request.opt.block2.szx)
+    response.opt.block2 = (number, more, szx)
     return response
+
+
+class _PeerBlockSize(object):
+    """Block size state kept for a single peer."""
+
+    __slots__ = ('size_exp', 'limit', 'loss_rate', 'clean', 'exchanges', 'shrinks', 'grows')
+
+    def __init__(self, size_exp, limit):
+        self.size_exp = size_exp
+        self.limit = limit
+        self.loss_rate = 0.0
+        self.clean = 0
+        self.exchanges = 0
+        self.shrinks = 0
+        self.grows = 0
+
+
+class BlockSizeController(object):
+    """Per-peer block size selection for blockwise transfers.
+
+    The block size starts at the initial exponent (clamped to what fits into the transport MTU)
+    and is adapted for every peer separately:
+        - it never exceeds the size negotiated by the peer (smaller szx in a Block1/Block2 response),
+        - it shrinks when the observed retransmission rate exceeds shrink_threshold,
+        - it grows after grow_after consecutive exchanges that needed no retransmission.
+
+    The controller learns about retransmissions as an exchange listener, e.g.:
+        controller = BlockSizeController(transport.mtu)
+        protocol.register_exchange_listener(controller)
+    and is passed to the block request and response helpers, which use the size it chooses.
+    """
+
+    def __init__(self, mtu=None, initial_size_exp=DEFAULT_BLOCK_SIZE_EXP, overhead=BLOCK_OVERHEAD,
+                 shrink_threshold=0.2, grow_after=8, smoothing=0.25, max_peers=1024):
+        """Initialize the controller.
+
+        Args:
+            mtu (int): A transport MTU in bytes. May be None if unknown.
+            initial_size_exp (int): A size exponent used for peers with no history.
+            overhead (int): Bytes reserved in a datagram for IP/UDP and CoAP headers.
+            shrink_threshold (float): A retransmission rate above which the block size is reduced.
+            grow_after (int): A number of clean exchanges after which the block size is increased.
+            smoothing (float): A weight of the newest sample in the retransmission rate average.
+            max_peers (int): A maximum number of peers tracked. The least recently used peer is forgotten
+                when a new one is seen.
+        """
+        if max_peers < 1:
+            raise ValueError("At least one peer shall be tracked")
+        if mtu is None:
+            self.max_size_exp = MAX_BLOCK_SIZE_EXP
+        else:
+            self.max_size_exp = size_to_size_exp(mtu - overhead)
+        self.initial_size_exp = max(MIN_BLOCK_SIZE_EXP, min(initial_size_exp, self.max_size_exp))
+        self.shrink_threshold = shrink_threshold
+        self.grow_after = grow_after
+        self.smoothing = smoothing
+        self.max_peers = max_peers
+
+        self._peers = collections.OrderedDict()  # per-peer block size state (identified by remote), least recently used first
+        self._chosen = {}  # number of times each block size was handed out (identified by size exponent)
+
+    def _peer(self, remote):
+        peer = self._peers.get(remote)
+        if peer is None:
+            peer = _PeerBlockSize(self.initial_size_exp, self.max_size_exp)
+            self._peers[remote] = peer
+            if len(self._peers) > self.max_peers:
+                self._peers.popitem(last=False)
+        else:
+            self._peers.move_to_end(remote)
+        return peer
+
+    def size_exp(self, remote):
+        """Get a size exponent that shall be used for the next block sent to or requested from a peer.
+
+        Args:
+            remote (piccata.types.Endpoint): A peer address.
+
+        Returns:
+            int: A block size exponent.
+        """
+        size_exp = self._peer(remote).size_exp
+        self._chosen[size_exp] = self._chosen.get(size_exp, 0) + 1
+        return size_exp
+
+    def negotiated(self, remote, size_exp):
+        """Limit the block size for a peer to the size exponent it has chosen.
+
+        Args:
+            remote (piccata.types.Endpoint): A peer address.
+            size_exp (int): A size exponent received from the peer.
+        """
+        peer = self._peer(remote)
+        if size_exp < peer.limit:
+            peer.limit = size_exp
+        if peer.size_exp > peer.limit:
+            peer.size_exp = peer.limit
+
+    def update_from_response(self, response):
+        """Apply the size exponent carried in Block1/Block2 option of a received response.
+
+        Args:
+            response (piccata.message.Message): A response received from a peer.
+        """
+        for block in (response.opt.block1, response.opt.block2):
+            if block is not None:
+                self.negotiated(response.remote, block.szx)
+
+    def exchange_completed(self, message, result, retransmissions):
+        """Update the retransmission rate of a peer. Called by the CoAP message layer.
+
+        Args:
+            message (piccata.message.Message): A CON message that finished its exchange.
+            result (int): A result code of the exchange.
+            retransmissions (int): A number of times the message was retransmitted.
+        """
+        if result == RESULT_CANCELLED and retransmissions == 0:
+            # Cancelled before any loss could be observed.
+            return
+
+        peer = self._peer(message.remote)
+        peer.exchanges += 1
+        if result == RESULT_TIMEOUT:
+            sample = 1.0
+        else:
+            sample = retransmissions / (retransmissions + 1.0)
+        peer.loss_rate += self.smoothing * (sample - peer.loss_rate)
+
+        if sample > 0:
+            peer.clean = 0
+            if peer.loss_rate > self.shrink_threshold and peer.size_exp > MIN_BLOCK_SIZE_EXP:
+                peer.size_exp -= 1
+                peer.shrinks += 1
+        else:
+            peer.clean += 1
+            if peer.clean >= self.grow_after and peer.size_exp < peer.limit:
+                peer.size_exp += 1
+                peer.grows += 1
+                peer.clean = 0
+
+    def forget(self, remote):
+        """Drop the history kept for a peer.
+
+        Args:
+            remote (piccata.types.Endpoint): A peer address.
+        """
+        self._peers.pop(remote, None)
+
+    def stats(self):
+        """Get block size statistics.
+
+        Returns:
+            dict: A dictionary with block sizes handed out ('chosen', block size -> count)
+                  and the current state of every peer ('peers', remote -> dictionary).
+        """
+        peers = {}
+        for remote, peer in self._peers.items():
+            peers[remote] = {'block_size': size_exp_to_size(peer.size_exp),
+                             'size_exp': peer.size_exp,
+                             'limit': size_exp_to_size(peer.limit),
+                             'loss_rate': peer.loss_rate,
+                             'exchanges': peer.exchanges,
+                             'shrinks': peer.shrinks,
+                             'grows': peer.grows}
+        chosen = {size_exp_to_size(size_exp): count for size_exp, count in self._chosen.items()}
+        return {'chosen': chosen, 'peers': peers}
@@ -0,0 +1,395 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Caching of responses (RFC 7252, section 5.6).
+"""
+import collections
+import copy
+import hashlib
+import math
+import threading
+import time
+
+from piccata import option
+from piccata.constants import *
+from piccata.message import Message
+
+
+def cache_key(request):
+    """Get a key identifying the representation a GET request asks for.
+
+    Args:
+        request (piccata.message.Message): A GET request.
+
+    Returns:
+        tuple: A (remote, Uri-Path, Uri-Query, Accept) tuple.
+    """
+    query = request.opt.get_option(URI_QUERY)
+    query = () if query is None else tuple([segment.value for segment in query])
+    return (request.remote, request.opt.get_uri_path_tuple(), query, request.opt.accept)
+
+
+def coalescing_key(request):
+    """Get a key identifying GET requests that may share a single response.
+
+    Requests carrying different ETags may be answered differently (e.g. 2.03 Valid without a representation),
+    so the set of ETags is a part of the key.
+
+    Args:
+        request (piccata.message.Message): A GET request.
+
+    Returns:
+        tuple: A key returned by cache_key, extended with the ETags of the request.
+    """
+    return cache_key(request) + (frozenset(request.opt.etags), )
+
+
+def is_cacheable(request):
+    """Check if a request may be answered from the cache.
+
+    Observe registrations and Block2 continuations always go to the wire.
+
+    Args:
+        request (piccata.message.Message): A request.
+
+    Returns:
+        bool: True if the request may be served from the cache.
+    """
+    return request.code is GET and request.opt.observe is None and request.opt.block2 is None
+
+
+def _copy_response(response):
+    """Get a copy of a stored response, which header fields and options may be changed by the caller."""
+    response = copy.copy(response)
+    options = response.opt
+    response.opt = option.Options()
+    for opt in options.option_list():
+        response.opt.add_option(opt)
+    response._encoded_body = None
+    return response
+
+
+class _CacheEntry(object):
+
+    __slots__ = ('response', 'expires', 'size')
+
+    def __init__(self, response, expires):
+        self.response = response
+        self.expires = expires
+        self.size = len(response.payload)
+
+
+class ResponseCache(object):
+    """LRU cache of 2.05 Content responses.
+
+    Fresh entries (within Max-Age) are served locally. Stale entries carrying an ETag are kept,
+    so the request can be revalidated and a 2.03 Valid response served from the cache.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=64 * 1024):
+        """Initialize.
+
+        Args:
+            max_entries (int): A maximum number of responses stored.
+            max_bytes (int): A maximum total size of payloads stored. May be None for no limit.
+        """
+        if max_entries < 1:
+            raise ValueError("Cache shall hold at least one entry")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def lookup(self, key, now=None):
+        """Find a response for the key.
+
+        A fresh response is counted as a hit. A stale response is returned for revalidation,
+        and counted once the revalidation result is known.
+
+        Args:
+            key (tuple): A key returned by cache_key.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            tuple: A (response, fresh) tuple, or (None, False) if nothing usable is stored. The response is a copy,
+                which the caller may modify.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            if now < entry.expires:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_response(entry.response), True
+            if entry.response.opt.etag is None:
+                self._remove(key)
+                self.misses += 1
+                return None, False
+            return _copy_response(entry.response), False
+
+    def store(self, key, response, now=None):
+        """Store a response to a request. Responses other than 2.05 Content are not stored.
+
+        Args:
+            key (tuple): A key returned by cache_key.
+            response (piccata.message.Message): A response received.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+        """
+        if response.code is not CONTENT:
+            return
+        now = time.monotonic() if now is None else now
+        max_age = response.opt.max_age
+        entry = _CacheEntry(response, now + (DEFAULT_MAX_AGE if max_age is None else max_age))
+        if self.max_bytes is not None and entry.size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and self._size > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def revalidated(self, key, response, now=None):
+        """Update a stale entry after a response to the revalidation request.
+
+        Args:
+            key (tuple): A key returned by cache_key.
+            response (piccata.message.Message): A response to the request carrying a stored ETag.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            piccata.message.Message: A copy of the stored response if the server answered with 2.03 Valid and
+                a matching ETag, otherwise None.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if (response.code is VALID and entry is not None and
+                    (response.opt.etag is None or response.opt.etag == entry.response.opt.etag)):
+                max_age = response.opt.max_age
+                entry.expires = now + (DEFAULT_MAX_AGE if max_age is None else max_age)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_response(entry.response)
+            self.misses += 1
+        if response.code is CONTENT:
+            self.store(key, response, now)
+        else:
+            self.invalidate(key)
+        return None
+
+    def invalidate(self, key):
+        """Remove a stored response.
+
+        Args:
+            key (tuple): A key returned by cache_key.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all stored responses."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Get cache statistics.
+
+        Returns:
+            dict: Numbers of hits, misses, entries and bytes stored.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._size}
+
+
+def representation_key(request):
+    """Get a key identifying the representation of a local resource a GET request asks for.
+
+    Args:
+        request (piccata.message.Message): A GET request.
+
+    Returns:
+        tuple: A (Uri-Path, Uri-Query, Accept) tuple.
+    """
+    return cache_key(request)[1:]
+
+
+def make_etag(response):
+    """Derive an ETag from the payload and Content-Format of a response.
+
+    Args:
+        response (piccata.message.Message): A response.
+
+    Returns:
+        bytes: An 8-byte entity tag.
+    """
+    digest = hashlib.blake2b(response.payload, digest_size=8)
+    if response.opt.content_format is not None:
+        digest.update(response.opt.content_format.to_bytes(2, 'big'))
+    return digest.digest()
+
+
+class _RepresentationEntry(object):
+
+    __slots__ = ('resource', 'code', 'payload', 'options', 'etag', 'expires')
+
+    def __init__(self, resource, response, expires):
+        self.resource = resource
+        self.code = response.code
+        self.payload = response.payload
+        self.options = [option for option in response.opt.option_list() if option.number != MAX_AGE]
+        self.etag = response.opt.etag
+        self.expires = expires
+
+
+class RepresentationCache(object):
+    """LRU cache of representations rendered by local resources.
+
+    Representations are stored until the resource invalidates them or their Max-Age expires.
+    Responses without an ETag get one derived from their content, so clients can revalidate
+    them and be answered with 2.03 Valid without rendering.
+    """
+
+    def __init__(self, max_entries=256):
+        """Initialize.
+
+        Args:
+            max_entries (int): A maximum number of representations stored.
+        """
+        if max_entries < 1:
+            raise ValueError("Cache shall hold at least one entry")
+
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._keys = {}  # resource -> set of keys of its representations
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._keys[entry.resource]
+        keys.discard(key)
+        if not keys:
+            del self._keys[entry.resource]
+
+    def _response(self, request, entry, now):
+        """Create a response from a stored representation."""
+        max_age = max(0, int(math.ceil(entry.expires - now)))
+        if entry.etag in request.opt.etags:
+            response = Message(code=VALID)
+            response.opt.etag = entry.etag
+        else:
+            response = Message(code=entry.code, payload=entry.payload)
+            for option in entry.options:
+                response.opt.add_option(option)
+        response.opt.max_age = max_age
+        response.remote = request.remote
+        return response
+
+    def lookup(self, request, now=None):
+        """Answer a GET request from a stored representation.
+
+        Args:
+            request (piccata.message.Message): A GET request.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            piccata.message.Message: A 2.03 Valid response if the request carries the ETag of the stored
+                representation, a copy of the representation otherwise, or None if nothing is stored.
+        """
+        now = time.monotonic() if now is None else now
+        key = representation_key(request)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now >= entry.expires:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._response(request, entry, now)
+
+    def store(self, resource, request, response, now=None):
+        """Store a representation rendered by a resource. Responses other than 2.05 Content are not stored.
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource that rendered the response.
+            request (piccata.message.Message): A GET request.
+            response (piccata.message.Message): A response rendered. An ETag is added if it has none.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            piccata.message.Message: A response to send, 2.03 Valid if the request carries the ETag of the representation.
+        """
+        if response is None or response.code is not CONTENT:
+            return response
+        now = time.monotonic() if now is None else now
+        if response.opt.etag is None:
+            response.opt.etag = make_etag(response)
+        max_age = response.opt.max_age
+        entry = _RepresentationEntry(resource, response, now + (DEFAULT_MAX_AGE if max_age is None else max_age))
+        key = representation_key(request)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._keys.setdefault(resource, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+        if entry.etag in request.opt.etags:
+            valid = self._response(request, entry, now)
+            valid.mtype, valid.mid, valid.token = response.mtype, response.mid, response.token
+            return valid
+        return response
+
+    def invalidate(self, resource):
+        """Remove all stored representations of a resource.
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource that has changed.
+        """
+        with self._lock:
+            for key in self._keys.pop(resource, ()):
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all stored representations."""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        """Get cache statistics.
+
+        Returns:
+            dict: Numbers of hits, misses and entries stored.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Sources of time and timers used by the protocol.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+
+class Clock(object):
+    """Interface of a clock. All timeouts, timers and expiry times of a protocol instance use a single clock."""
+
+    random = random
+    """Random number generator of protocol timing: initial message IDs, ACK timeouts, leisure and re-registration
+    jitter. The random module by default."""
+
+    def now(self):
+        """Get the current time.
+
+        Returns:
+            float: A monotonic time in seconds.
+        """
+        raise NotImplementedError
+
+    def call_later(self, delay, function, *args):
+        """Call a function after a delay.
+
+        Args:
+            delay (float): A delay in seconds.
+            function (function): A function to call.
+            args (tuple): Arguments of the function.
+
+        Returns:
+            object: A timer handle with a cancel method.
+        """
+        raise NotImplementedError
+
+
+class RealTimeClock(Clock):
+    """Clock following time.monotonic. Functions are called from timer threads."""
+
+    def now(self):
+        return time.monotonic()
+
+    def call_later(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class _VirtualTimer(object):
+    """A function call scheduled on a VirtualClock."""
+
+    __slots__ = ('time', 'function', 'args', 'cancelled')
+
+    def __init__(self, time, function, args):
+        self.time = time
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock(Clock):
+    """Clock advanced explicitly, calling due functions in order of their time.
+
+    Time does not pass on its own: run processes scheduled calls and advances the clock instantly,
+    so hours of protocol time (e.g. EXCHANGE_LIFETIME expiry) take as long as the processing does.
+    Functions are called by the thread calling run. Protocol timing is randomized by a generator of
+    the clock, so a simulation seeded with the same value is reproducible.
+    """
+
+    def __init__(self, start=0.0, seed=None):
+        """Initialize.
+
+        Args:
+            start (float): An initial time in seconds.
+            seed (int): A seed of the random number generator. May be None for a random seed.
+        """
+        self.random = random.Random(seed)
+        self._now = start
+        self._lock = threading.RLock()
+        self._timers = []  # (time, sequence, timer) heap, cancelled timers are skipped when due
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def now(self):
+        return self._now
+
+    def call_later(self, delay, function, *args):
+        with self._lock:
+            timer = _VirtualTimer(self._now + max(delay, 0.0), function, args)
+            heapq.heappush(self._timers, (timer.time, next(self._sequence), timer))
+        return timer
+
+    def run(self, duration=None, max_calls=None):
+        """Advance the clock, calling due functions.
+
+        Args:
+            duration (float): A time in seconds to advance by. May be None to run until nothing is scheduled.
+            max_calls (int): A maximum number of functions called. May be None for no limit.
+
+        Returns:
+            int: A number of functions called.
+        """
+        with self._lock:
+            end = self._now + duration if duration is not None else None
+        calls = 0
+        while max_calls is None or calls < max_calls:
+            with self._lock:
+                if not self._timers or (end is not None and self._timers[0][0] > end):
+                    break
+                _, _, timer = heapq.heappop(self._timers)
+                if timer.cancelled:
+                    continue
+                self._now = max(self._now, timer.time)
+            try:
+                timer.function(*timer.args)
+            except Exception:
+                logging.exception("Exception in function called by virtual clock")
+            calls += 1
+        with self._lock:
+            if end is not None and end > self._now and (max_calls is None or calls < max_calls):
+                self._now = end
+        return calls
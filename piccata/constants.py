@@ -36,6 +36,10 @@ NSTART = 1
 """Maximum number of simultaneous outstanding interactions
    that endpoint maintains to a given server (including proxies)"""
 
+DEFAULT_LEISURE = 5.0
+"""Time, in seconds, a server may delay a response to a multicast
+request, so responses of group members do not collide."""
+
 #   +-------------------+---------------+
 #   | name              | default value |
 #   +-------------------+---------------+
@@ -76,9 +80,22 @@ i.e. message layer information about the message exchange can be purged"""
 DEFAULT_BLOCK_SIZE_EXP = 2  # Block size 64
 """Default size exponent for blockwise transfers."""
 
+MIN_BLOCK_SIZE_EXP = 0  # Block size 16
+"""Smallest size exponent allowed for blockwise transfers."""
+
+MAX_BLOCK_SIZE_EXP = 6  # Block size 1024
+"""Largest size exponent allowed for blockwise transfers."""
+
+BLOCK_OVERHEAD = 128
+"""Bytes of a datagram reserved for IP, UDP and CoAP headers when
+deriving block size from the transport MTU."""
+
 EMPTY_ACK_DELAY = 0.1
 """After this time protocol sends empty ACK, and separate response"""
 
+DEFAULT_MAX_AGE = 60
+"""Default value of the Max-Age option in seconds."""
+
 MAX_TOKEN_LENGTH = 8
 """Maximum length of a token"""
 
@@ -112,6 +129,9 @@ GET = 1
 POST = 2
 PUT = 3
 DELETE = 4
+FETCH = 5
+PATCH = 6
+IPATCH = 7
 CREATED = 65
 DELETED = 66
 VALID = 67
@@ -129,6 +149,7 @@ REQUEST_ENTITY_INCOMPLETE = 136
 PRECONDITION_FAILED = 140
 REQUEST_ENTITY_TOO_LARGE = 141
 UNSUPPORTED_CONTENT_FORMAT = 143
+TOO_MANY_REQUESTS = 157
 INTERNAL_SERVER_ERROR = 160
 NOT_IMPLEMENTED = 161
 BAD_GATEWAY = 162
@@ -139,7 +160,10 @@ PROXYING_NOT_SUPPORTED = 165
 requests = {1: 'GET',
             2: 'POST',
             3: 'PUT',
-            4: 'DELETE'}
+            4: 'DELETE',
+            5: 'FETCH',
+            6: 'PATCH',
+            7: 'iPATCH'}
 
 requests_rev = {v:k for k, v in requests.items()}
 
@@ -160,6 +184,7 @@ responses = {65: '2.01 Created',
              140: '4.12 Precondition Failed',
              141: '4.13 Request Entity Too Large',
              143: '4.15 Unsupported Content-Format',
+             157: '4.29 Too Many Requests',
              160: '5.00 Internal Server Error',
              161: '5.01 Not Implemented',
              162: '5.02 Bad Gateway',
@@ -4,17 +4,34 @@ Copyright (c) 2012 Maciej Wasilak <http://sixpinetrees.blogspot.com/>
 
 CoAP protocol implementation.
 """
-import datetime
 import logging
+import math
 import os
-import random
+import struct
 import sys
-from threading import Timer
-from ipaddress import ip_address
+from threading import Lock
 
+from piccata.cache import cache_key, coalescing_key, is_cacheable
+from piccata.clock import RealTimeClock
 from piccata.constants import *
-from piccata.message import Message
-from piccata.types import Endpoint
+from piccata.executor import SerialExecutor
+from piccata.group import GroupExchange
+from piccata.message import Message, random_token
+from piccata.observe import Subscriptions
+from piccata.ratelimit import ACTION_DROP, ACTION_RESPOND
+from piccata.types import Endpoint, endpoint
+
+
+def _is_multicast(request):
+    """Check if a request was received on a multicast address."""
+    return request.local is not None and request.local[0].is_multicast
+
+
+def _endpoint(remote):
+    """Convert an address given by the application to an Endpoint, reusing Endpoints as they are."""
+    if isinstance(remote, Endpoint):
+        return remote
+    return endpoint(remote[0], remote[1])
 
 
 class _CoapMessageLayer(object):
@@ -24,20 +41,26 @@ class _CoapMessageLayer(object):
     Valid requests/responses are forwarded to the transaction layer.
     """
 
-    def __init__(self, transport):
+    def __init__(self, transport, clock=None):
         """ Initialize _CoapMessageLayer object.
 
         Args:
             transport (transport.TransportBase): A transport that shall be used by the message layer.
+            clock (piccata.clock.Clock): A clock used for retransmissions and deduplication. May be None for real time.
         """
         self._transport = transport
+        self.clock = clock if clock is not None else RealTimeClock()
         self._transaction_layer = None
 
-        self._message_id = random.randint(0, 65535)
+        self._message_id = self.clock.random.randint(0, 65535)
+        self._lock = Lock()  # guards message ID allocation, deduplication caches and active exchanges
 
         self._recent_local_ids = {}  # recently received messages with IDs generated locally (identified by message ID and remote)
         self._recent_remote_ids = {}  # recently received messages with IDs generated by remote endpoints (identified by message ID and remote)
         self._active_exchanges = {}  # active exchanges i.e. sent CON messages (identified by message ID and remote)
+        self._exchange_listeners = []  # objects informed about the outcome of every CON exchange
+        self.rate_limiter = None  # piccata.ratelimit.PeerRateLimiter applied to CON and NON messages before decoding
+        self.deduplication_store = None  # piccata.dedup.DeduplicationStore shared with other processes
 
     def _deduplicate_message(self, message):
         """Check incoming message if it's a duplicate.
@@ -52,49 +75,59 @@ class _CoapMessageLayer(object):
             bool: The return value. True if duplicate was detected, False otherwise.
         """
         def _add_message_to_recent(cache, key):
-            timeout = datetime.datetime.now() + datetime.timedelta(seconds=EXCHANGE_LIFETIME)
+            timeout = self.clock.now() + EXCHANGE_LIFETIME
             cache[key] = (message, timeout)
 
-        # Forget Message ID uses past their lifetime.
-        now = datetime.datetime.now()
-        for key, data in self._recent_local_ids.items():
-            timeout = data[1]
-            if timeout <= now:
-                del self._recent_local_ids[key]
-            else:
-                # dict iteration order is guarateed to be in
-                # insertion order. The rest of the messages are
-                # all newer.
-                break
-
         # Check for reused Message ID, remembering new messages
         # and issuing retransmissions.
         key = (message.mid, message.remote)
         logging.info("Incoming Message ID: %d" % message.mid)
 
-        if message.mtype in (CON, NON):
-            if key in self._recent_remote_ids:
-                if message.mtype is CON:
-                    if len(self._recent_remote_ids[key]) == 3:
-                        logging.info('Duplicate CON received, sending old response again')
-                        self.send_message(self._recent_remote_ids[key][2])
+        old_response = None
+        with self._lock:
+            # Forget Message ID uses past their lifetime.
+            # dict iteration order is guarateed to be in insertion order,
+            # so the oldest messages are first.
+            now = self.clock.now()
+            for cache in (self._recent_local_ids, self._recent_remote_ids):
+                while cache:
+                    oldest = next(iter(cache))
+                    if cache[oldest][1] > now:
+                        break
+                    del cache[oldest]
+
+            if message.mtype in (CON, NON):
+                if key in self._recent_remote_ids:
+                    duplicate = True
+                    if message.mtype is CON:
+                        if len(self._recent_remote_ids[key]) == 3:
+                            logging.info('Duplicate CON received, sending old response again')
+                            old_response = self._recent_remote_ids[key][2]
+                        else:
+                            logging.info('Duplicate CON received, no response to send')
                     else:
-                        logging.info('Duplicate CON received, no response to send')
+                        logging.info('Duplicate NON received')
+                elif (self.deduplication_store is not None and
+                      not self.deduplication_store.add(message.mid, message.remote, EXCHANGE_LIFETIME, now)):
+                    logging.info('Duplicate CON or NON received by another process')
+                    duplicate = True
                 else:
-                    logging.info('Duplicate NON received')
-                return True
-            else:
-                logging.info('New unique CON or NON message received')
-                _add_message_to_recent(self._recent_remote_ids, key)
-                return False
-        else:
-            if key in self._recent_local_ids:
-                logging.info('Duplicate ACK or RST received')
-                return True
+                    logging.info('New unique CON or NON message received')
+                    _add_message_to_recent(self._recent_remote_ids, key)
+                    duplicate = False
             else:
-                logging.info('New unique ACK or RST message received')
-                _add_message_to_recent(self._recent_local_ids, key)
-                return False
+                if key in self._recent_local_ids:
+                    logging.info('Duplicate ACK or RST received')
+                    duplicate = True
+                else:
+                    logging.info('New unique ACK or RST message received')
+                    _add_message_to_recent(self._recent_local_ids, key)
+                    duplicate = False
+
+        # The response is sent without holding the lock, sending may take a while.
+        if old_response is not None:
+            self.send_message(old_response)
+        return duplicate
 
     def _next_message_id(self):
         """Reserve and return a new message ID.
@@ -102,15 +135,15 @@ class _CoapMessageLayer(object):
         Returns:
             A new message ID.
         """
-        message_id = self._message_id
-        self._message_id = (self._message_id + 1) & 0xFFFF
+        with self._lock:
+            message_id = self._message_id
+            self._message_id = (self._message_id + 1) & 0xFFFF
         return message_id
 
     def _enqueue_exchange(self, message, timeout, retransmission_counter):
-        retransmission_timer = Timer(timeout, self._retransmit, (message.mid, timeout, retransmission_counter))
-        retransmission_timer.daemon = True
-        retransmission_timer.start()
-        self._active_exchanges[message.mid] = (message, retransmission_timer)
+        retransmission_timer = self.clock.call_later(timeout, self._retransmit, message.mid, timeout, retransmission_counter)
+        with self._lock:
+            self._active_exchanges[message.mid] = (message, retransmission_timer, retransmission_counter)
 
     def _add_exchange(self, message):
         """Add an outgoing CON message to the retransmission list.
@@ -121,26 +154,41 @@ class _CoapMessageLayer(object):
         Args:
             message (piccata.message.Message): A message to retransmit.
         """
-        timeout = random.uniform(ACK_TIMEOUT, ACK_TIMEOUT * ACK_RANDOM_FACTOR)
+        timeout = self.clock.random.uniform(ACK_TIMEOUT, ACK_TIMEOUT * ACK_RANDOM_FACTOR)
         retransmission_counter = 0
         self._enqueue_exchange(message, timeout, retransmission_counter)
         logging.info("Exchange added, Message ID: %d." % message.mid)
 
-    def _remove_exchange(self, mid):
+    def _remove_exchange(self, mid, result=RESULT_CANCELLED):
         """Remove a message from retranmission list and cancel the timer for next retransmission.
 
         Args:
            mid (int): An ID of a message to remove.
+           result (int): An outcome of the exchange reported to the exchange listeners.
 
         Returns:
             piccata.message.Message: A message removed from the retransmission list. None if no message was found.
         """
-        msg, timer = self._active_exchanges.pop(mid, (None, None))
+        with self._lock:
+            msg, timer, retransmission_counter = self._active_exchanges.pop(mid, (None, None, 0))
         if timer != None:
             timer.cancel()
         logging.info("Exchange removed, Message ID: %d." % mid)
+        if msg != None:
+            self._notify_exchange_listeners(msg, result, retransmission_counter)
         return msg
 
+    def _notify_exchange_listeners(self, message, result, retransmission_counter):
+        """Inform registered listeners that a CON exchange has finished.
+
+        Args:
+            message (piccata.message.Message): A CON message that the exchange was started with.
+            result (int): A result code of the exchange.
+            retransmission_counter (int): A number of times the message was retransmitted.
+        """
+        for listener in self._exchange_listeners:
+            listener.exchange_completed(message, result, retransmission_counter)
+
     def _retransmit(self, mid, timeout, retransmission_counter):
         """Retransmit CON message that has not been ACKed or RSTed.
 
@@ -149,17 +197,18 @@ class _CoapMessageLayer(object):
             timeout (int): A last timeout value.
             retransmission_counter (int): A number of times the message was retransmitted.
         """
-        message, _ = self._active_exchanges.pop(mid, (None, None))
+        with self._lock:
+            message, _, _ = self._active_exchanges.pop(mid, (None, None, 0))
         if message != None:
             if retransmission_counter < MAX_RETRANSMIT:
-                self._transport.send(message.encode(), message.remote)
+                self._transmit(message.encode(), message)
                 retransmission_counter += 1
                 timeout *= 2
                 self._enqueue_exchange(message, timeout, retransmission_counter)
                 logging.info("Retransmission, Message ID: %d." % message.mid)
             else:
-                pass
                 #TODO: error handling (especially for requests)
+                self._notify_exchange_listeners(message, RESULT_TIMEOUT, retransmission_counter)
         else:
             logging.error("Message no longer exists, Message ID: %d." % mid)
 
@@ -171,6 +220,26 @@ class _CoapMessageLayer(object):
         """
         self._transaction_layer = transaction_layer
 
+    def register_exchange_listener(self, listener):
+        """Register an object that will be informed about the outcome of every CON exchange.
+
+        Args:
+            listener (object): An object containing exchange_completed function.
+                The function shall be in format:
+                exchange_completed(message, result, retransmissions)
+        """
+        if listener not in self._exchange_listeners:
+            self._exchange_listeners.append(listener)
+
+    def remove_exchange_listener(self, listener):
+        """Remove an exchange listener.
+
+        Args:
+            listener (object): A listener that was previously registered.
+        """
+        if listener in self._exchange_listeners:
+            self._exchange_listeners.remove(listener)
+
     def receive(self, data, remote, local):
         """Process raw messages received from transport layer.
 
@@ -182,18 +251,52 @@ class _CoapMessageLayer(object):
             local (piccata.types.Endpoint): A destination address that data was received to.
         """
         logging.info("Received %r from %s:%d" % (data, remote[0], remote[1]))
+        if (self.rate_limiter is not None and len(data) >= 4 and (data[0] >> 4) & 0x03 in (CON, NON) and
+                (struct.unpack('!H', data[2:4])[0], remote) not in self._recent_remote_ids):
+            # Duplicates of messages already received are not charged, deduplication answers them.
+            delay = self.rate_limiter.delay(remote, self.clock.now())
+            if delay > 0:
+                self._reject_excess(data, remote, delay)
+                return
+
         message = Message.decode(data, remote)
+        message.local = local
         if self._deduplicate_message(message):
             return
 
         if message.mtype in (ACK, RST):
-            req = self._remove_exchange(message.mid)
-            if message.mtype == RST:
+            req = self._remove_exchange(message.mid, RESULT_SUCCESS if message.mtype == ACK else RESULT_RESET)
+            if message.mtype == RST and req is not None:
                 self._transaction_layer.reset_transaction(req)
                 return
 
         self._transaction_layer.receive_message(message, remote, local)
 
+    def _reject_excess(self, data, remote, delay):
+        """Handle a CON or NON message over the rate of its originator, using only the message header.
+
+        Args:
+            data (bytes): Data received.
+            remote (piccata.types.Endpoint): An address of the message originator.
+            delay (float): A time in seconds until the originator may send again.
+        """
+        action = self.rate_limiter.action
+        logging.info("Rate of %s:%d exceeded" % (remote[0], remote[1]))
+        if action == ACTION_DROP:
+            return
+
+        mtype = (data[0] >> 4) & 0x03
+        code = data[1]
+        mid = struct.unpack('!H', data[2:4])[0]
+        if action == ACTION_RESPOND and code >= 1 and code < 32:
+            token = data[4:4 + (data[0] & 0x0F)]
+            response = Message(ACK if mtype == CON else NON, mid if mtype == CON else None, TOO_MANY_REQUESTS, token=token)
+            response.opt.max_age = int(math.ceil(delay))
+        else:
+            response = Message(RST, mid, EMPTY)
+        response.remote = remote
+        self.send_message(response)
+
     def send_message(self, message):
         """Set Message ID, encode and send message. Also if message is Confirmable (CON) add exchange.
 
@@ -205,27 +308,63 @@ class _CoapMessageLayer(object):
         # Check if message is present on deduplication list and register response.
         if message.mtype in (ACK, RST):
             recent_key = (message.mid, message.remote)
-            if recent_key in self._recent_remote_ids:
-                if len(self._recent_remote_ids[recent_key]) != 3:
-                    self._recent_remote_ids[recent_key] = self._recent_remote_ids[recent_key] + (message,)
+            with self._lock:
+                if recent_key in self._recent_remote_ids:
+                    if len(self._recent_remote_ids[recent_key]) != 3:
+                        self._recent_remote_ids[recent_key] = self._recent_remote_ids[recent_key] + (message,)
 
         if message.mid is None:
             message.mid = self._next_message_id()
 
         raw_message = message.encode()
-        self._transport.send(raw_message, message.remote)
 
+        # The exchange is added before sending, an ACK may arrive before send returns.
         if message.mtype is CON:
             self._add_exchange(message)
+        try:
+            self._transmit(raw_message, message)
+        except Exception:
+            if message.mtype is CON:
+                with self._lock:
+                    _, timer, _ = self._active_exchanges.pop(message.mid, (None, None, 0))
+                if timer is not None:
+                    timer.cancel()
+            raise
         logging.info("Message %r sent successfully" % raw_message)
 
-    def cancel_retransmission(self, mid):
+    def _transmit(self, raw_message, message):
+        """Pass an encoded message to the transport, from the local address of the message if the transport supports it.
+
+        Args:
+            raw_message (bytes): An encoded message.
+            message (piccata.message.Message): The message, giving the destination and source addresses.
+        """
+        if message.local is not None and self._transport.source_selection:
+            self._transport.send(raw_message, message.remote, message.local)
+        else:
+            self._transport.send(raw_message, message.remote)
+
+    def cancel_retransmission(self, mid, result=RESULT_CANCELLED):
         """Simply cancel further retansmissions.
 
         Args:
             mid (int): A message ID of a transaction to cancel.
+            result (int): An outcome of the exchange reported to the exchange listeners.
         """
-        self._remove_exchange(mid)
+        self._remove_exchange(mid, result)
+
+
+class _PendingRequest(object):
+    """A request being handled in an executor."""
+
+    __slots__ = ('request', 'arrived', 'timer', 'acknowledged', 'done')
+
+    def __init__(self, request, arrived):
+        self.request = request
+        self.arrived = arrived
+        self.timer = None
+        self.acknowledged = False
+        self.done = False
 
 
 class _CoapTransactionLayer(object):
@@ -236,17 +375,29 @@ class _CoapTransactionLayer(object):
     Valid responses are forwareded to a callback registered with a respective request.
     """
 
-    def __init__(self, message_layer):
+    def __init__(self, message_layer, executor=None, leisure=DEFAULT_LEISURE, admission=None):
         """Initialize CoAP Transaction layer object.
 
         Args:
             message_layer (piccata.core._CoapMessageLayer): A _CoapMessageLayer object that shall
                                                         be bound to the transaction layer.
+            executor (concurrent.futures.Executor): An executor running request handlers and response callbacks.
+                May be None to run them in the receiving thread.
+            leisure (float): A maximum time in seconds responses to multicast requests are delayed for.
+            admission (piccata.admission.AdmissionController): An admission controller deciding whether requests
+                are handled, before they are queued for the request handler. May be None to handle all requests.
         """
         self._message_layer = message_layer
+        self.clock = message_layer.clock
+        self.leisure = leisure
+        self.admission = admission
         self._request_handler = None
+        self._executor = SerialExecutor(executor) if executor is not None else None
+        self._pending_lock = Lock()
 
         self._outgoing_requests = {}  # unfinished outgoing requests (identified by token and remote)
+        self._multicast_tokens = {}  # remotes of unfinished multicast requests (identified by token)
+        self.subscriptions = Subscriptions(self)  # observations of remote resources (identified by token)
 
     def _handle_app_callback(self, callback, result, request, response):
         """Call application callback registered with a request.
@@ -257,6 +408,13 @@ class _CoapTransactionLayer(object):
             request (piccata.message.Message): A request that the callback was registered with.
             response (piccata.message.Message): A response received to the respective request.
         """
+        if self._executor is not None:
+            # Callbacks of a single token (e.g. notifications) are called in order of reception.
+            self._executor.submit(request.token, self._call_app_callback, callback, result, request, response)
+        else:
+            self._call_app_callback(callback, result, request, response)
+
+    def _call_app_callback(self, callback, result, request, response):
         cb, args, kw = callback
         args = args or ()
         kw = kw or {}
@@ -269,10 +427,10 @@ class _CoapTransactionLayer(object):
             request (piccata.message.Message): A request that is part of the transaction.
             callback (function): A callback function registered by a user.
         """
-        timer = Timer(request.timeout, self._timeout_transaction, (request, ))
-        timer.daemon = True
-        timer.start()
+        timer = self.clock.call_later(request.timeout, self._timeout_transaction, request)
         self._outgoing_requests[(request.token, request.remote)] = (request, callback, timer)
+        if request.remote.addr.is_multicast:
+            self._multicast_tokens[request.token] = request.remote
 
     def _finish_transaction(self, token, remote, result, response):
         """Finalize the transaction by removing the transaction from list and calling respective callback.
@@ -288,9 +446,12 @@ class _CoapTransactionLayer(object):
         except KeyError:
             logging.info("Transaction not found.")
         else:
-            if (not remote.addr.is_multicast):
+            # A multicast request may be answered by many responders, it ends with the timeout or cancellation.
+            if not remote.addr.is_multicast or result is not RESULT_SUCCESS:
                 del self._outgoing_requests[(token, remote)]
                 timer.cancel()
+                if remote.addr.is_multicast:
+                    self._multicast_tokens.pop(token, None)
             self._handle_app_callback(callback, result, request, response)
 
     def _timeout_transaction(self, request):
@@ -301,7 +462,7 @@ class _CoapTransactionLayer(object):
         """
         logging.info("Request timed out")
         # In case of transaction layer timeout, remove a possible retransmission on message layer as well
-        self._message_layer.cancel_retransmission(request.mid)
+        self._message_layer.cancel_retransmission(request.mid, RESULT_TIMEOUT)
         self._finish_transaction(request.token, request.remote, RESULT_TIMEOUT, None)
 
     def _process_request(self, request):
@@ -313,14 +474,115 @@ class _CoapTransactionLayer(object):
         if request.mtype not in (CON, NON):
             return
 
-        if self._request_handler is not None:
-            response = self._request_handler.receive_request(request)
-            if response is not None:
-                self.send_response(request, response)
-        else:
+        if self._request_handler is None:
+            if _is_multicast(request):
+                return
             # Send reset if we do not process requests.
             rst = Message.EmptyRstMessage(request)
             self._message_layer.send_message(rst)
+            return
+
+        # Requests are admitted on arrival, so requests waiting in the executor count as pending
+        # and their handling time includes the time spent waiting.
+        arrived = self.clock.now()
+        if self.admission is not None and not self.admission.admit(request, arrived):
+            logging.info("Request not admitted")
+            self._send_handler_response(request, self.admission.reject(request), False)
+        elif self._executor is None:
+            try:
+                response = self._request_handler.receive_request(request)
+            finally:
+                self._finish_admission(arrived)
+            self._send_handler_response(request, response, False)
+        else:
+            pending = _PendingRequest(request, arrived)
+            if request.mtype is CON and not _is_multicast(request):
+                pending.timer = self.clock.call_later(EMPTY_ACK_DELAY, self._acknowledge_pending, pending)
+            # Requests of a single token (e.g. blocks of a transfer) are handled in order of reception.
+            self._executor.submit((request.remote, request.token), self._handle_pending, pending)
+
+    def _handle_pending(self, pending):
+        """Run the request handler in the executor and send its response.
+
+        Args:
+            pending (piccata.core._PendingRequest): A request to handle.
+        """
+        try:
+            response = self._request_handler.receive_request(pending.request)
+        except Exception:
+            logging.exception("Request handler failed")
+            response = Message.AckMessage(pending.request, code=INTERNAL_SERVER_ERROR)
+        self._finish_admission(pending.arrived)
+
+        with self._pending_lock:
+            pending.done = True
+            if pending.timer is not None:
+                pending.timer.cancel()
+            acknowledged = pending.acknowledged
+        self._send_handler_response(pending.request, response, acknowledged)
+
+    def _finish_admission(self, arrived):
+        """Report an admitted request was handled to the admission controller.
+
+        Args:
+            arrived (float): A time the request was received at, in seconds.
+        """
+        if self.admission is not None:
+            self.admission.finished(arrived, self.clock.now())
+
+    def _acknowledge_pending(self, pending):
+        """Send an empty ACK to a CON request the handler did not respond to within EMPTY_ACK_DELAY.
+
+        Args:
+            pending (piccata.core._PendingRequest): A request being handled.
+        """
+        with self._pending_lock:
+            if pending.done:
+                return
+            pending.acknowledged = True
+        logging.info("Request handling takes long - sending empty ACK")
+        self._message_layer.send_message(Message.EmptyAckMessage(pending.request))
+
+    def _send_handler_response(self, request, response, acknowledged):
+        """Send a response returned by the request handler.
+
+        Args:
+            request (piccata.message.Message): A request handled.
+            response (piccata.message.Message): A response returned by the handler. May be None.
+            acknowledged (bool): True if the request was acknowledged with an empty ACK already,
+                so the response shall be sent as a separate one.
+        """
+        if response is None:
+            return
+        if _is_multicast(request):
+            self._send_multicast_response(request, response)
+            return
+        if response.code is EMPTY:
+            # Request acknowledged, the response will be sent separately.
+            if not acknowledged:
+                self._message_layer.send_message(response)
+            return
+        if acknowledged:
+            response.mtype = CON
+            response.mid = None
+        self.send_response(request, response)
+
+    def _send_multicast_response(self, request, response):
+        """Send a response to a multicast request after a random leisure period (RFC 7252, section 8.2).
+
+        Error and empty responses are not sent, as every other group member could send the same.
+
+        Args:
+            request (piccata.message.Message): A multicast request handled.
+            response (piccata.message.Message): A response returned by the handler.
+        """
+        if response.code is EMPTY or not response.is_successfull():
+            logging.info("Response to multicast request suppressed, code %d" % response.code)
+            return
+
+        response.mtype = NON
+        response.mid = None
+        self.clock.call_later(self.clock.random.uniform(0, self.leisure), self.send_response, request, response)
 
     def _process_response(self, response):
         """Method used for processing incoming responses.
@@ -341,16 +603,22 @@ class _CoapTransactionLayer(object):
 
         logging.info("Received Response, token: %s, host: %s, port: %s" % (response.token.hex(), response.remote[0], response.remote[1]))
 
-        found = False
-        for token, remote in self._outgoing_requests.keys():
-            if (token == response.token) and (remote == response.remote or remote.addr.is_multicast):
-                found = True
-                self._finish_transaction(response.token, remote, RESULT_SUCCESS, response)
-                _ack_if_confirmable()
-                break
+        if self.subscriptions.receive(response):
+            _ack_if_confirmable()
+            return
 
-        if not found:
-            _reset_unrecognized()
+        transaction = self._outgoing_requests.get((response.token, response.remote))
+        if transaction is not None:
+            remote = transaction[0].remote
+        else:
+            # Responses to multicast requests come from unicast addresses.
+            remote = self._multicast_tokens.get(response.token)
+            if remote is None:
+                _reset_unrecognized()
+                return
+
+        self._finish_transaction(response.token, remote, RESULT_SUCCESS, response)
+        _ack_if_confirmable()
 
     def _process_empty(self, message):
         """Method used for processing empty messages.
@@ -360,9 +628,14 @@ class _CoapTransactionLayer(object):
         """
         if message.mtype is CON:
             logging.info('Empty CON message received (CoAP Ping) - replying with RST.')
-            rst = Message.EmptyRstMessage(request)
+            rst = Message.EmptyRstMessage(message)
             self._message_layer.send_message(rst)
-        # RST response is handled on the message layer (no token information in the RST message.)
+        elif message.mtype is RST:
+            # RST matching a CON message is handled on the message layer (no token information in the RST message).
+            # Other RSTs reject NON messages, e.g. notifications sent by the request handler.
+            receive_reset = getattr(self._request_handler, 'receive_reset', None)
+            if receive_reset is not None:
+                receive_reset(message)
 
     def reset_transaction(self, request):
         """Clean the transaction after reset from message processing layer.
@@ -371,6 +644,8 @@ class _CoapTransactionLayer(object):
             request (piccata.message.Message): A request to reset.
         """
         logging.info("Request reseted from the remote")
+        if self.subscriptions.reset(request):
+            return
         self._finish_transaction(request.token, request.remote, RESULT_RESET, None)
 
     def cancel_transaction(self, request):
@@ -438,14 +713,20 @@ class _CoapTransactionLayer(object):
         assert response_callback == None or callable(response_callback)
         assert request.token is not None
 
+        # The transaction is added first, as the response may be received before send_message returns.
+        if response_callback != None:
+            callback = (response_callback, response_callback_args, response_callback_kw)
+            self._add_transaction(request, callback)
         try:
             self._message_layer.send_message(request)
         except:
+            if response_callback != None:
+                _, _, timer = self._outgoing_requests.pop((request.token, request.remote))
+                timer.cancel()
+                if request.remote.addr.is_multicast:
+                    self._multicast_tokens.pop(request.token, None)
             raise
         else:
-            if response_callback != None:
-                callback = (response_callback, response_callback_args, response_callback_kw)
-                self._add_transaction(request, callback)
             logging.info("Sending request - Token: %s, Host: %s, Port: %s" % (request.token.hex(), str(request.remote[0]), request.remote[1]))
 
     def send_response(self, request, response):
@@ -463,6 +744,7 @@ class _CoapTransactionLayer(object):
         response.token = request.token
         logging.info("Token: %s" % ":".join("{:02x}".format(c) for c in response.token))
         response.remote = request.remote
+        response.local = request.local
 
         if response.mtype is None:
             if request.mtype is CON:
@@ -483,14 +765,44 @@ class Coap:
     This class wraps together Message layer and Transaction layer.
     """
 
-    def __init__(self, transport):
+    def __init__(self, transport, response_cache=None, coalesce_requests=False, rate_limiter=None, executor=None,
+                 deduplication_store=None, leisure=DEFAULT_LEISURE, clock=None, admission=None):
         """Initialize a CoAP protocol instance.
 
         Args:
             transport (transport.TransportBase): A transport object that Coap shall use for communicationm.
+            response_cache (piccata.cache.ResponseCache): A cache for responses to GET requests. May be None
+                if every request shall be sent.
+            coalesce_requests (bool): If True, a GET request identical to one still waiting for a response
+                (same remote, Uri-Path, Uri-Query and Accept) is not sent, but gets the response of the earlier one.
+            rate_limiter (piccata.ratelimit.PeerRateLimiter): A limiter of CON and NON messages received from a single
+                peer, applied before the messages are decoded. May be None.
+            executor (concurrent.futures.Executor): An executor (e.g. ThreadPoolExecutor) running request handlers and
+                response callbacks, so a slow handler does not block reception. CON requests not handled within
+                EMPTY_ACK_DELAY are acknowledged with an empty ACK and answered with a separate response. Handlers and
+                callbacks of a single token run one at a time, in order of reception. May be None to run them
+                in the receiving thread.
+            deduplication_store (piccata.dedup.DeduplicationStore): A store of received message IDs shared with other
+                processes serving the same port, so duplicates received by different processes are detected. May be None.
+            leisure (float): A maximum time in seconds a response to a request received on a multicast address is
+                delayed for, so responses of group members are spread in time. See piccata.group.leisure for
+                scaling it with the size of the group.
+            clock (piccata.clock.Clock): A clock used for all timeouts, retransmissions and expiry times. May be None
+                for real time. A piccata.clock.VirtualClock lets simulations run hours of protocol time in seconds.
+            admission (piccata.admission.AdmissionController): An admission controller shedding requests under overload.
+                Requests are admitted on arrival, before waiting for the executor, so the number of requests queued
+                is bounded by its max_pending. Rejected requests are answered with 5.03 Service Unavailable. May be
+                None to handle all requests.
         """
-        self._message_layer = _CoapMessageLayer(transport)
-        self._transaction_layer = _CoapTransactionLayer(self._message_layer)
+        self.response_cache = response_cache
+        self.coalesce_requests = coalesce_requests
+        self._coalesced = {}  # GET requests waiting for a response (identified by cache key)
+        self._coalesced_lock = Lock()
+        self.clock = clock if clock is not None else RealTimeClock()
+        self._message_layer = _CoapMessageLayer(transport, self.clock)
+        self._message_layer.rate_limiter = rate_limiter
+        self._message_layer.deduplication_store = deduplication_store
+        self._transaction_layer = _CoapTransactionLayer(self._message_layer, executor, leisure, admission)
         self._message_layer.register_transaction_layer(self._transaction_layer)
 
     def register_request_handler(self, request_handler):
@@ -499,6 +811,8 @@ class Coap:
         The object shall contain receive_request function of the following format:
             receive_request(request)
         where request is an piccata.message.Message object.
+        The object may also contain receive_reset(message) function, called with RST messages that do not
+        match any CON message sent (e.g. an observer rejecting a NON notification).
         The function shall return a response message of type piccata.message.Message, or None if no response shall be sent.
         This implementation does not automatically ACK confirmable requests. So if response is going to be prepared later,
         but the reuqest shall be acknowledged now, the function shall return an empty ACK message. The postponed response
@@ -517,6 +831,30 @@ class Coap:
         """
         self._transaction_layer.remove_request_handler(request_handler)
 
+    def register_exchange_listener(self, listener):
+        """Register an object that will be informed when a CON exchange finishes.
+
+        The object shall contain exchange_completed function of the following format:
+            exchange_completed(message, result, retransmissions)
+        where:
+            message (piccata.message.Message): A CON message that started the exchange.
+            result (int): RESULT_SUCCESS if ACKed, RESULT_RESET if RSTed, RESULT_TIMEOUT if retransmissions
+                were exhausted or RESULT_CANCELLED if the exchange was cancelled locally.
+            retransmissions (int): A number of times the message was retransmitted.
+
+        Args:
+            listener (object): An object that will be informed about exchanges.
+        """
+        self._message_layer.register_exchange_listener(listener)
+
+    def remove_exchange_listener(self, listener):
+        """Unregister an exchange listener.
+
+        Args:
+            listener (object): An object that was previously registered.
+        """
+        self._message_layer.remove_exchange_listener(listener)
+
     def receive(self, data, remote, local):
         """A function for receiving messages. Will be called by transport.
 
@@ -555,10 +893,210 @@ class Coap:
             response_callback_args (tuple): An optional arguments for the callback function. May be None.
             response_callback_kw (dictionary): An optional keyword arguments for the callback function. May be None.
         """
-        request.remote = Endpoint(ip_address(request.remote[0]), request.remote[1])
+        request.remote = _endpoint(request.remote)
+        if response_callback is not None and is_cacheable(request):
+            callback = (response_callback, response_callback_args, response_callback_kw)
+            if self.response_cache is not None:
+                return self._cached_request(request, callback)
+            if self.coalesce_requests:
+                return self._coalesced_request(request, callback)
         return self._transaction_layer.send_request(request, response_callback, response_callback_args, response_callback_kw)
         # return Requester(self._transaction_layer, request, response_callback, response_callback_args, response_callback_kw)
 
+    def _cached_request(self, request, callback):
+        """Serve a GET request from the response cache, or send it with ETag of a stale response to revalidate it.
+
+        Args:
+            request (piccata.message.Message): A GET request.
+            callback (tuple): An application callback with its arguments and keyword arguments.
+        """
+        key = cache_key(request)
+        response, fresh = self.response_cache.lookup(key, self.clock.now())
+        if fresh:
+            logging.info("Response served from cache")
+            self._transaction_layer._handle_app_callback(callback, RESULT_SUCCESS, request, response)
+            return
+
+        revalidating = response is not None
+        added_etag = None
+        if revalidating and response.opt.etag not in request.opt.etags:
+            added_etag = response.opt.etag
+            request.opt.etags = request.opt.etags + [added_etag]
+        self._send_cacheable(request, (self._cache_response, (key, callback, revalidating, added_etag), None))
+
+    def _send_cacheable(self, request, callback):
+        """Send a cacheable request, coalescing it with an identical pending one if enabled."""
+        if self.coalesce_requests:
+            self._coalesced_request(request, callback)
+        else:
+            self._transaction_layer.send_request(request, *callback)
+
+    def _cache_response(self, result, request, response, key, callback, revalidating, added_etag):
+        """Store a response in the cache and pass it to the application. A 2.03 Valid response is replaced with the cached one.
+
+        If the stale response was evicted while being revalidated, a 2.03 Valid response to the ETag added by the cache
+        carries no representation for the application, so the request is sent again without that ETag.
+        """
+        if result is RESULT_SUCCESS:
+            if revalidating:
+                cached = self.response_cache.revalidated(key, response, self.clock.now())
+                if cached is not None:
+                    response = cached
+                elif response.code is VALID and added_etag is not None:
+                    logging.info("Revalidated response no longer cached, fetching it again")
+                    request.opt.etags = [etag for etag in request.opt.etags if etag != added_etag]
+                    request.mid = None
+                    self._send_cacheable(request, (self._cache_response, (key, callback, False, None), None))
+                    return
+            else:
+                self.response_cache.store(key, response, self.clock.now())
+        self._transaction_layer._handle_app_callback(callback, result, request, response)
+
+    def _coalesced_request(self, request, callback):
+        """Send a GET request, unless an identical one is waiting for a response already.
+
+        Args:
+            request (piccata.message.Message): A GET request.
+            callback (tuple): An application callback with its arguments and keyword arguments.
+        """
+        key = coalescing_key(request)
+        with self._coalesced_lock:
+            pending = self._coalesced.get(key)
+            if pending is not None:
+                logging.info("Request coalesced with a pending one, token: %s" % pending[0].token.hex())
+                pending[1].append((request, callback))
+                return
+            self._coalesced[key] = (request, [(request, callback)])
+        try:
+            self._transaction_layer.send_request(request, self._coalesced_response, (key, ), None)
+        except:
+            with self._coalesced_lock:
+                del self._coalesced[key]
+            raise
+
+    def _coalesced_response(self, result, request, response, key):
+        """Pass the result of a coalesced request to all requests waiting for it."""
+        with self._coalesced_lock:
+            _, waiting = self._coalesced.pop(key)
+        for waiting_request, callback in waiting:
+            self._transaction_layer._handle_app_callback(callback, result, waiting_request, response)
+
+    def _cancel_coalesced(self, request):
+        """Withdraw a request from a coalesced exchange, keeping the exchange if others still wait for it.
+
+        Args:
+            request (piccata.message.Message): A request to cancel.
+
+        Returns:
+            piccata.message.Message: A request which transaction shall be cancelled, or None if the request was withdrawn.
+        """
+        with self._coalesced_lock:
+            pending = self._coalesced.get(coalescing_key(request))
+            if pending is None:
+                return request
+            sent, waiting = pending
+            for i, (waiting_request, callback) in enumerate(waiting):
+                if waiting_request is request:
+                    break
+            else:
+                return request
+            if len(waiting) == 1:
+                return sent
+            del waiting[i]
+        self._transaction_layer._handle_app_callback(callback, RESULT_CANCELLED, request, None)
+        return None
+
+    def group_request(self, request, response_callback, window=None, max_responses=None,
+                      response_callback_args=None, response_callback_kw=None):
+        """Send a multicast request and collect responses of group members within a time window.
+
+        A random token is generated if the request has none. The callback is called once, when the window
+        ends or max_responses responders answered, in the following format:
+            response_callback(result, request, responses, *response_callback_args, **response_callback_kw)
+        where:
+            result (int): RESULT_SUCCESS if any responses were received, RESULT_TIMEOUT if none,
+                or RESULT_CANCELLED if the request was cancelled with cancel_request before completion.
+            request (piccata.message.Message): The request sent.
+            responses (collections.OrderedDict): The first response of every responder, by responder address.
+
+        Args:
+            request (piccata.message.Message): A NON request with a multicast remote address.
+            response_callback (function): A callback function called with the aggregated responses.
+            window (float): A time in seconds responses are collected for. May be None to use the request timeout.
+            max_responses (int): A number of responders after which the request completes early. May be None.
+            response_callback_args (tuple): An optional arguments for the callback function. May be None.
+            response_callback_kw (dictionary): An optional keyword arguments for the callback function. May be None.
+
+        Returns:
+            piccata.group.GroupExchange: The exchange collecting the responses.
+        """
+        request.remote = _endpoint(request.remote)
+        if not request.remote.addr.is_multicast:
+            raise ValueError("Group requests shall be sent to a multicast address")
+        if request.mtype is not NON:
+            raise ValueError("Multicast requests shall be non-confirmable")
+        assert callable(response_callback)
+
+        if not request.token:
+            request.token = random_token()
+        if window is not None:
+            request.timeout = window
+        exchange = GroupExchange(request, (response_callback, response_callback_args, response_callback_kw),
+                                 max_responses)
+        self._transaction_layer.send_request(request, self._group_response, (exchange, ), None)
+        return exchange
+
+    def _group_response(self, result, request, response, exchange):
+        if result is RESULT_SUCCESS:
+            if exchange.add(response):
+                # All expected responders answered, there is no need to wait for the end of the window.
+                self._transaction_layer.cancel_transaction(request)
+            return
+
+        result = exchange.finish(result)
+        if result is not None:
+            logging.info("Group request finished with %d responses" % len(exchange))
+            cb, args, kw = exchange.callback
+            cb(result, request, exchange.responses, *(args or ()), **(kw or {}))
+
+    def observe(self, request, notification_callback, notification_callback_args = None, notification_callback_kw = None):
+        """Start observing a remote resource (RFC 7641).
+
+        The Observe option is set in the request and a random token is generated if the request has none.
+        The callback has the same format as the one of the request function. It is called with
+        RESULT_SUCCESS for every fresh notification; reordered notifications are dropped. If a response
+        without Observe option or an error response is received, the observation ends after the callback.
+        If no notification is received within Max-Age, the callback is called with RESULT_TIMEOUT and
+        the registration is renewed with the same token. RESULT_RESET ends the observation.
+
+        Args:
+            request (piccata.message.Message): A GET request for the observed resource.
+            notification_callback (function): A callback function called upon notification reception.
+            notification_callback_args (tuple): An optional arguments for the callback function. May be None.
+            notification_callback_kw (dictionary): An optional keyword arguments for the callback function. May be None.
+
+        Returns:
+            piccata.observe.Subscription: A subscription that can be passed to cancel_observation.
+        """
+        if request.code is not GET:
+            raise ValueError("Only GET requests can be observed")
+        assert callable(notification_callback)
+        request.remote = _endpoint(request.remote)
+        callback = (notification_callback, notification_callback_args, notification_callback_kw)
+        return self._transaction_layer.subscriptions.add(request, callback)
+
+    def cancel_observation(self, subscription, deregister=True):
+        """Stop observing a remote resource.
+
+        The notification callback will not be called anymore.
+
+        Args:
+            subscription (piccata.observe.Subscription): A subscription returned by the observe function.
+            deregister (bool): If True, the server is informed with a GET request with Observe option set to 1.
+                Otherwise further notifications are rejected with RST.
+        """
+        self._transaction_layer.subscriptions.cancel(subscription, deregister)
+
     def cancel_request(self, request):
         """Cancel a pending request from the application.
 
@@ -567,6 +1105,10 @@ class Coap:
         Args:
             request (piccata.message.Message): A request to cancel.
         """
+        if self.coalesce_requests:
+            request = self._cancel_coalesced(request)
+            if request is None:
+                return
         self._transaction_layer.cancel_transaction(request)
 
     def respond(self, request, response):
@@ -581,6 +1123,6 @@ class Coap:
             request (piccata.message.Message): A request that the response refers to.
             response (piccata.message.Message): A response message.
         """
-        request.remote = Endpoint(ip_address(request.remote[0]), request.remote[1])
-        response.remote = Endpoint(ip_address(response.remote[0]), response.remote[1])
+        request.remote = _endpoint(request.remote)
+        response.remote = _endpoint(response.remote)
         self._transaction_layer.send_response(request, response)
@@ -0,0 +1,171 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Message deduplication stores shared between processes.
+"""
+import multiprocessing
+import struct
+import time
+import zlib
+
+from multiprocessing import shared_memory
+
+_SLOT = struct.Struct('<IHH16sd')
+"""Slot layout: sequence number, message ID, port, IPv6 (or IPv4-mapped) address, expiry time."""
+
+_MAX_PROBES = 32
+"""A maximum number of slots checked for a single key."""
+
+
+class DeduplicationStore(object):
+    """Interface of a secondary deduplication store used by the message layer.
+
+    The message layer keeps its own store of recently received messages, used to resend responses
+    to duplicates. A secondary store only tells whether a message was seen before, possibly by
+    another process, so duplicates handled elsewhere are not processed again.
+    """
+
+    def add(self, mid, remote, lifetime, now=None):
+        """Remember a message unless it was seen already.
+
+        Args:
+            mid (int): A message ID.
+            remote (piccata.types.Endpoint): An address of the message originator.
+            lifetime (float): A time in seconds the message shall be remembered for.
+            now (float): A current time in seconds, from the clock of the protocol instance.
+
+        Returns:
+            bool: True if the message is new, False if it is a duplicate.
+        """
+        raise NotImplementedError
+
+
+def _packed_address(remote):
+    address = remote[0]
+    if address.version == 4:
+        return b'\x00' * 10 + b'\xff\xff' + address.packed
+    return address.packed
+
+
+class SharedDeduplicationStore(DeduplicationStore):
+    """Fixed-size open addressing hash table of (mid, remote) keys in shared memory.
+
+    Readers do not lock: every slot carries a sequence number which is odd while the slot is
+    being written, so a reader retries if it sees an odd or changed sequence number (seqlock).
+    Writers are serialized with a single process-shared lock held for the duration of one insert.
+    The table is created before worker processes are forked, and inherited by them. Expiry times
+    use the clock of the protocol instance, time.monotonic by default, which is shared by all
+    processes of a host on Linux. Processes sharing a table shall use the same clock.
+    """
+
+    def __init__(self, slots=65536, name=None, create=True, lock=None):
+        """Initialize.
+
+        Args:
+            slots (int): A number of slots in the table. Shall be a power of two.
+            name (str): A name of the shared memory block. May be None for a random name when creating.
+            create (bool): If True, a new table is created, otherwise an existing one is attached.
+            lock (multiprocessing.Lock): A lock serializing writers. Required when attaching to an existing
+                table from an unrelated process, shall be the lock used by other writers.
+        """
+        if slots < 1 or slots & (slots - 1):
+            raise ValueError("Number of slots shall be a power of two")
+
+        self.slots = slots
+        self._mask = slots - 1
+        self._memory = shared_memory.SharedMemory(name=name, create=create, size=slots * _SLOT.size)
+        self._buffer = self._memory.buf
+        self._lock = lock if lock is not None else multiprocessing.Lock()
+
+    @property
+    def name(self):
+        """Name of the shared memory block, used to attach to the table."""
+        return self._memory.name
+
+    def close(self):
+        """Detach from the shared memory block."""
+        self._buffer = None
+        self._memory.close()
+
+    def unlink(self):
+        """Destroy the shared memory block. Shall be called once, by the process that created the table."""
+        self._memory.unlink()
+
+    def _read(self, index):
+        """Read a consistent copy of a slot without locking."""
+        offset = index * _SLOT.size
+        while True:
+            slot = _SLOT.unpack_from(self._buffer, offset)
+            if slot[0] & 1 == 0 and struct.unpack_from('<I', self._buffer, offset)[0] == slot[0]:
+                return slot
+
+    def _write(self, index, sequence, mid, port, address, expires):
+        offset = index * _SLOT.size
+        struct.pack_into('<I', self._buffer, offset, sequence + 1)
+        _SLOT.pack_into(self._buffer, offset, sequence + 1, mid, port, address, expires)
+        struct.pack_into('<I', self._buffer, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def _find(self, home, mid, port, address, now):
+        """Find a slot of a key.
+
+        Returns:
+            tuple: A (found, index) tuple, where index is the slot of the key if found, or the best slot for it otherwise.
+        """
+        free = None
+        oldest = None
+        for probe in range(_MAX_PROBES):
+            index = (home + probe) & self._mask
+            _, slot_mid, slot_port, slot_address, expires = self._read(index)
+            if expires == 0:
+                return False, index if free is None else free
+            if expires <= now:
+                if free is None:
+                    free = index
+            elif slot_mid == mid and slot_port == port and slot_address == address:
+                return True, index
+            if oldest is None or expires < oldest[1]:
+                oldest = (index, expires)
+        return False, free if free is not None else oldest[0]
+
+    def contains(self, mid, remote, now=None):
+        """Check if a message was seen, without locking.
+
+        Args:
+            mid (int): A message ID.
+            remote (piccata.types.Endpoint): An address of the message originator.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            bool: True if the message is remembered.
+        """
+        now = time.monotonic() if now is None else now
+        address = _packed_address(remote)
+        home = zlib.crc32(address, (mid << 16) | remote[1]) & self._mask
+        return self._find(home, mid, remote[1], address, now)[0]
+
+    def add(self, mid, remote, lifetime, now=None):
+        """Remember a message unless it was seen already.
+
+        Args:
+            mid (int): A message ID.
+            remote (piccata.types.Endpoint): An address of the message originator.
+            lifetime (float): A time in seconds the message shall be remembered for.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            bool: True if the message is new, False if it is a duplicate.
+        """
+        now = time.monotonic() if now is None else now
+        address = _packed_address(remote)
+        port = remote[1]
+        home = zlib.crc32(address, (mid << 16) | port) & self._mask
+
+        if self._find(home, mid, port, address, now)[0]:
+            return False
+        with self._lock:
+            found, index = self._find(home, mid, port, address, now)
+            if found:
+                return False
+            sequence = struct.unpack_from('<I', self._buffer, index * _SLOT.size)[0]
+            self._write(index, sequence, mid, port, address, now + lifetime)
+        return True
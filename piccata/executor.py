@@ -0,0 +1,60 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Execution of request handlers and response callbacks outside of the receiving thread.
+"""
+import collections
+import logging
+import threading
+
+
+class SerialExecutor(object):
+    """Runs functions in an executor, one at a time and in order of submission for every key.
+
+    Functions submitted with different keys may run in parallel. Used to keep callbacks of a single
+    token (e.g. notifications of an observation, or blocks of a transfer) in order.
+    """
+
+    def __init__(self, executor):
+        """Initialize.
+
+        Args:
+            executor (concurrent.futures.Executor): An executor running the functions. As the queue of every key is
+                drained by a single task, the executor shall run tasks in the same process (e.g. ThreadPoolExecutor).
+        """
+        self.executor = executor
+
+        self._lock = threading.Lock()
+        self._queues = {}  # functions waiting to run (identified by key)
+
+    def __len__(self):
+        return len(self._queues)
+
+    def submit(self, key, fn, *args):
+        """Schedule a function call.
+
+        Args:
+            key (object): A hashable key. Calls with equal keys run in order of submission.
+            fn (function): A function to call.
+            args (tuple): Arguments of the function.
+        """
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[key] = collections.deque([(fn, args)])
+        self.executor.submit(self._run, key)
+
+    def _run(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception("Exception in executed function")
@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Group communication (RFC 7390): aggregation of responses to multicast requests.
+"""
+import collections
+import threading
+
+from piccata.constants import *
+
+
+def leisure(group_size, response_size, data_rate):
+    """Estimate the leisure period of a group (RFC 7252, section 8.2).
+
+    Responses of all group members, spread evenly over the leisure period, shall not exceed
+    the data rate targeted on the link.
+
+    Args:
+        group_size (int): An estimated number of group members.
+        response_size (int): An estimated size of a response in bytes.
+        data_rate (float): A target data rate of responses in bytes per second.
+
+    Returns:
+        float: A leisure period in seconds, to be passed to piccata.core.Coap.
+    """
+    if data_rate <= 0:
+        raise ValueError("Data rate shall be positive")
+    return float(response_size) * group_size / data_rate
+
+
+class GroupExchange(object):
+    """Responses to a single multicast request, collected within a time window.
+
+    Every responder (identified by its address) is counted once: retransmitted or repeated
+    responses of a responder are ignored, only the first one is kept.
+    """
+
+    def __init__(self, request, callback, max_responses=None):
+        """Initialize.
+
+        Args:
+            request (piccata.message.Message): A multicast request sent.
+            callback (tuple): A (function, args, kw) tuple of the application callback.
+            max_responses (int): A number of responders after which the exchange completes without waiting
+                for the end of the window. May be None to always wait.
+        """
+        self.request = request
+        self.callback = callback
+        self.max_responses = max_responses
+        self.responses = collections.OrderedDict()  # first response of every responder (identified by remote)
+        self.duplicates = 0
+        self.complete = False
+        self.done = False
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def add(self, response):
+        """Add a response to the exchange.
+
+        Args:
+            response (piccata.message.Message): A response received.
+
+        Returns:
+            bool: True if the exchange became complete with this response.
+        """
+        with self._lock:
+            if self.done or self.complete:
+                return False
+            if response.remote in self.responses:
+                self.duplicates += 1
+                return False
+            self.responses[response.remote] = response
+            if self.max_responses is not None and len(self.responses) >= self.max_responses:
+                self.complete = True
+                return True
+            return False
+
+    def finish(self, result):
+        """Mark the exchange finished and get the result reported to the application.
+
+        Args:
+            result (int): A result code the transaction was finished with.
+
+        Returns:
+            int: A result code for the application, or None if the exchange was already finished.
+        """
+        with self._lock:
+            if self.done:
+                return None
+            self.done = True
+            if self.complete or (result is RESULT_TIMEOUT and self.responses):
+                return RESULT_SUCCESS
+            return result
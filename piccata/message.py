@@ -27,8 +27,11 @@ class Message(object):
         self.payload = payload
 
         self.remote = None
+        self.local = None  # local address a received message was sent to, or a sent message shall be sent from
         self.timeout = MAX_TRANSMIT_WAIT
 
+        self._encoded_body = None
+
     @classmethod
     def decode(cls, rawdata, remote=None):
         """Create Message object from binary representation of message."""
@@ -51,12 +54,29 @@ class Message(object):
         rawdata = bytes([(self.version << 6) + ((self.mtype & 0x03) << 4) + (len(self.token) & 0x0F)])
         rawdata += struct.pack('!BH', self.code, self.mid)
         rawdata += self.token
-        rawdata += self.opt.encode()
+        body = self._encoded_body
+        if body is None:
+            body = self.encode_body()
+        rawdata += body
+        return rawdata
+
+    def encode_body(self):
+        """Create binary representation of message options and payload."""
+        rawdata = self.opt.encode()
         if len(self.payload) > 0:
             rawdata += bytes([0xFF])
             rawdata += self.payload
         return rawdata
 
+    def freeze_body(self):
+        """Encode options and payload once and reuse them in every subsequent encode call.
+
+        Used when the same representation is sent in many messages that differ only in the header
+        and token (e.g. notifications sent to multiple observers). Changes made to options or payload
+        after this call are not reflected in the encoded message.
+        """
+        self._encoded_body = self.encode_body()
+
     def is_request(self):
         return (self.code >= 1 and self.code < 32)
 
@@ -70,6 +90,7 @@ class Message(object):
     def _empty_message(cls, request, mtype):
         response = cls(mtype=mtype, mid=request.mid, code=EMPTY)
         response.remote = request.remote
+        response.local = request.local
         return response
 
     @classmethod
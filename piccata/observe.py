@@ -0,0 +1,475 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Resource observation (RFC 7641).
+"""
+import collections
+import copy
+import heapq
+import itertools
+import logging
+import threading
+
+from piccata.constants import *
+from piccata.message import random_token
+from piccata.ratelimit import TokenBucket
+
+OBSERVE_SEQUENCE_MASK = 0xFFFFFF
+"""Observe option values are 24-bit sequence numbers."""
+
+OBSERVE_FRESHNESS_TIMEOUT = 128
+"""Time in seconds after which a notification is newer than the previous one regardless of the sequence number."""
+
+
+class Observation(object):
+    """A registration of a single observer (identified by remote and token) on a resource."""
+
+    __slots__ = ('resource', 'request', 'remote', 'token', 'last_mid', 'in_flight', 'pending', 'queued')
+
+    def __init__(self, resource, request):
+        """Initialize an observation.
+
+        Args:
+            resource (piccata.resource.CoapResource): An observed resource.
+            request (piccata.message.Message): A GET request that registered the observer.
+        """
+        self.resource = resource
+        self.request = request
+        self.remote = request.remote
+        self.token = request.token
+        self.last_mid = None  # message ID of the last notification sent
+        self.in_flight = False  # True while a CON notification waits for ACK
+        self.pending = None  # the latest notification not sent yet
+        self.queued = False  # True while waiting in the rate limit queue
+
+    @property
+    def key(self):
+        return (self.remote, self.token)
+
+
+class Notifier(object):
+    """Sends notifications to observers of resources.
+
+    A notification is rendered and encoded once per distinct representation, every observer
+    gets a shallow copy stamped with its own token and message ID. Notifications are sent at
+    a bounded rate, those exceeding the rate are queued and sent by a timer.
+
+    Every observer has at most one notification in flight (a CON notification waiting for ACK)
+    and one pending. A newer state replaces the pending notification instead of queueing behind
+    it, as RFC 7641 allows, so slow observers only ever receive the latest state and do not
+    hold back the others.
+
+    Observers rejecting a notification with RST, or not acknowledging a CON notification,
+    are removed.
+    """
+
+    def __init__(self, protocol, mtype=NON, rate=1000, burst=100):
+        """Initialize a notifier.
+
+        Args:
+            protocol (piccata.core.Coap): A protocol used to send notifications.
+            mtype (int): A type of notifications (CON or NON).
+            rate (float): A maximum number of notifications sent per second. May be None for no limit.
+            burst (int): A number of notifications that may be sent at once before the rate applies.
+        """
+        if mtype not in (CON, NON):
+            raise ValueError("Notifications should be of type CON or NON")
+
+        self._protocol = protocol
+        self._clock = protocol.clock
+        self.mtype = mtype
+        self._bucket = TokenBucket(rate, burst, self._clock.now()) if rate is not None else None
+
+        self._lock = threading.RLock()
+        self._queue = collections.deque()  # observations with a pending notification waiting for the rate limit
+        self._timer = None
+        self._sent = {}  # observations that were sent the last notification (identified by message ID and remote)
+
+        protocol.register_exchange_listener(self)
+
+    def register(self, resource, request, response):
+        """Register an observer, if the response to the registering request allows it.
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource the request was addressed to.
+            request (piccata.message.Message): A GET request with Observe option.
+            response (piccata.message.Message): A response to the request. May be None.
+        """
+        key = (request.remote, request.token)
+        if (request.opt.observe == 0 and resource.observable and
+                response is not None and response.is_successfull()):
+            resource.observers[key] = Observation(resource, request)
+            response.opt.observe = resource.observe_index
+            logging.info("Observer registered, token: %s" % request.token.hex())
+        else:
+            self.deregister(resource.observers.pop(key, None))
+
+    def deregister(self, observation):
+        """Remove an observer.
+
+        Args:
+            observation (piccata.observe.Observation): An observation to remove. May be None.
+        """
+        if observation is None:
+            return
+        with self._lock:
+            observation.resource.observers.pop(observation.key, None)
+            if observation.last_mid is not None:
+                self._sent.pop((observation.last_mid, observation.remote), None)
+            observation.pending = None
+        logging.info("Observer removed, token: %s" % observation.token.hex())
+
+    def notify(self, resource):
+        """Send the current representation of a resource to all its observers.
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource that has changed.
+        """
+        observers = list(resource.observers.values())
+        if not observers:
+            return
+
+        resource.observe_index = (resource.observe_index + 1) & OBSERVE_SEQUENCE_MASK
+
+        # Observers asking for the same content format share a single rendered notification.
+        notifications = {}
+        for observation in observers:
+            accept = observation.request.opt.accept
+            notification = notifications.get(accept)
+            if notification is None:
+                notification = resource.render(observation.request)
+                if notification is not None:
+                    if notification.is_successfull():
+                        notification.opt.observe = resource.observe_index
+                    notification.freeze_body()
+                notifications[accept] = notification
+            if notification is None:
+                continue
+            if not notification.is_successfull():
+                # An error response terminates the observation.
+                self.deregister(observation)
+                self._send(observation, notification)
+                continue
+            self._submit(observation, notification)
+
+    def _submit(self, observation, notification):
+        """Make a notification the latest one for an observer and send it, if the observer is ready for it."""
+        with self._lock:
+            observation.pending = notification
+            if observation.in_flight or observation.queued:
+                # Replaces the notification waiting for ACK of the previous one or for the rate limit.
+                return
+            if self._queue or (self._bucket is not None and not self._bucket.consume(now=self._clock.now())):
+                observation.queued = True
+                self._queue.append(observation)
+                self._schedule()
+                return
+            observation.pending = None
+            self._mark_in_flight(observation)
+        self._send(observation, notification)
+
+    def _mark_in_flight(self, observation):
+        if self.mtype == CON:
+            observation.in_flight = True
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = self._clock.call_later(self._bucket.delay(now=self._clock.now()), self._drain)
+
+    def _drain(self):
+        """Send pending notifications allowed by the rate limit."""
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._timer = None
+                    return
+                observation = self._queue[0]
+                notification = observation.pending
+                if notification is not None and not observation.in_flight:
+                    if not self._bucket.consume(now=self._clock.now()):
+                        self._timer = None
+                        self._schedule()
+                        return
+                    observation.pending = None
+                    self._mark_in_flight(observation)
+                else:
+                    # Removed observer, or the notification will follow the ACK of the one in flight.
+                    notification = None
+                self._queue.popleft()
+                observation.queued = False
+            if notification is not None:
+                self._send(observation, notification)
+
+    def _send(self, observation, notification):
+        """Stamp a shared notification with observer specific header fields and send it."""
+        msg = copy.copy(notification)
+        msg.mtype = self.mtype
+        msg.mid = None
+        msg.remote = observation.remote
+
+        # Holding the lock makes sure an ACK is not processed before the notification is recorded.
+        with self._lock:
+            self._protocol.respond(observation.request, msg)
+            if observation.last_mid is not None:
+                self._sent.pop((observation.last_mid, observation.remote), None)
+            observation.last_mid = msg.mid
+            if observation.key in observation.resource.observers:
+                self._sent[(msg.mid, observation.remote)] = observation
+
+    def exchange_completed(self, message, result, retransmissions):
+        """Send the pending notification once a CON notification is acknowledged. Called by the CoAP message layer.
+
+        Observers that have not acknowledged a CON notification are removed.
+        """
+        with self._lock:
+            observation = self._sent.pop((message.mid, message.remote), None)
+            if observation is None:
+                return
+            observation.in_flight = False
+            pending = observation.pending
+        if result in (RESULT_RESET, RESULT_TIMEOUT):
+            self.deregister(observation)
+        elif pending is not None:
+            self._submit(observation, pending)
+
+    def receive_reset(self, message):
+        """Remove an observer that has rejected a NON notification with RST.
+
+        Args:
+            message (piccata.message.Message): A received RST message.
+        """
+        with self._lock:
+            observation = self._sent.pop((message.mid, message.remote), None)
+        self.deregister(observation)
+
+
+def is_fresh(last_sequence, last_time, sequence, now):
+    """Check if a notification is newer than the last one received (RFC 7641, section 3.4).
+
+    Args:
+        last_sequence (int): Observe option value of the last notification. May be None if there was none.
+        last_time (float): Reception time of the last notification in seconds.
+        sequence (int): Observe option value of the received notification.
+        now (float): Reception time of the received notification in seconds.
+
+    Returns:
+        bool: True if the notification is newer, False if it shall be dropped.
+    """
+    if last_sequence is None:
+        return True
+    return ((last_sequence < sequence and sequence - last_sequence < 2 ** 23) or
+            (last_sequence > sequence and last_sequence - sequence > 2 ** 23) or
+            now > last_time + OBSERVE_FRESHNESS_TIMEOUT)
+
+
+class Subscription(object):
+    """An observation of a remote resource, kept open across notifications.
+
+    Notifications are matched by token. Reordered notifications are dropped and the
+    registration is renewed when no notification arrives within Max-Age.
+    """
+
+    __slots__ = ('request', 'remote', 'token', 'callback', 'last_sequence', 'last_time', 'deadline', 'scheduled',
+                 'active')
+
+    def __init__(self, request, callback):
+        self.request = request
+        self.remote = request.remote
+        self.token = request.token
+        self.callback = callback
+        self.last_sequence = None
+        self.last_time = None
+        self.deadline = None  # time after which the registration is renewed
+        self.scheduled = None  # deadline of the latest entry on the heap
+        self.active = True
+
+
+class Subscriptions(object):
+    """Client side observations of a CoAP protocol instance, indexed by token.
+
+    Freshness of all subscriptions is supervised by a single timer, so receiving
+    a notification costs a dictionary lookup and a few attribute updates.
+    """
+
+    def __init__(self, transaction_layer, jitter=0.1):
+        """Initialize.
+
+        Args:
+            transaction_layer (piccata.core._CoapTransactionLayer): A transaction layer used to send requests.
+            jitter (float): Re-registrations are delayed by a random part of Max-Age up to this fraction,
+                so observations established together are not renewed together.
+        """
+        self._transaction_layer = transaction_layer
+        self._clock = transaction_layer.clock
+        self.jitter = jitter
+
+        self._lock = threading.RLock()
+        self._subscriptions = {}  # active subscriptions (identified by token)
+        self._deadlines = []  # heap of (deadline, counter, subscription), an entry may be older than subscription.deadline
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def _handle_app_callback(self, subscription, result, response):
+        self._transaction_layer._handle_app_callback(subscription.callback, result, subscription.request, response)
+
+    def _refresh(self, subscription, max_age, now):
+        """Set the time of re-registration."""
+        subscription.deadline = now + max_age * (1 + self._clock.random.uniform(0, self.jitter))
+
+    def _push(self, subscription):
+        """Put the subscription deadline on the heap, unless an earlier entry is there already."""
+        if subscription.scheduled is not None and subscription.scheduled <= subscription.deadline:
+            return
+        subscription.scheduled = subscription.deadline
+        heapq.heappush(self._deadlines, (subscription.deadline, next(self._counter), subscription))
+        self._schedule()
+
+    def _register(self, subscription):
+        """Send a registration request (also used for re-registration)."""
+        request = copy.deepcopy(subscription.request)
+        request.mid = None
+        request.opt.observe = 0
+        self._transaction_layer.send_request(request, None, None, None)
+
+    def _schedule(self):
+        """Arm the timer for the earliest deadline."""
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self._clock.call_later(max(0.0, deadline - self._clock.now()), self._expire)
+
+    def _expire(self):
+        """Renew subscriptions that have not received a notification in time."""
+        now = self._clock.now()
+        expired = []
+        with self._lock:
+            self._timer = None
+            while self._deadlines and self._deadlines[0][0] <= now:
+                scheduled, _, subscription = heapq.heappop(self._deadlines)
+                if not subscription.active or scheduled != subscription.scheduled:
+                    continue
+                subscription.scheduled = None
+                if subscription.deadline > now:
+                    # Refreshed by a notification in the meantime.
+                    self._push(subscription)
+                    continue
+                expired.append(subscription)
+                self._refresh(subscription, subscription.request.timeout, now)
+                self._push(subscription)
+            self._schedule()
+
+        for subscription in expired:
+            logging.info("Observation not fresh, re-registering, token: %s" % subscription.token.hex())
+            self._handle_app_callback(subscription, RESULT_TIMEOUT, None)
+            if subscription.active:
+                self._register(subscription)
+
+    def add(self, request, callback):
+        """Register an observation.
+
+        Args:
+            request (piccata.message.Message): A GET request for the observed resource.
+            callback (tuple): A callback with its arguments and keyword arguments.
+
+        Returns:
+            piccata.observe.Subscription: A subscription created.
+        """
+        if not request.token:
+            request.token = random_token()
+        request.opt.observe = 0
+        subscription = Subscription(request, callback)
+
+        with self._lock:
+            if request.token in self._subscriptions:
+                raise ValueError("Token is already used by another observation")
+            self._subscriptions[request.token] = subscription
+            self._refresh(subscription, request.timeout, self._clock.now())
+            self._push(subscription)
+
+        self._transaction_layer.send_request(request, None, None, None)
+        return subscription
+
+    def cancel(self, subscription, deregister=True):
+        """Cancel an observation.
+
+        Args:
+            subscription (piccata.observe.Subscription): A subscription to cancel.
+            deregister (bool): If True, a GET request with Observe option set to 1 is sent, so the server
+                stops sending notifications. Otherwise the next notification will be rejected with RST.
+        """
+        with self._lock:
+            if self._subscriptions.get(subscription.token) is not subscription:
+                return
+            del self._subscriptions[subscription.token]
+            subscription.active = False
+
+        if deregister:
+            request = copy.deepcopy(subscription.request)
+            request.mid = None
+            request.opt.observe = 1
+            # Response to deregistration is not reported, the callback prevents it from being rejected.
+            self._transaction_layer.send_request(request, lambda result, request, response: None, None, None)
+
+    def _terminate(self, subscription, result, response):
+        with self._lock:
+            if self._subscriptions.get(subscription.token) is subscription:
+                del self._subscriptions[subscription.token]
+            subscription.active = False
+        self._handle_app_callback(subscription, result, response)
+
+    def receive(self, response):
+        """Deliver a response to a matching subscription.
+
+        Args:
+            response (piccata.message.Message): A response received.
+
+        Returns:
+            bool: True if the response belongs to a subscription, False otherwise.
+        """
+        subscription = self._subscriptions.get(response.token)
+        if subscription is None or subscription.remote != response.remote:
+            return False
+
+        sequence = response.opt.observe
+        if sequence is None or not response.is_successfull():
+            # The server has not established or has ended the observation.
+            self._terminate(subscription, RESULT_SUCCESS, response)
+            return True
+
+        now = self._clock.now()
+        if not is_fresh(subscription.last_sequence, subscription.last_time, sequence, now):
+            logging.info("Reordered notification dropped, token: %s" % response.token.hex())
+            return True
+
+        max_age = response.opt.max_age
+        with self._lock:
+            subscription.last_sequence = sequence
+            subscription.last_time = now
+            self._refresh(subscription, DEFAULT_MAX_AGE if max_age is None else max_age, now)
+            self._push(subscription)
+        self._handle_app_callback(subscription, RESULT_SUCCESS, response)
+        return True
+
+    def reset(self, request):
+        """End a subscription which registration request was rejected with RST.
+
+        Args:
+            request (piccata.message.Message): A request rejected.
+
+        Returns:
+            bool: True if the request belongs to a subscription, False otherwise.
+        """
+        subscription = self._subscriptions.get(request.token)
+        if subscription is None or subscription.remote != request.remote:
+            return False
+        self._terminate(subscription, RESULT_RESET, None)
+        return True
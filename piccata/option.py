@@ -89,6 +89,13 @@ class Options(object):
 
     uri_path = property(_get_uri_path, _set_uri_path)
 
+    def get_uri_path_tuple(self):
+        """Get Uri-Path segments as a tuple, suitable for use as a dictionary key."""
+        uri_path = self._options.get(URI_PATH)
+        if uri_path is None:
+            return ()
+        return tuple([segment.value for segment in uri_path])
+
     def _set_uri_query(self, segments):
         """Convenience setter: Uri-Query option"""
         if isinstance(segments, (str, bytes)):
@@ -194,6 +201,20 @@ class Options(object):
 
     observe = property(_get_observe, _set_observe)
 
+    def _set_max_age(self, max_age):
+        self.delete_option(number=MAX_AGE)
+        if max_age is not None:
+            self.add_option(UintOption(number=MAX_AGE, value=max_age))
+
+    def _get_max_age(self):
+        max_age = self.get_option(number=MAX_AGE)
+        if max_age is not None:
+            return max_age[0].value
+        else:
+            return None
+
+    max_age = property(_get_max_age, _set_max_age)
+
     def _set_accept(self, accept):
         self.delete_option(number=ACCEPT)
         if accept is not None:
@@ -227,6 +248,62 @@ class Options(object):
 
     location_path = property(_get_location_path, _set_location_path)
 
+    def _set_uri_host(self, host):
+        self.delete_option(number=URI_HOST)
+        if host is not None:
+            self.add_option(StringOption(number=URI_HOST, value=host))
+
+    def _get_uri_host(self):
+        host = self.get_option(number=URI_HOST)
+        if host is not None:
+            return host[0].value
+        else:
+            return None
+
+    uri_host = property(_get_uri_host, _set_uri_host)
+
+    def _set_uri_port(self, port):
+        self.delete_option(number=URI_PORT)
+        if port is not None:
+            self.add_option(UintOption(number=URI_PORT, value=port))
+
+    def _get_uri_port(self):
+        port = self.get_option(number=URI_PORT)
+        if port is not None:
+            return port[0].value
+        else:
+            return None
+
+    uri_port = property(_get_uri_port, _set_uri_port)
+
+    def _set_proxy_uri(self, uri):
+        self.delete_option(number=PROXY_URI)
+        if uri is not None:
+            self.add_option(StringOption(number=PROXY_URI, value=uri))
+
+    def _get_proxy_uri(self):
+        uri = self.get_option(number=PROXY_URI)
+        if uri is not None:
+            return uri[0].value
+        else:
+            return None
+
+    proxy_uri = property(_get_proxy_uri, _set_proxy_uri)
+
+    def _set_proxy_scheme(self, scheme):
+        self.delete_option(number=PROXY_SCHEME)
+        if scheme is not None:
+            self.add_option(StringOption(number=PROXY_SCHEME, value=scheme))
+
+    def _get_proxy_scheme(self):
+        scheme = self.get_option(number=PROXY_SCHEME)
+        if scheme is not None:
+            return scheme[0].value
+        else:
+            return None
+
+    proxy_scheme = property(_get_proxy_scheme, _set_proxy_scheme)
+
     @staticmethod
     def read_extended_field_value(value, rawdata):
         """Used to decode large values of option delta and option length
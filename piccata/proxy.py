@@ -0,0 +1,300 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+CoAP-to-CoAP forward proxy (RFC 7252, section 5.7).
+"""
+import collections
+import logging
+import threading
+
+from urllib.parse import unquote_to_bytes, urlsplit
+
+from piccata.cache import cache_key, coalescing_key
+from piccata.constants import *
+from piccata.message import Message, random_token
+from piccata.types import endpoint
+
+_HOP_BY_HOP_OPTIONS = (URI_HOST, URI_PORT, URI_PATH, URI_QUERY, PROXY_URI, PROXY_SCHEME, OBSERVE)
+"""Options of a proxied request that are not forwarded as they are."""
+
+_RESULT_CODES = {RESULT_TIMEOUT: GATEWAY_TIMEOUT,
+                 RESULT_RESET: BAD_GATEWAY,
+                 RESULT_CANCELLED: BAD_GATEWAY}
+"""Response codes sent to clients when no response was received from the upstream server."""
+
+
+class ProxyError(Exception):
+    """Raised when a proxied request cannot be forwarded. Carries a response code for the client."""
+
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+
+
+def parse_proxy_request(request):
+    """Get the upstream server and resource of a proxied request.
+
+    The target is taken from the Proxy-Uri option, or from Proxy-Scheme with Uri-Host, Uri-Port,
+    Uri-Path and Uri-Query options. Only coap scheme with IP address literals is supported.
+
+    Args:
+        request (piccata.message.Message): A request with Proxy-Uri or Proxy-Scheme option.
+
+    Returns:
+        tuple: An (endpoint, Uri-Path segments, Uri-Query segments) tuple.
+
+    Raises:
+        ProxyError: If the request cannot be forwarded.
+    """
+    if request.opt.proxy_uri is not None:
+        try:
+            uri = urlsplit(request.opt.proxy_uri.decode('ascii'))
+            scheme, host, port = uri.scheme, uri.hostname, uri.port
+        except ValueError:
+            raise ProxyError(BAD_OPTION, "Malformed Proxy-Uri")
+        path = [unquote_to_bytes(segment) for segment in uri.path.split('/')[1:]]
+        query = [unquote_to_bytes(segment) for segment in uri.query.split('&')] if uri.query else []
+    else:
+        scheme = request.opt.proxy_scheme.decode('ascii', 'replace')
+        host = request.opt.uri_host
+        host = host.decode('ascii', 'replace') if host is not None else None
+        port = request.opt.uri_port
+        path = request.opt.uri_path
+        query = request.opt.uri_query
+
+    if scheme != 'coap':
+        raise ProxyError(PROXYING_NOT_SUPPORTED, "Scheme %s not supported" % scheme)
+    try:
+        remote = endpoint(host, COAP_PORT if port is None else port)
+    except (TypeError, ValueError):
+        raise ProxyError(BAD_GATEWAY, "Host %s cannot be resolved" % host)
+    return remote, path, query
+
+
+class _ProxyExchange(object):
+    """A request forwarded upstream, with downstream requests waiting for its response."""
+
+    __slots__ = ('request', 'key', 'pending_key', 'waiting', 'revalidating')
+
+    def __init__(self, request, key, waiting, revalidating):
+        self.request = request
+        self.key = key
+        self.pending_key = coalescing_key(request)
+        self.waiting = waiting
+        self.revalidating = revalidating
+
+
+class _Upstream(object):
+    """Requests forwarded to a single upstream server."""
+
+    __slots__ = ('in_flight', 'queue')
+
+    def __init__(self):
+        self.in_flight = 0
+        self.queue = collections.deque()
+
+
+class ProxyRequestHandler(object):
+    """Forward proxy handling requests with Proxy-Uri or Proxy-Scheme option.
+
+    Requests are forwarded with a new token, and answered with a separate response once the
+    upstream server responds. Identical GET requests waiting for the same upstream response share
+    a single upstream exchange, and fresh responses are served from a response cache. At most
+    nstart requests are outstanding towards a single upstream server, others are queued.
+
+    Tokens are mapped between the two sides with dicts. Message IDs are not mapped: they are hop-by-hop,
+    so every side allocates its own and matches them in its message layer, which also uses dicts.
+    """
+
+    def __init__(self, protocol, upstream=None, response_cache=None, nstart=NSTART, max_queue=64):
+        """Initialize.
+
+        Args:
+            protocol (piccata.core.Coap): A protocol used to respond to clients.
+            upstream (piccata.core.Coap): A protocol used to forward requests. May be None to use the client side protocol.
+            response_cache (piccata.cache.ResponseCache): A cache for upstream responses. May be None.
+            nstart (int): A maximum number of outstanding requests per upstream server.
+            max_queue (int): A maximum number of requests queued per upstream server. Requests over the limit
+                are answered with 5.03 Service Unavailable.
+        """
+        if nstart < 1:
+            raise ValueError("At least one outstanding request shall be allowed")
+
+        self.protocol = protocol
+        self.upstream = upstream if upstream is not None else protocol
+        self.response_cache = response_cache
+        self.nstart = nstart
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._exchanges = {}  # requests forwarded upstream (identified by token)
+        self._downstream = {}  # requests waiting for an upstream response (identified by remote and token)
+        self._pending_gets = {}  # GET requests forwarded upstream (identified by coalescing key)
+        self._upstreams = {}  # upstream servers with outstanding requests (identified by endpoint)
+
+    def __len__(self):
+        return len(self._exchanges)
+
+    def _forwarded_request(self, request, remote, path, query):
+        forwarded = Message(CON, None, request.code, request.payload, random_token())
+        for option in request.opt.option_list():
+            if option.number not in _HOP_BY_HOP_OPTIONS:
+                forwarded.opt.add_option(option)
+        forwarded.opt.uri_path = path
+        forwarded.opt.uri_query = query
+        forwarded.remote = remote
+        return forwarded
+
+    def _client_response(self, request, response, piggybacked):
+        """Create a response to the client from the upstream response."""
+        if piggybacked:
+            mtype = ACK if request.mtype is CON else NON
+        else:
+            mtype = request.mtype
+        client_response = Message(mtype, None, response.code, response.payload)
+        for option in response.opt.option_list():
+            if option.number != OBSERVE:
+                client_response.opt.add_option(option)
+        client_response.remote = request.remote
+        return client_response
+
+    def _accepted(self, request):
+        """Response to a request that will be answered with a separate response."""
+        return Message.EmptyAckMessage(request) if request.mtype is CON else None
+
+    def receive_request(self, request):
+        """Function for handling proxied requests. Shall be called by the ResourceManager.
+
+        Args:
+            request (piccata.message.Message): A request with Proxy-Uri or Proxy-Scheme option.
+
+        Returns:
+            A response to send back. None if no response shall be sent.
+        """
+        try:
+            remote, path, query = parse_proxy_request(request)
+        except ProxyError as e:
+            logging.info("Proxy request rejected: %s" % e)
+            return Message.AckMessage(request, code=e.code)
+
+        forwarded = self._forwarded_request(request, remote, path, query)
+        key = cache_key(forwarded)
+        revalidating = False
+
+        if request.code is GET and self.response_cache is not None:
+            response, fresh = self.response_cache.lookup(key, self.protocol.clock.now())
+            if fresh:
+                return self._client_response(request, response, True)
+            if response is not None:
+                revalidating = True
+                if response.opt.etag not in forwarded.opt.etags:
+                    forwarded.opt.etags = forwarded.opt.etags + [response.opt.etag]
+        elif self.response_cache is not None:
+            self.response_cache.invalidate(key)
+
+        with self._lock:
+            downstream_key = (request.remote, request.token)
+            if downstream_key in self._downstream:
+                # The client repeated the request, the response is already on the way.
+                return self._accepted(request)
+
+            # Clients sending different ETags may need different responses, so they do not share an exchange.
+            exchange = self._pending_gets.get(coalescing_key(forwarded)) if request.code is GET else None
+            if exchange is not None:
+                exchange.waiting.append(request)
+                self._downstream[downstream_key] = exchange
+                return self._accepted(request)
+
+            upstream = self._upstreams.get(remote)
+            if upstream is None:
+                upstream = self._upstreams[remote] = _Upstream()
+            elif upstream.in_flight >= self.nstart and len(upstream.queue) >= self.max_queue:
+                response = Message.AckMessage(request, code=SERVICE_UNAVAILABLE)
+                response.opt.max_age = int(ACK_TIMEOUT)
+                return response
+
+            exchange = _ProxyExchange(forwarded, key, [request], revalidating)
+            self._exchanges[forwarded.token] = exchange
+            self._downstream[downstream_key] = exchange
+            if request.code is GET:
+                self._pending_gets[exchange.pending_key] = exchange
+
+            if upstream.in_flight < self.nstart:
+                upstream.in_flight += 1
+            else:
+                upstream.queue.append(forwarded)
+                forwarded = None
+
+        if forwarded is not None:
+            self._send(forwarded)
+        return self._accepted(request)
+
+    def _send(self, forwarded):
+        logging.info("Forwarding request to %s:%d" % forwarded.remote)
+        try:
+            self.upstream.request(forwarded, self._upstream_response)
+        except Exception as e:
+            logging.info("Forwarding failed: %s" % e)
+            self._upstream_response(RESULT_CANCELLED, forwarded, None)
+
+    def _refetch(self, exchange):
+        """Forward the request of an exchange again without ETags, keeping the clients waiting and the upstream slot."""
+        forwarded = Message(CON, None, exchange.request.code, exchange.request.payload, random_token())
+        for option in exchange.request.opt.option_list():
+            if option.number != ETAG:
+                forwarded.opt.add_option(option)
+        forwarded.remote = exchange.request.remote
+        with self._lock:
+            del self._exchanges[exchange.request.token]
+            exchange.request = forwarded
+            exchange.revalidating = False
+            self._exchanges[forwarded.token] = exchange
+        self._send(forwarded)
+
+    def _upstream_response(self, result, request, response):
+        """Pass an upstream response to all clients waiting for it and forward the next queued request."""
+        with self._lock:
+            exchange = self._exchanges.get(request.token)
+        if exchange is None:
+            return
+
+        if result is RESULT_SUCCESS and self.response_cache is not None and request.code is GET:
+            if exchange.revalidating:
+                cached = self.response_cache.revalidated(exchange.key, response, self.protocol.clock.now())
+                if cached is not None:
+                    response = cached
+                elif response.code is VALID:
+                    # The stale entry was evicted meanwhile. The 2.03 cannot be passed on, as the waiting
+                    # clients may not know the ETag, so the representation is fetched again.
+                    logging.info("Revalidated response no longer cached, forwarding request again")
+                    self._refetch(exchange)
+                    return
+            else:
+                self.response_cache.store(exchange.key, response, self.protocol.clock.now())
+
+        with self._lock:
+            del self._exchanges[request.token]
+            if self._pending_gets.get(exchange.pending_key) is exchange:
+                del self._pending_gets[exchange.pending_key]
+            for waiting in exchange.waiting:
+                del self._downstream[(waiting.remote, waiting.token)]
+
+            upstream = self._upstreams[request.remote]
+            if upstream.queue:
+                next_request = upstream.queue.popleft()
+            else:
+                next_request = None
+                upstream.in_flight -= 1
+                if upstream.in_flight == 0:
+                    del self._upstreams[request.remote]
+
+        for waiting in exchange.waiting:
+            if result is RESULT_SUCCESS:
+                client_response = self._client_response(waiting, response, False)
+            else:
+                client_response = Message(waiting.mtype, None, _RESULT_CODES[result])
+                client_response.remote = waiting.remote
+            self.protocol.respond(waiting, client_response)
+
+        if next_request is not None:
+            self._send(next_request)
@@ -0,0 +1,135 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Rate limiting helpers.
+"""
+import collections
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    The bucket holds up to burst tokens and is refilled with rate tokens per second.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'timestamp')
+
+    def __init__(self, rate, burst, now=None):
+        """Initialize a full token bucket.
+
+        Args:
+            rate (float): A number of tokens added per second.
+            burst (float): A maximum number of tokens in the bucket.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.timestamp = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        elapsed = now - self.timestamp
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.timestamp = now
+
+    def consume(self, tokens=1, now=None):
+        """Take tokens from the bucket if available.
+
+        Args:
+            tokens (float): A number of tokens to take.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            bool: True if tokens were taken, False if there were not enough tokens.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1, now=None):
+        """Get time after which the requested number of tokens will be available.
+
+        Args:
+            tokens (float): A number of tokens.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            float: A delay in seconds, 0 if tokens are available now.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+
+ACTION_DROP = 0
+"""Excess messages are silently dropped."""
+
+ACTION_RESET = 1
+"""Excess CON and NON messages are rejected with RST."""
+
+ACTION_RESPOND = 2
+"""Excess requests are answered with 4.29 Too Many Requests, other CON and NON messages are rejected with RST."""
+
+
+class PeerRateLimiter(object):
+    """Per remote endpoint token bucket rate limiter.
+
+    Buckets are kept for a bounded number of recently active peers. The least recently active
+    peer is forgotten first, it starts with a full bucket when it appears again.
+    """
+
+    def __init__(self, rate, burst, action=ACTION_DROP, max_peers=4096):
+        """Initialize.
+
+        Args:
+            rate (float): A number of messages accepted per second from a single peer.
+            burst (float): A number of messages a peer may send at once.
+            action (int): What to do with excess messages: ACTION_DROP, ACTION_RESET or ACTION_RESPOND.
+            max_peers (int): A maximum number of peers tracked.
+        """
+        if action not in (ACTION_DROP, ACTION_RESET, ACTION_RESPOND):
+            raise ValueError("Unknown rate limiter action")
+        if max_peers < 1:
+            raise ValueError("At least one peer shall be tracked")
+
+        self.rate = rate
+        self.burst = burst
+        self.action = action
+        self.max_peers = max_peers
+        self.limited = 0
+
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def delay(self, remote, now=None):
+        """Check if a message from a peer is within its rate, taking a token if it is.
+
+        Args:
+            remote (piccata.types.Endpoint): An address of the message originator.
+            now (float): A current time in seconds. May be None to use time.monotonic.
+
+        Returns:
+            float: 0 if the message is allowed, otherwise a time in seconds until the next message would be.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(remote)
+            if bucket is None:
+                bucket = self._buckets[remote] = TokenBucket(self.rate, self.burst, now)
+                if len(self._buckets) > self.max_peers:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(remote)
+            if bucket.consume(1, now):
+                return 0.0
+            self.limited += 1
+            return bucket.delay(1, now)
@@ -5,16 +5,99 @@ Copyright (c) 2012 Maciej Wasilak <http://sixpinetrees.blogspot.com/>
 Implementation of the lowest-level Resource class.
 """
 
+import bisect
+import collections
+
+from piccata import cache
 from piccata import message
+from piccata import observe
+from piccata.block_transfer import extract_block, size_exp_to_size
+from piccata.clock import RealTimeClock
 from piccata.constants import *
-from itertools import chain
+from itertools import chain, islice
 from piccata.types import NoResource, UnallowedMethod, UnsupportedMethod
 
+WILDCARD = object()
+"""A child path that matches any single Uri-Path segment (e.g. a device ID).
+
+Children registered under an exact segment take precedence over a wildcard child.
+"""
+
+_RENDER_METHODS = dict((code, 'render_' + name) for code, name in requests.items())
+"""Names of render methods (identified by request code), so they are not built for every request."""
+
+_LinkEntry = collections.namedtuple('_LinkEntry', 'href params text')
+"""A link-format description of a single resource: href, params (name -> list of values) and encoded text."""
+
+_VirtualLinks = collections.namedtuple('_VirtualLinks', 'resource path')
+"""A placeholder for link-format descriptions of virtual children, enumerated only when needed."""
+
+
+def _expand_links(entries, offset=0):
+    """Iterate over link entries past offset, enumerating virtual subtrees lazily.
+
+    Skipped virtual subtrees are asked to seek rather than generating the entries thrown away.
+    """
+    for entry in entries:
+        if type(entry) is _VirtualLinks:
+            resource = entry.resource
+            count = resource.virtual_link_count(entry.path)
+            if count is not None and offset >= count:
+                offset -= count
+                continue
+            for virtual_entry in resource.iter_virtual_links(entry.path, offset):
+                offset = 0
+                yield virtual_entry
+            if offset:
+                # The subtree was shorter than offset, so it was enumerated to the end and its size is known.
+                offset = max(0, offset - resource.virtual_link_count(entry.path))
+        elif offset:
+            offset -= 1
+        else:
+            yield entry
+
+
+def _link_matches(entry, name, value):
+    """Check if a link entry matches a single query filter. Value None checks only for param presence."""
+    if name == 'href':
+        if value is None:
+            # Every link has a target.
+            return True
+        if value.endswith('*'):
+            return entry.href.startswith(value[:-1])
+        return entry.href == value
+
+    values = entry.params.get(name)
+    if values is None:
+        return False
+    if value is None:
+        return True
+    prefix = value[:-1] if value.endswith('*') else None
+    for param_value in values:
+        for token in set(param_value.split()) | {param_value}:
+            if token == value or (prefix is not None and token.startswith(prefix)):
+                return True
+    return False
+
+
+def _segment_to_str(segment):
+    if isinstance(segment, bytes):
+        return segment.decode('utf-8')
+    return segment
+
+
 class CoapResource(object):
     """CoAP-accessible resource."""
 
     server = None
 
+    _endpoint = None  # piccata.resource.CoapEndpoint routing requests to the resource tree
+    _parent = None
+    _link_cache = None  # (path, list of _LinkEntry) describing the subtree, None if invalid
+    _handlers = None  # render methods (identified by request code), resolved when attached or on the first request
+    _visible = False
+    _observable = False
+
     def __init__(self):
         """Initialize.
         """
@@ -23,9 +106,28 @@ class CoapResource(object):
         self.visible = False
         self.observers = {} # (address, token) -> observation
 
-    observable = False
     observe_index = 0
     is_leaf = False
+    cacheable = False
+    """If True, GET responses are cached by the ResourceManager until the resource changes or Max-Age expires."""
+
+    def _get_visible(self):
+        return self._visible
+
+    def _set_visible(self, visible):
+        self._visible = visible
+        self.invalidate_links()
+
+    visible = property(_get_visible, _set_visible)
+
+    def _get_observable(self):
+        return self._observable
+
+    def _set_observable(self, observable):
+        self._observable = observable
+        self.invalidate_links()
+
+    observable = property(_get_observable, _set_observable)
 
     def get_child(self, path):
         """Retrieve a child resource from me.
@@ -40,10 +142,28 @@ class CoapResource(object):
         """Register a static child.
 
         You almost certainly don't want '/' in your path. If you intended to have the root of a folder,
-        e.g. /foo/, you want path to be ''.
+        e.g. /foo/, you want path to be ''. Use WILDCARD as path to match any single segment.
         """
+        previous = self.children.get(path)
         self.children[path] = child
         child.server = self.server
+        child._parent = self
+        child._resolve_handlers()
+        self.invalidate_links()
+        if self._endpoint is not None:
+            self._endpoint.child_updated(self, path, previous, child)
+
+    def delete_child(self, path):
+        """Remove a static child.
+
+        Args:
+            path (bytes): A path the child was registered with.
+        """
+        child = self.children.pop(path, None)
+        if child is not None:
+            self.invalidate_links()
+            if self._endpoint is not None:
+                self._endpoint.child_updated(self, path, child, None)
 
     def render(self, request):
         """Render a given resource. Calls a handler for respective request code in format render_CODE.
@@ -51,22 +171,46 @@ class CoapResource(object):
         The render method shall accept one argument with a request message. An example render method:
             rended_GET(request)
 
+        Requests with a code not recognized or not handled by the resource are answered
+        with 4.05 Method Not Allowed. Render methods are looked up when the resource is attached
+        with put_child (or on its first request), see invalidate_handlers.
+
         Args:
             request (piccata.message.Message) A request for handling.
         """
-        if request.code not in requests:
-            raise UnsupportedMethod()
-        m = getattr(self, 'render_' + requests[request.code], None)
-        if not m:
-            raise UnallowedMethod()
-        return m(request)
+        handlers = self._handlers
+        if handlers is None:
+            handlers = self._resolve_handlers()
+        try:
+            handler = handlers[request.code]
+        except KeyError:
+            return _render_method_not_recognized(self, request)
+        if handler is None:
+            return _render_method_not_allowed(self, request)
+        return handler(request)
+
+    def _resolve_handlers(self):
+        """Look up render methods of the resource once, so requests are dispatched without attribute lookups."""
+        handlers = dict((code, getattr(self, name, None)) for code, name in _RENDER_METHODS.items())
+        self._handlers = handlers
+        return handlers
+
+    def invalidate_handlers(self):
+        """Drop the render methods looked up for the resource.
+
+        Shall be called by the application after assigning or removing render methods of the resource
+        or its class, once the resource was attached or rendered.
+        """
+        self._handlers = None
 
     def add_param(self, param):
         self.params.setdefault(param.name, []).append(param)
+        self.invalidate_links()
 
     def delete_param(self, name):
         if name in self.params:
             self.params.pop(name)
+            self.invalidate_links()
 
     def get_param(self, name):
         return self.params.get(name)
@@ -78,15 +222,74 @@ class CoapResource(object):
             data.append(param.encode())
         return (';'.join(data))
 
-    def generate_resource_list(self, data, path=""):
-        params = self.encode_params() + (";obs" if self.observable else "")
+    def invalidate_links(self):
+        """Drop the cached link-format description of this resource and its ancestors.
+
+        Called automatically when children, params, visibility or observability change.
+        Shall be called by the application after modifying params or LinkParam values directly.
+        """
+        resource = self
+        # A valid cache implies valid caches of the whole subtree, so the walk may stop early.
+        while resource is not None and resource._link_cache is not None:
+            resource._link_cache = None
+            resource = resource._parent
+
+    def _link_entry(self, path):
+        """Create a link-format description of this resource."""
+        params = {}
+        for name, values in self.params.items():
+            params[name] = [str(param.value) for param in values]
+        text = self.encode_params()
+        if self.observable:
+            params['obs'] = []
+            text += ";obs"
+        href = path or "/"
+        return _LinkEntry(href, params, '<' + href + '>' + text)
+
+    def _link_entries(self, path):
+        """Get link-format descriptions of all visible resources in the subtree.
+
+        The result is cached until invalidate_links is called for this resource or any of its descendants.
+
+        Args:
+            path (str): A path of this resource.
+
+        Returns:
+            list: A list of _LinkEntry objects, with _VirtualLinks placeholders for virtual subtrees.
+        """
+        cache = self._link_cache
+        if cache is not None and cache[0] == path:
+            return cache[1]
+
+        entries = []
         if self.visible is True:
-            if path is "":
-                data.append('</>' + params)
-            else:
-                data.append('<' + path + '>' + params)
-        for key in self.children:
-            self.children[key].generate_resource_list(data, path + "/" + key)
+            entries.append(self._link_entry(path))
+        for key, child in self.children.items():
+            if key is WILDCARD:
+                continue
+            entries.extend(child._link_entries(path + "/" + _segment_to_str(key)))
+        entries.extend(self._virtual_link_entries(path))
+        self._link_cache = (path, entries)
+        return entries
+
+    def _virtual_link_entries(self, path):
+        """Get placeholders for children that are not stored in the children dictionary."""
+        return ()
+
+    def generate_resource_list(self, data, path="", offset=0, count=None):
+        """Append link-format descriptions of visible resources in the subtree to a list.
+
+        Virtual subtrees are enumerated lazily and seek to the offset, so a page of a large listing
+        can be generated without resolving the resources before or past it.
+
+        Args:
+            data (list): A list that the descriptions are appended to.
+            path (str): A path of this resource.
+            offset (int): A number of descriptions to skip.
+            count (int): A maximum number of descriptions to append. May be None for no limit.
+        """
+        for entry in islice(_expand_links(self._link_entries(path), offset), count):
+            data.append(entry.text)
 
 
 class LinkParam(object):
@@ -101,6 +304,358 @@ class LinkParam(object):
         return '%s="%s"' % (self.name, self.value)
 
 
+class VirtualResource(CoapResource):
+    """Resource which children are resolved on demand instead of being stored.
+
+    Children are created by a resolver callback and only the most recently used ones are kept,
+    so memory follows the working set rather than the size of the namespace (e.g. one path
+    per proxied device). Static children registered with put_child take precedence.
+
+    Note that state kept in an evicted child (e.g. observers) is lost, unless the resolver
+    returns the same object again. Positions of enumerated pages are remembered to serve deep
+    pages of resource discovery, so invalidate_links shall be called when virtual children are
+    added or removed.
+    """
+
+    def __init__(self, resolver, enumerator=None, max_children=1024, page_size=256):
+        """Initialize.
+
+        Args:
+            resolver (function): A function returning a child resource for a path segment, or None if there is no such child:
+                resolver(path)
+            enumerator (function): A function returning an iterable of path segments of existing children, used for
+                resource discovery. May be None if virtual children shall not be listed:
+                enumerator(offset, count)
+            max_children (int): A maximum number of resolved children kept in memory.
+            page_size (int): A number of path segments requested from the enumerator at once.
+        """
+        CoapResource.__init__(self)
+        self.resolver = resolver
+        self.enumerator = enumerator
+        self.max_children = max_children
+        self.page_size = page_size
+
+        self._resolved = collections.OrderedDict()  # recently used children (identified by path segment)
+        self._positions = None  # path and (link index, enumerator offset) of each page start, see iter_virtual_links
+        self._link_count = None  # number of virtual links, known once enumerated to the end
+
+    def _resolve(self, path):
+        child = self.resolver(path)
+        if child is not None:
+            child.server = self.server
+            child._endpoint = self._endpoint
+            child._resolve_handlers()
+        return child
+
+    def get_child(self, path):
+        """Retrieve a static child or resolve a virtual one.
+
+        If no resource is found, NoResource exception is raised.
+        """
+        child = self.children.get(path)
+        if child is not None:
+            return child
+
+        resolved = self._resolved
+        child = resolved.get(path)
+        if child is not None:
+            resolved.move_to_end(path)
+            return child
+
+        child = self._resolve(path)
+        if child is None:
+            raise NoResource
+        resolved[path] = child
+        if len(resolved) > self.max_children:
+            resolved.popitem(last=False)
+        return child
+
+    def invalidate_links(self):
+        """Drop the cached link-format description and the remembered positions of virtual children."""
+        self._positions = None
+        self._link_count = None
+        CoapResource.invalidate_links(self)
+
+    def forget_child(self, path):
+        """Drop a resolved child, e.g. after the resource it represents was removed.
+
+        Args:
+            path (bytes): A path segment of the child.
+        """
+        self._resolved.pop(path, None)
+        self.invalidate_links()
+
+    def _virtual_link_entries(self, path):
+        if self.enumerator is None:
+            return ()
+        return (_VirtualLinks(self, path), )
+
+    def virtual_link_count(self, path):
+        """Get a number of link-format descriptions of virtual children, if already known.
+
+        Args:
+            path (str): A path of this resource.
+
+        Returns:
+            int: A number of descriptions, or None if the children were not enumerated to the end yet.
+        """
+        if self._positions is None or self._positions[0] != path:
+            return None
+        return self._link_count
+
+    def iter_virtual_links(self, path, offset=0):
+        """Enumerate link-format descriptions of virtual children page by page.
+
+        Children not present in memory are resolved only for the description and are not kept.
+        Enumeration starts at the page holding the description at offset, if its position is known
+        from an earlier enumeration, so paging through the listing does not start over each time.
+
+        Args:
+            path (str): A path of this resource.
+            offset (int): A number of descriptions to skip.
+        """
+        if self._positions is None or self._positions[0] != path:
+            self._positions = (path, [(0, 0)])
+            self._link_count = None
+        positions = self._positions[1]
+        index, page_offset = positions[bisect.bisect_right(positions, (offset, float('inf'))) - 1]
+
+        while True:
+            page = list(self.enumerator(page_offset, self.page_size))
+            for segment in page:
+                if segment in self.children:
+                    continue
+                child = self._resolved.get(segment)
+                if child is None:
+                    child = self._resolve(segment)
+                    if child is None:
+                        continue
+                for entry in _expand_links(child._link_entries(path + "/" + _segment_to_str(segment))):
+                    if index >= offset:
+                        yield entry
+                    index += 1
+            if len(page) < self.page_size:
+                self._link_count = index
+                return
+            page_offset += len(page)
+            if positions[-1][1] < page_offset:
+                positions.append((index, page_offset))
+
+
+class WellKnownCoreResource(CoapResource):
+    """Resource serving CoRE link format (RFC 6690) description of the resource tree.
+
+    It shall be registered under /.well-known/core path, e.g.:
+        well_known = CoapResource()
+        well_known.put_child(b'core', WellKnownCoreResource())
+        root.put_child(b'.well-known', well_known)
+
+    The serialized description and the indexes used for query filtering (e.g. ?rt=temperature,
+    ?if=sensor*, ?href=/devices*) are cached and rebuilt only after the resource tree has changed.
+    Descriptions larger than a single block are served with Block2 option.
+    """
+
+    def __init__(self, size_exp=MAX_BLOCK_SIZE_EXP, max_cached_queries=64):
+        """Initialize.
+
+        Args:
+            size_exp (int): A largest block size exponent used for responses.
+            max_cached_queries (int): A maximum number of filtered responses kept in cache.
+        """
+        CoapResource.__init__(self)
+        self.size_exp = size_exp
+        self.max_cached_queries = max_cached_queries
+
+        self._entries = None  # link entries the cached data was generated from
+        self._virtual = False  # True if the entries contain virtual subtrees
+        self._payload = b''
+        self._indexes = {}  # entry positions (identified by param name and value)
+        self._hrefs = []  # sorted (href, position) tuples
+        self._queries = collections.OrderedDict()  # filtered payloads (identified by query)
+        self._streams = collections.OrderedDict()  # sorted (byte offset, link index) of streamed blocks (identified by query)
+
+    def _update(self):
+        """Regenerate cached data if the resource tree has changed since the last request."""
+        root = self._endpoint.root if self._endpoint is not None else self
+        entries = root._link_entries("")
+        if entries is self._entries:
+            return entries
+
+        self._entries = entries
+        self._indexes = {}
+        self._queries.clear()
+        self._streams.clear()
+        self._virtual = any(type(entry) is _VirtualLinks for entry in entries)
+        if self._virtual:
+            # Virtual subtrees are enumerated per request, only as far as the requested block.
+            self._payload = None
+            self._hrefs = []
+        else:
+            self._payload = ','.join(entry.text for entry in entries).encode('utf-8')
+            self._hrefs = sorted((entry.href, position) for position, entry in enumerate(entries))
+        return entries
+
+    def _index(self, name):
+        """Get an index of a link param.
+
+        The index maps each value of the param (and each of its space separated tokens) to positions
+        of entries carrying it. Positions of all entries carrying the param are stored under None.
+        """
+        index = self._indexes.get(name)
+        if index is None:
+            index = {None: []}
+            for position, entry in enumerate(self._entries):
+                values = entry.params.get(name)
+                if values is None:
+                    continue
+                index[None].append(position)
+                for value in values:
+                    for token in set(value.split()) | {value}:
+                        index.setdefault(token, []).append(position)
+            self._indexes[name] = index
+        return index
+
+    def _match(self, name, value):
+        """Get positions of entries matching a single query filter."""
+        if name == 'href':
+            if value is None:
+                return set(range(len(self._entries)))
+            exact = not value.endswith('*')
+            prefix = value if exact else value[:-1]
+            positions = set()
+            hrefs = self._hrefs
+            i = bisect.bisect_left(hrefs, (prefix, ))
+            while i < len(hrefs):
+                href, position = hrefs[i]
+                if not href.startswith(prefix) or (exact and href != value):
+                    break
+                positions.add(position)
+                i += 1
+            return positions
+
+        index = self._index(name)
+        if value is not None and value.endswith('*'):
+            prefix = value[:-1]
+            return set(chain.from_iterable(positions for token, positions in index.items()
+                                           if token is not None and token.startswith(prefix)))
+        return set(index.get(value, ()))
+
+    def _filter(self, query):
+        """Get link-format payload of entries matching all query filters."""
+        key = tuple(query)
+        payload = self._queries.get(key)
+        if payload is not None:
+            self._queries.move_to_end(key)
+            return payload
+
+        positions = None
+        for segment in query:
+            name, separator, value = _segment_to_str(segment).partition('=')
+            matched = self._match(name, value if separator else None)
+            positions = matched if positions is None else positions & matched
+
+        payload = ','.join(self._entries[position].text for position in sorted(positions)).encode('utf-8')
+        self._queries[key] = payload
+        if len(self._queries) > self.max_cached_queries:
+            self._queries.popitem(last=False)
+        return payload
+
+    def _stream(self, query, start, limit):
+        """Generate link-format payload enumerating virtual subtrees, stopping once limit bytes are reached.
+
+        Generation resumes from the last known link starting at or before the start byte, remembered when
+        earlier blocks were served, so each block of a listing costs about the same.
+
+        Returns:
+            tuple: An (offset, payload) tuple, where offset is the position of the payload in the whole description.
+        """
+        filters = []
+        for segment in query:
+            name, separator, value = _segment_to_str(segment).partition('=')
+            filters.append((name, value if separator else None))
+
+        key = tuple(query)
+        positions = self._streams.get(key)
+        if positions is None:
+            positions = self._streams[key] = [(0, 0)]
+            if len(self._streams) > self.max_cached_queries:
+                self._streams.popitem(last=False)
+        else:
+            self._streams.move_to_end(key)
+        offset, index = positions[bisect.bisect_right(positions, (start, float('inf'))) - 1]
+
+        data = []
+        end = offset - 1
+        for index, entry in enumerate(_expand_links(self._entries, index), index):
+            if all(_link_matches(entry, name, value) for name, value in filters):
+                text = entry.text.encode('utf-8')
+                position = end + 1
+                data.append(text)
+                end += len(text) + 1
+                if end >= limit:
+                    # The last link reaches into the next block, which resumes from it.
+                    if position > positions[-1][0]:
+                        positions.append((position, index))
+                    break
+        return offset, b','.join(data)
+
+    def render_GET(self, request):
+        self._update()
+        query = request.opt.uri_query
+
+        block2 = request.opt.block2
+        if block2 is None:
+            number, szx = 0, self.size_exp
+        else:
+            number, szx = block2.num, block2.szx
+            if szx > self.size_exp:
+                number = number << (szx - self.size_exp)
+                szx = self.size_exp
+
+        offset = 0
+        if self._virtual:
+            start = number * size_exp_to_size(szx)
+            # One byte past the requested block tells if there are more blocks.
+            offset, payload = self._stream(query, start, start + size_exp_to_size(szx) + 1)
+        else:
+            payload = self._filter(query) if query else self._payload
+
+        if block2 is None and len(payload) <= size_exp_to_size(self.size_exp):
+            response = message.Message(code=CONTENT, payload=payload)
+            response.opt.content_format = media_types_rev['application/link-format']
+            return response
+
+        if offset:
+            # A streamed payload starts at a known link before the requested block.
+            data_block, more = extract_block(payload[number * size_exp_to_size(szx) - offset:], 0, szx)
+        else:
+            data_block, more = extract_block(payload, number, szx)
+        if data_block is None:
+            return message.Message.AckMessage(request, code=BAD_OPTION, payload=b"Error: Block number out of range!")
+
+        response = message.Message(code=CONTENT, payload=data_block)
+        response.opt.content_format = media_types_rev['application/link-format']
+        response.opt.block2 = (number, more, szx)
+        return response
+
+
+def _render_method_not_allowed(resource, request):
+    return message.Message.AckMessage(request, code=METHOD_NOT_ALLOWED, payload=b"Error: Method not allowed!")
+
+
+def _render_method_not_recognized(resource, request):
+    return message.Message.AckMessage(request, code=METHOD_NOT_ALLOWED, payload=b"Error: Method not recognized!")
+
+
+def _is_dynamic(resource):
+    """Check if children of a resource can not be compiled into the routing table.
+
+    It is the case for leaf resources (they handle the whole remaining path) and resources
+    providing their own get_child.
+    """
+    return resource.is_leaf or type(resource).get_child is not CoapResource.get_child
+
+
 class CoapEndpoint(object):
 
     def __init__(self, root_resource):
@@ -111,33 +666,222 @@ class CoapEndpoint(object):
         """
         self.root = root_resource
 
+        self._routes = {}  # resources reachable by a compiled path, WILDCARD segments included (identified by path tuple)
+        self._paths = {}  # compiled paths of resources in the routing table (identified by resource)
+        self._dynamic = set()  # paths of resources that require walking the tree to resolve their children
+        self._patterns = {}  # numbers of routes with WILDCARD segments (identified by path length and wildcard positions)
+        self._masks = {}  # wildcard positions of routes, exact segments first (identified by path length)
+
+        self._add_routes((), root_resource)
+
+    def _attach(self, resource):
+        """Bind a resource subtree with this endpoint."""
+        resource._endpoint = self
+        for child in resource.children.values():
+            self._attach(child)
+
+    def _count_pattern(self, path, change):
+        """Update the wildcard positions tried for paths of the length of a route."""
+        mask = tuple(segment is WILDCARD for segment in path)
+        if not any(mask):
+            return
+        key = (len(path), mask)
+        count = self._patterns.get(key, 0) + change
+        if count:
+            self._patterns[key] = count
+        else:
+            del self._patterns[key]
+        # Positions with an exact segment first, as exact children take precedence over wildcards.
+        masks = sorted(m for length, m in self._patterns if length == len(path))
+        if masks:
+            self._masks[len(path)] = masks
+        else:
+            self._masks.pop(len(path), None)
+
+    def _add_routes(self, path, resource):
+        """Compile paths of a resource subtree into the routing table."""
+        resource._endpoint = self
+        self._routes[path] = resource
+        self._paths.setdefault(resource, set()).add(path)
+        self._count_pattern(path, 1)
+
+        if _is_dynamic(resource):
+            self._dynamic.add(path)
+            for child in resource.children.values():
+                self._attach(child)
+            return
+
+        for segment, child in resource.children.items():
+            self._add_routes(path + (segment,), child)
+
+    def _remove_routes(self, path, resource):
+        """Remove static paths of a resource subtree from the routing table."""
+        if self._routes.get(path) is not resource:
+            return
+
+        del self._routes[path]
+        self._count_pattern(path, -1)
+        self._dynamic.discard(path)
+        paths = self._paths[resource]
+        paths.discard(path)
+        if not paths:
+            del self._paths[resource]
+
+        for segment, child in resource.children.items():
+            self._remove_routes(path + (segment,), child)
+
+    def _walk(self, path):
+        """Resolve a path by walking the resource tree. Used for paths not present in the routing table.
+
+        Returns:
+            piccata.resource.CoapResource: A resource found, or None.
+        """
+        resource = self.root
+        for index, segment in enumerate(path):
+            if resource.is_leaf:
+                break
+            if type(resource).get_child is not CoapResource.get_child:
+                try:
+                    resource = resource.get_child(segment)
+                except NoResource:
+                    return None
+                continue
+            children = resource.children
+            child = children.get(segment)
+            if child is None:
+                child = children.get(WILDCARD)
+                if child is None:
+                    return None
+            resource = child
+        return resource
+
+    def child_updated(self, parent, path, previous, child):
+        """Update the routing table after a child of a resource has changed. Called by CoapResource.
+
+        Args:
+            parent (piccata.resource.CoapResource): A resource which children have changed.
+            path (bytes): A path of the child.
+            previous (piccata.resource.CoapResource): A child previously registered with the path. May be None.
+            child (piccata.resource.CoapResource): A child registered with the path. May be None if removed.
+        """
+        for parent_path in list(self._paths.get(parent, ())):
+            if previous is not None:
+                self._remove_routes(parent_path + (path,), previous)
+
+            if _is_dynamic(parent):
+                # Children added to dynamic resources are resolved by walking the tree.
+                self._dynamic.add(parent_path)
+            elif parent_path in self._dynamic:
+                self._dynamic.discard(parent_path)
+                for segment, sibling in parent.children.items():
+                    self._add_routes(parent_path + (segment,), sibling)
+            elif child is not None:
+                self._add_routes(parent_path + (path,), child)
+
+        if child is not None:
+            self._attach(child)
+
+    def find_resource(self, request):
+        """Find a resource for a request.
+
+        Static paths are resolved with a single routing table lookup. Paths matching WILDCARD children
+        take one more lookup for every distinct set of wildcard positions among routes of the same length.
+        Paths leading through leaf resources or resources with custom get_child are resolved by walking the tree.
+
+        Args:
+            request (piccata.message.Message) A request containing the Uri path to search for.
+
+        Returns:
+            piccata.resource.CoapResource: A resource found, or None if there is no such resource.
+        """
+        path = request.opt.get_uri_path_tuple()
+        resource = self._routes.get(path)
+        if resource is None:
+            for mask in self._masks.get(len(path), ()):
+                resource = self._routes.get(tuple([WILDCARD if wild else segment for segment, wild in zip(path, mask)]))
+                if resource is not None:
+                    return resource
+            if self._dynamic:
+                resource = self._walk(path)
+        return resource
+
     def get_resource_for(self, request):
         """Get a resource for a request.
 
-        This iterates through the resource hierarchy, calling get_child on each resource
-        it finds for a path element, stopping when it hits an element where is_leaf is true.
+        If no resource is found, NoResource exception is raised.
 
         Args:
             request (piccata.message.Message) A request containing the Uri path to search for.
         """
-        resource = self.root
-        postpath = request.opt.uri_path
-
-        while postpath and not resource.is_leaf:
-            pathElement = postpath.pop(0)
-            resource = resource.get_child(pathElement)
+        resource = self.find_resource(request)
+        if resource is None:
+            raise NoResource
         return resource
 
 
 class ResourceManager(object):
 
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, protocol=None, notification_type=NON, notification_rate=1000, notification_burst=100,
+                 cache_size=256, proxy=None):
         """Initialize the resource manager.
 
+        Resource observation (RFC 7641) is supported only if a protocol for sending notifications is given.
+        Representations of resources marked as cacheable are kept in a cache, so GET requests are
+        answered without rendering until the resource changes. Requests with Proxy-Uri or Proxy-Scheme
+        option are passed to the proxy, or answered with 5.05 Proxying Not Supported if there is none.
+
         Args:
             endpoint (piccata.resource.coapEndpoint): An endpoint containing the resource tree.
+            protocol (piccata.core.Coap): A protocol used to send notifications. Its clock is used for cache expiry.
+                May be None, then real time is used.
+            notification_type (int): A type of notifications (CON or NON).
+            notification_rate (float): A maximum number of notifications sent per second. May be None for no limit.
+            notification_burst (int): A number of notifications that may be sent at once before the rate applies.
+            cache_size (int): A maximum number of representations cached.
+            proxy (piccata.proxy.ProxyRequestHandler): A handler for proxied requests. May be None.
         """
         self.endpoint = endpoint
+        self.proxy = proxy
+        self.cache = cache.RepresentationCache(cache_size)
+        self.clock = protocol.clock if protocol is not None else RealTimeClock()
+        self.notifier = None
+        if protocol is not None:
+            self.notifier = observe.Notifier(protocol, notification_type, notification_rate, notification_burst)
+
+    def notify(self, resource):
+        """Send the current representation of a resource to all its observers.
+
+        Shall be called by the application whenever an observable resource changes. The resource
+        is rendered once for every distinct Accept option of its observers.
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource that has changed.
+        """
+        self.invalidate(resource)
+        if self.notifier is not None:
+            self.notifier.notify(resource)
+
+    def invalidate(self, resource):
+        """Drop cached representations of a resource.
+
+        Shall be called by the application whenever a cacheable resource changes and its observers
+        are not notified (notify invalidates the cache as well).
+
+        Args:
+            resource (piccata.resource.CoapResource): A resource that has changed.
+        """
+        self.cache.invalidate(resource)
+
+    def receive_reset(self, message):
+        """Function for handling RST messages not matching any CON message sent.
+
+        This function will be called by the CoAP object, e.g. when an observer rejects a NON notification.
+
+        Args:
+            message (piccata.message.Message): RST message received.
+        """
+        if self.notifier is not None:
+            self.notifier.receive_reset(message)
 
     def receive_request(self, request):
         """Function for handling requests.
@@ -152,14 +896,38 @@ class ResourceManager(object):
         """
         response = None
 
+        if request.opt.proxy_uri is not None or request.opt.proxy_scheme is not None:
+            if self.proxy is None:
+                return message.Message.AckMessage(request, code=PROXYING_NOT_SUPPORTED)
+            return self.proxy.receive_request(request)
+
+        resource = self.endpoint.find_resource(request)
+        if resource is None:
+            return message.Message.AckMessage(request, code=NOT_FOUND, payload=b"Error: Resource not found!")
+
+        cached = (resource.cacheable and request.code == GET and
+                  request.opt.observe is None and request.opt.block2 is None)
+        if cached:
+            response = self.cache.lookup(request, self.clock.now())
+            if response is not None:
+                return response
+
+        # Resources overriding render may still signal errors with exceptions.
         try:
-            resource = self.endpoint.get_resource_for(request)
             response = resource.render(request)
         except NoResource:
             response = message.Message.AckMessage(request, code=NOT_FOUND, payload=b"Error: Resource not found!")
         except UnallowedMethod:
-            response = message.Message.AckMessage(request, code=METHOD_NOT_ALLOWED, payload=b"Error: Method not allowed!")
+            response = _render_method_not_allowed(resource, request)
         except UnsupportedMethod:
-            response = message.Message.AckMessage(request, code=METHOD_NOT_ALLOWED, payload=b"Error: Method not recognized!")
+            response = _render_method_not_recognized(resource, request)
+
+        if cached:
+            response = self.cache.store(resource, request, response, self.clock.now())
+        elif resource.cacheable and request.code != GET:
+            self.cache.invalidate(resource)
+
+        if request.code == GET and request.opt.observe is not None and self.notifier is not None:
+            self.notifier.register(resource, request, response)
 
         return response
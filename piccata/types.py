@@ -7,6 +7,8 @@ Exception definitions and types for CoAP toolkit.
 
 import collections
 
+from ipaddress import IPv4Address, IPv6Address, ip_address
+
 class Error(Exception):
     """
     Base exception for all exceptions that indicate a failed request
@@ -67,10 +69,106 @@ class MissingBlock2Option(Error):
     but response without Block2 option is received.
     """
 
-Endpoint = collections.namedtuple('Endpoint', 'addr port')
-"""
+class Endpoint(collections.namedtuple('Endpoint', 'addr port')):
+    """
     A tuple conisting of an IP address and port number.
-"""
+
+    The hash is computed once, as hashing ipaddress objects is slow. It is equal to the hash
+    of a plain tuple with the same items, so both can be used to look up dictionary entries.
+    """
+
+    def __hash__(self):
+        try:
+            return self.__dict__['_hash']
+        except KeyError:
+            value = self.__dict__['_hash'] = tuple.__hash__(self)
+            return value
+
+
+class UnixAddress(str):
+    """A path of a Unix domain socket, used in place of an IP address in an Endpoint (with port 0).
+
+    It provides the attributes of IP addresses used by the protocol, so Coap handles Unix domain
+    socket peers like unicast IP peers. Paths starting with a null character are abstract addresses.
+    """
+
+    __slots__ = ()
+
+    is_multicast = False
+    is_unspecified = False
+    version = None
+
+    @property
+    def packed(self):
+        return self.encode('utf-8', 'surrogateescape')
+
+
+MAX_INTERNED_ENDPOINTS = 65536
+"""Default maximum number of endpoints kept by the endpoint function, enough for tens of thousands of peers
+seen under a few address forms (e.g. as received and as given by the application)."""
+
+_max_interned_endpoints = MAX_INTERNED_ENDPOINTS
+_interned_endpoints = {}  # canonical endpoints (identified by host and port as given)
+
+
+def set_max_interned_endpoints(count):
+    """Set the maximum number of endpoints kept by the endpoint function.
+
+    The limit shall exceed the number of peers exchanging messages at the same time (e.g. devices
+    and observers), otherwise endpoints are evicted and parsed again on the packet hot path.
+
+    Args:
+        count (int): A maximum number of endpoints.
+    """
+    global _max_interned_endpoints
+
+    if count < 1:
+        raise ValueError("At least one endpoint shall be kept")
+    _max_interned_endpoints = count
+    while len(_interned_endpoints) > count:
+        try:
+            del _interned_endpoints[next(iter(_interned_endpoints))]
+        except (KeyError, RuntimeError, StopIteration):
+            pass
+
+
+def endpoint(host, port):
+    """Get the canonical Endpoint of an address.
+
+    Repeated calls with the same address return the same object, so address parsing and hashing
+    are done once per peer rather than once per packet. IPv4-mapped IPv6 addresses are converted
+    to IPv4 addresses. Scope IDs (e.g. fe80::1%eth0) are kept, so link-local peers on different
+    interfaces are different endpoints and replies leave on the interface the peer was seen on.
+
+    Args:
+        host (str or bytes or ipaddress.IPv4Address or ipaddress.IPv6Address or piccata.types.UnixAddress): An IP
+            address, packed if given as bytes, or a Unix domain socket path.
+        port (int): A port number.
+
+    Returns:
+        piccata.types.Endpoint: An endpoint.
+    """
+    key = (host, port)
+    try:
+        return _interned_endpoints[key]
+    except KeyError:
+        pass
+
+    address = host
+    if not isinstance(address, (IPv4Address, IPv6Address, UnixAddress)):
+        address = ip_address(address)
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    result = Endpoint(address, port)
+
+    if len(_interned_endpoints) >= _max_interned_endpoints:
+        # Forget the oldest endpoint, it will be parsed again when needed.
+        try:
+            del _interned_endpoints[next(iter(_interned_endpoints))]
+        except (KeyError, RuntimeError, StopIteration):
+            pass
+    _interned_endpoints[key] = result
+    return result
 
 __all__ = ['Error',
            'NoResource',
@@ -78,7 +176,10 @@ __all__ = ['Error',
            'UnsupportedMethod',
            'NotImplemented',
            'RequestTimedOut',
-           'WaitingForClientTimedOut'
+           'WaitingForClientTimedOut',
            'ResourceChanged',
            'MissingBlock2Option',
-           'Endpoint']
+           'Endpoint',
+           'UnixAddress',
+           'endpoint',
+           'set_max_interned_endpoints']
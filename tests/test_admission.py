@@ -0,0 +1,110 @@
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from piccata import admission
+from piccata import core
+from piccata import message
+from piccata import resource
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+
+def create_request(mid=1000, block2=None):
+    req = message.Message(CON, mid, GET, b"", b"abcd")
+    req.opt.uri_path = (b"slow", )
+    if block2 is not None:
+        req.opt.block2 = block2
+    req.remote = TEST_REMOTE
+    return req
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_controller_shall_shed_requests_over_pending_limit(self):
+        controller = admission.AdmissionController(max_pending=1)
+        self.assertTrue(controller.admit(create_request(), now=0))
+        self.assertFalse(controller.admit(create_request(), now=0))
+        controller.finished(0, now=0.1)
+        self.assertTrue(controller.admit(create_request(), now=0.1))
+        self.assertEqual(controller.stats()['shed_pending'], 1)
+
+    def test_controller_shall_admit_block_continuations(self):
+        controller = admission.AdmissionController(max_pending=1)
+        controller.admit(create_request(), now=0)
+        self.assertFalse(controller.admit(create_request(block2=(0, False, 2)), now=0))
+        self.assertTrue(controller.admit(create_request(block2=(1, False, 2)), now=0))
+
+    def test_controller_shall_shed_slow_load_and_probe_after_retry_period(self):
+        controller = admission.AdmissionController(max_latency=0.5, retry_after=2, smoothing=1)
+        controller.admit(create_request(), now=0)
+        controller.finished(0, now=1)
+        self.assertFalse(controller.admit(create_request(), now=2))
+        self.assertTrue(controller.admit(create_request(), now=3.5))
+
+        rsp = controller.reject(create_request())
+        self.assertEqual(rsp.code, SERVICE_UNAVAILABLE)
+        self.assertEqual(rsp.opt.max_age, 2)
+
+class TestCoapAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = tester.TesterTransport()
+        self.executor = None
+
+    def tearDown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def create_protocol(self, controller, handler, executor=None):
+        protocol = core.Coap(self.transport, executor=executor, admission=controller)
+        self.transport.register_receiver(protocol)
+        protocol.register_request_handler(handler)
+        return protocol
+
+    def receive(self, mid):
+        req = create_request(mid)
+        self.transport._receive(req.encode(), TEST_REMOTE, (ip_address(u"10.10.10.10"), 5683))
+
+    def test_coap_shall_reject_requests_not_admitted(self):
+        controller = admission.AdmissionController(max_pending=1)
+        self.create_protocol(controller, resource.ResourceManager(resource.CoapEndpoint(resource.CoapResource())))
+        controller.admit(create_request())
+        self.receive(1000)
+        self.assertEqual(message.Message.decode(self.transport.tester_data).code, SERVICE_UNAVAILABLE)
+
+        controller.finished(time.monotonic())
+        self.receive(1001)
+        self.assertEqual(message.Message.decode(self.transport.tester_data).code, NOT_FOUND)
+        self.assertEqual(controller.pending, 0)
+
+    def test_coap_shall_bound_queue_of_executor_and_measure_latency_from_arrival(self):
+        handled = []
+
+        class SlowHandler(object):
+
+            def receive_request(self, request):
+                time.sleep(0.05)
+                handled.append(request.mid)
+                return message.Message.AckMessage(request, code=CONTENT)
+
+        controller = admission.AdmissionController(max_pending=2, max_latency=None, smoothing=1)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.create_protocol(controller, SlowHandler(), self.executor)
+
+        for mid in (1000, 1001, 1002):
+            self.receive(mid)
+        # The third request is shed at once, while the second one waits for the executor.
+        self.assertEqual(message.Message.decode(self.transport.tester_data).code, SERVICE_UNAVAILABLE)
+        self.assertEqual(controller.stats()['shed_pending'], 1)
+
+        self.executor.shutdown()
+        self.assertEqual(handled, [1000, 1001])
+        self.assertEqual(controller.pending, 0)
+        self.assertGreaterEqual(controller.latency, 0.09)
+
+if __name__ == "__main__":
+    unittest.main()
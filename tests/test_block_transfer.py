@@ -0,0 +1,100 @@
+import unittest
+
+from piccata import block_transfer
+from piccata import core
+from piccata import message
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+
+class TestBlockRequests(unittest.TestCase):
+
+    def test_block_1_request_shall_carry_requested_block(self):
+        req = block_transfer.create_block_1_request(b"a" * 100, 1, (b"test", ), size_exp=1)
+        self.assertEqual(req.payload, b"a" * 32)
+        self.assertEqual(req.opt.block1, (1, True, 1))
+
+    def test_block_2_response_shall_rescale_block_number_to_smaller_size(self):
+        req = block_transfer.create_block_2_request(1, (b"test", ), size_exp=3)
+        rsp = block_transfer.create_block_2_response(bytes(range(256)), req, size_exp=2)
+        self.assertEqual(rsp.opt.block2, (2, True, 2))
+        self.assertEqual(rsp.payload, bytes(range(128, 192)))
+
+class TestBlockSizeController(unittest.TestCase):
+
+    def exchange(self, controller, retransmissions, result=RESULT_SUCCESS):
+        msg = message.Message(CON, 0, GET)
+        msg.remote = TEST_REMOTE
+        controller.exchange_completed(msg, result, retransmissions)
+
+    def test_controller_shall_limit_block_size_to_mtu(self):
+        controller = block_transfer.BlockSizeController(mtu=256, initial_size_exp=MAX_BLOCK_SIZE_EXP)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), 3)
+
+    def test_controller_shall_limit_block_size_to_negotiated_one(self):
+        controller = block_transfer.BlockSizeController(initial_size_exp=5)
+        rsp = message.Message(ACK, 0, CONTENT)
+        rsp.remote = TEST_REMOTE
+        rsp.opt.block2 = (0, True, 3)
+        controller.update_from_response(rsp)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), 3)
+
+        for _ in range(20):
+            self.exchange(controller, 0)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), 3)
+
+    def test_controller_shall_grow_on_clean_link_and_shrink_on_loss(self):
+        controller = block_transfer.BlockSizeController(grow_after=2)
+        for _ in range(4):
+            self.exchange(controller, 0)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), DEFAULT_BLOCK_SIZE_EXP + 2)
+
+        self.exchange(controller, 2)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), DEFAULT_BLOCK_SIZE_EXP + 2)
+        self.exchange(controller, 2)
+        self.assertEqual(controller.size_exp(TEST_REMOTE), DEFAULT_BLOCK_SIZE_EXP + 1)
+
+        stats = controller.stats()
+        self.assertEqual(stats['peers'][TEST_REMOTE]['block_size'], 128)
+        self.assertEqual(stats['chosen'], {256: 2, 128: 1})
+
+    def test_controller_shall_forget_least_recently_used_peers(self):
+        controller = block_transfer.BlockSizeController(max_peers=2)
+        remotes = [(ip_address(u"12.34.56.%d" % i), 5683) for i in range(3)]
+        for remote in remotes:
+            controller.size_exp(remote)
+        self.assertEqual(list(controller.stats()['peers']), remotes[1:])
+
+    def test_controller_shall_count_transaction_timeout_as_loss(self):
+        protocol = core.Coap(tester.TesterTransport())
+        controller = block_transfer.BlockSizeController()
+        protocol.register_exchange_listener(controller)
+        req = block_transfer.create_block_2_request(0, (b"test", ), controller=controller, remote=TEST_REMOTE)
+        protocol.request(req)
+        protocol._transaction_layer._timeout_transaction(req)
+
+        peer = controller.stats()['peers'][TEST_REMOTE]
+        self.assertEqual(peer['exchanges'], 1)
+        self.assertEqual(peer['loss_rate'], controller.smoothing)
+
+    def test_block_helpers_shall_use_block_size_chosen_by_controller(self):
+        controller = block_transfer.BlockSizeController(initial_size_exp=4)
+        req = block_transfer.create_block_2_request(8, (b"test", ), size_exp=2, controller=controller, remote=TEST_REMOTE)
+        self.assertEqual(req.opt.block2, (2, False, 4))
+        self.assertEqual(req.remote, TEST_REMOTE)
+
+        # The block is not aligned to the larger size, so its size is kept.
+        req = block_transfer.create_block_1_request(b"a" * 1024, 3, (b"test", ), size_exp=2,
+                                                    controller=controller, remote=TEST_REMOTE)
+        self.assertEqual(req.opt.block1, (3, True, 2))
+
+        req = block_transfer.create_block_2_request(0, (b"test", ), size_exp=6)
+        req.remote = TEST_REMOTE
+        rsp = block_transfer.create_block_2_response(b"a" * 1024, req, controller=controller)
+        self.assertEqual(rsp.opt.block2, (0, True, 4))
+
+if __name__ == "__main__":
+    unittest.main()
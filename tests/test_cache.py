@@ -0,0 +1,136 @@
+import unittest
+
+from piccata import cache
+from piccata import core
+from piccata import message
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+TEST_LOCAL = (ip_address(u"10.10.10.10"), 20000)
+TEST_TOKEN = b"abcd"
+TEST_ETAG = b"\x01\x02"
+
+def create_request(path=(b"sensor", ), mid=1000):
+    req = message.Message(CON, mid, GET, b"", TEST_TOKEN)
+    req.opt.uri_path = path
+    req.remote = TEST_REMOTE
+    return req
+
+def create_response(code=CONTENT, payload=b"21.5", max_age=None, etag=TEST_ETAG, mid=1000):
+    rsp = message.Message(ACK, mid, code, payload, TEST_TOKEN)
+    rsp.opt.max_age = max_age
+    rsp.opt.etag = etag
+    return rsp
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.ResponseCache(max_entries=2)
+
+    def test_cache_shall_serve_fresh_response_within_max_age(self):
+        key = cache.cache_key(create_request())
+        self.cache.store(key, create_response(max_age=10), now=0)
+        self.assertEqual(self.cache.lookup(key, now=5)[1], True)
+        self.assertEqual(self.cache.lookup(key, now=11)[1], False)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_cache_shall_return_copy_of_stored_response(self):
+        key = cache.cache_key(create_request())
+        self.cache.store(key, create_response(max_age=10), now=0)
+        response = self.cache.lookup(key, now=0)[0]
+        response.mid = 2000
+        response.token = b"wxyz"
+        response.opt.max_age = 3
+        response.opt.etag = b"\x03"
+
+        response = self.cache.lookup(key, now=0)[0]
+        self.assertEqual(response.mid, 1000)
+        self.assertEqual(response.token, TEST_TOKEN)
+        self.assertEqual(response.opt.max_age, 10)
+        self.assertEqual(response.opt.etag, TEST_ETAG)
+
+        revalidated = self.cache.revalidated(key, create_response(code=VALID, max_age=10), now=20)
+        revalidated.opt.etag = b"\x03"
+        self.assertEqual(self.cache.lookup(key, now=20)[0].opt.etag, TEST_ETAG)
+
+    def test_cache_shall_distinguish_query_and_accept(self):
+        req = create_request()
+        key = cache.cache_key(req)
+        req.opt.accept = 50
+        self.assertNotEqual(cache.cache_key(req), key)
+        req.opt.accept = None
+        req.opt.uri_query = (b"unit=C", )
+        self.assertNotEqual(cache.cache_key(req), key)
+
+    def test_cache_shall_evict_least_recently_used_entry(self):
+        keys = [cache.cache_key(create_request((str(i).encode(), ))) for i in range(3)]
+        self.cache.store(keys[0], create_response(), now=0)
+        self.cache.store(keys[1], create_response(), now=0)
+        self.cache.lookup(keys[0], now=0)
+        self.cache.store(keys[2], create_response(), now=0)
+        self.assertEqual(self.cache.lookup(keys[1], now=0), (None, False))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_cache_shall_drop_stale_response_without_etag(self):
+        key = cache.cache_key(create_request())
+        self.cache.store(key, create_response(max_age=0, etag=None), now=0)
+        self.assertEqual(self.cache.lookup(key, now=1), (None, False))
+        self.assertEqual(len(self.cache), 0)
+
+class TestCoapWithCache(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = tester.TesterTransport()
+        self.cache = cache.ResponseCache()
+        self.protocol = core.Coap(self.transport, response_cache=self.cache)
+        self.transport.register_receiver(self.protocol)
+        self.transport.open()
+        self.responses = []
+
+    def tearDown(self):
+        self.transport.close()
+
+    def callback(self, result, request, response):
+        self.responses.append((result, response.code, response.payload))
+
+    def test_coap_shall_answer_fresh_request_from_cache(self):
+        self.protocol.request(create_request(mid=1000), self.callback)
+        self.transport._receive(create_response(mid=1000).encode(), TEST_REMOTE, TEST_LOCAL)
+        self.protocol.request(create_request(mid=1001), self.callback)
+        self.assertEqual(self.transport.output_count, 1)
+        self.assertEqual(self.responses, [(RESULT_SUCCESS, CONTENT, b"21.5")] * 2)
+
+    def test_coap_shall_revalidate_stale_response_with_etag(self):
+        self.protocol.request(create_request(mid=1000), self.callback)
+        self.transport._receive(create_response(max_age=0, mid=1000).encode(), TEST_REMOTE, TEST_LOCAL)
+
+        self.protocol.request(create_request(mid=1001), self.callback)
+        self.assertEqual(self.transport.output_count, 2)
+        revalidation = message.Message.decode(self.transport.tester_data)
+        self.assertEqual(revalidation.opt.etags, [TEST_ETAG])
+
+        self.transport._receive(create_response(VALID, b"", mid=1001).encode(), TEST_REMOTE, TEST_LOCAL)
+        self.assertEqual(self.responses[1], (RESULT_SUCCESS, CONTENT, b"21.5"))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_coap_shall_fetch_again_when_revalidated_response_was_evicted(self):
+        self.protocol.request(create_request(mid=1000), self.callback)
+        self.transport._receive(create_response(max_age=0, mid=1000).encode(), TEST_REMOTE, TEST_LOCAL)
+
+        self.protocol.request(create_request(mid=1001), self.callback)
+        self.cache.clear()
+        self.transport._receive(create_response(VALID, b"", mid=1001).encode(), TEST_REMOTE, TEST_LOCAL)
+        self.assertEqual(len(self.responses), 1)
+        self.assertEqual(self.transport.output_count, 3)
+        refetch = message.Message.decode(self.transport.tester_data)
+        self.assertEqual(refetch.opt.etags, [])
+
+        self.transport._receive(create_response(payload=b"22.0", mid=refetch.mid).encode(), TEST_REMOTE, TEST_LOCAL)
+        self.assertEqual(self.responses[1], (RESULT_SUCCESS, CONTENT, b"22.0"))
+        self.assertEqual(len(self.cache), 1)
+
+if __name__ == "__main__":
+    unittest.main()
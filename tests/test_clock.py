@@ -0,0 +1,39 @@
+import unittest
+
+from piccata import clock
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        self.calls = []
+
+    def test_clock_shall_call_functions_in_order_of_their_time(self):
+        self.clock.call_later(2, self.calls.append, "second")
+        self.clock.call_later(1, self.calls.append, "first")
+        self.clock.call_later(2, self.calls.append, "third")
+
+        self.assertEqual(self.clock.run(), 3)
+        self.assertEqual(self.calls, ["first", "second", "third"])
+        self.assertEqual(self.clock.now(), 2)
+
+    def test_clock_shall_advance_by_duration_only(self):
+        self.clock.call_later(1, self.calls.append, "early")
+        self.clock.call_later(5, self.calls.append, "late")
+
+        self.clock.run(3)
+        self.assertEqual(self.calls, ["early"])
+        self.assertEqual(self.clock.now(), 3)
+
+    def test_clock_shall_not_call_cancelled_functions(self):
+        timer = self.clock.call_later(1, self.calls.append, "cancelled")
+        timer.cancel()
+        self.clock.run()
+        self.assertEqual(self.calls, [])
+
+    def test_functions_scheduled_while_running_shall_be_called(self):
+        self.clock.call_later(1, lambda: self.clock.call_later(1, self.calls.append, self.clock.now()))
+        self.clock.run()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.clock.now(), 2)
@@ -1,7 +1,11 @@
+import threading
 import unittest
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
 from piccata import core
+from piccata import group
 from piccata import message
 from piccata import resource
 from piccata.constants import *
@@ -170,6 +174,23 @@ class TestCoapSendResponsePath(TestCoap):
         # Validate that response was handled properly
         self.assertInRetransmissionList(self.rsp)
 
+    def test_coap_core_shall_retransmit_CON_response_from_address_request_was_received_on(self):
+        sources = []
+
+        def send(data, dest, source=None):
+            sources.append(source)
+
+        self.transport.source_selection = True
+        self.transport.send = send
+        self.rsp = message.Message(CON, TEST_MID + 1, CONTENT, b"", TEST_TOKEN)
+        req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        req.opt.uri_path = (b"test", )
+        self.transport._receive(req.encode(), (TEST_ADDRESS, TEST_PORT), (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+
+        self.protocol._message_layer._retransmit(TEST_MID + 1, ACK_TIMEOUT, 0)
+        self.protocol._message_layer.cancel_retransmission(TEST_MID + 1)
+        self.assertEqual(sources, [(TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT)] * 2)
+
     def test_coap_core_shall_not_queue_NON_response_on_retransmission_list(self):
 
         self.rsp = message.Message(NON, TEST_MID + 1, CONTENT, b"", TEST_TOKEN)
@@ -405,6 +426,39 @@ class TestCoapReceiveResponsePath(TestCoap):
         time.sleep(0.6)
         self.assertEqual(self.responseResult, RESULT_TIMEOUT)
 
+    def test_coap_core_shall_inform_exchange_listener_when_CON_is_acknowledged(self):
+        completed = []
+
+        class Listener:
+            def exchange_completed(self, message, result, retransmissions):
+                completed.append((message, result, retransmissions))
+
+        remote = (TEST_ADDRESS, TEST_PORT)
+        self.protocol.register_exchange_listener(Listener())
+        self.send_initial_request(remote)
+        self.receive_ack_response(remote)
+        self.assertEqual(completed, [(self.req, RESULT_SUCCESS, 0)])
+
+    def test_coap_core_shall_match_responses_from_any_address_to_multicast_request(self):
+        group = (ip_address(u"224.0.1.187"), COAP_PORT)
+        req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        req.remote = group
+        self.protocol.request(req, self.callback)
+
+        for address in (u"12.34.56.78", u"12.34.56.79"):
+            rsp = message.Message(NON, TEST_MID + 1, CONTENT, TEST_PAYLOAD, TEST_TOKEN)
+            self.transport._receive(rsp.encode(), (ip_address(address), TEST_PORT), (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(self.callbackCounter, 2)
+        self.assertEqual(self.responseResult, RESULT_SUCCESS)
+
+    def test_coap_core_shall_reset_response_with_unknown_token(self):
+        remote = (TEST_ADDRESS, TEST_PORT)
+        self.send_initial_request(remote)
+        rsp = message.Message(CON, TEST_MID + 1, CONTENT, TEST_PAYLOAD, b"dcba")
+        self.transport._receive(rsp.encode(), remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(self.transport.tester_data, message.Message(RST, TEST_MID + 1, EMPTY).encode())
+        self.assertIsNone(self.responseResult)
+
     def test_coap_core_shall_resend_ACK_on_duplicated_CON_response(self):
         # Send initial request.
         remote = (TEST_ADDRESS, TEST_PORT)
@@ -429,5 +483,325 @@ class TestCoapReceiveResponsePath(TestCoap):
         self.assertEqual(self.transport.tester_data, raw_empty_ack)
         self.assertEqual(self.callbackCounter, 1)
 
+class TestCoapGroupRequest(TestCoap):
+
+    TEST_GROUP = (ip_address(u"224.0.1.187"), COAP_PORT)
+
+    def group_callback(self, result, request, responses):
+        self.responseResult = result
+        self.responses = responses
+        self.callbackCounter += 1
+
+    def send_group_request(self, window=0.2, max_responses=None):
+        self.req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        self.req.remote = self.TEST_GROUP
+        return self.protocol.group_request(self.req, self.group_callback, window, max_responses)
+
+    def receive_response(self, address, mid):
+        rsp = message.Message(NON, mid, CONTENT, TEST_PAYLOAD, TEST_TOKEN)
+        self.transport._receive(rsp.encode(), (ip_address(address), TEST_PORT), (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+
+    def test_coap_core_shall_aggregate_group_responses_per_responder(self):
+        exchange = self.send_group_request()
+        self.receive_response(u"12.34.56.78", TEST_MID + 1)
+        self.receive_response(u"12.34.56.79", TEST_MID + 2)
+        self.receive_response(u"12.34.56.78", TEST_MID + 3)
+        self.assertEqual(self.callbackCounter, 0)
+
+        time.sleep(0.3)
+        self.assertEqual(self.callbackCounter, 1)
+        self.assertEqual(self.responseResult, RESULT_SUCCESS)
+        self.assertEqual([remote[0] for remote in self.responses],
+                         [ip_address(u"12.34.56.78"), ip_address(u"12.34.56.79")])
+        self.assertEqual(exchange.duplicates, 1)
+        self.assertNotIn((TEST_TOKEN, self.TEST_GROUP), self.protocol._transaction_layer._outgoing_requests)
+
+    def test_coap_core_shall_finish_group_request_early_when_all_expected_responders_answered(self):
+        self.send_group_request(window=10, max_responses=2)
+        self.receive_response(u"12.34.56.78", TEST_MID + 1)
+        self.receive_response(u"12.34.56.79", TEST_MID + 2)
+        self.assertEqual(self.callbackCounter, 1)
+        self.assertEqual(self.responseResult, RESULT_SUCCESS)
+        self.assertEqual(len(self.responses), 2)
+
+    def test_coap_core_shall_report_timeout_when_no_group_member_responded(self):
+        self.send_group_request(window=0.1)
+        time.sleep(0.2)
+        self.assertEqual(self.responseResult, RESULT_TIMEOUT)
+        self.assertEqual(len(self.responses), 0)
+
+    def test_coap_core_shall_generate_distinct_tokens_for_group_requests_without_token(self):
+        exchanges = []
+        for mid in (TEST_MID, TEST_MID + 1):
+            req = message.Message(NON, mid, GET)
+            req.remote = self.TEST_GROUP
+            exchanges.append(self.protocol.group_request(req, self.group_callback, 0.2))
+        tokens = [exchange.request.token for exchange in exchanges]
+        self.assertTrue(all(tokens))
+        self.assertNotEqual(tokens[0], tokens[1])
+
+        rsp = message.Message(NON, TEST_MID + 2, CONTENT, TEST_PAYLOAD, tokens[0])
+        self.transport._receive(rsp.encode(), (ip_address(u"12.34.56.78"), TEST_PORT), (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(len(exchanges[0]), 1)
+        self.assertEqual(len(exchanges[1]), 0)
+
+        # A response with an empty token does not belong to any group request.
+        rsp = message.Message(NON, TEST_MID + 3, CONTENT, TEST_PAYLOAD, b"")
+        self.transport._receive(rsp.encode(), (ip_address(u"12.34.56.79"), TEST_PORT), (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual([len(exchange) for exchange in exchanges], [1, 0])
+
+    def test_coap_core_shall_reject_group_request_to_unicast_address(self):
+        req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        req.remote = (TEST_ADDRESS, TEST_PORT)
+        with self.assertRaises(ValueError):
+            self.protocol.group_request(req, self.group_callback)
+
+class TestCoapMulticastServer(TestCoap):
+
+    TEST_GROUP = (ip_address(u"224.0.1.187"), COAP_PORT)
+
+    def setUp(self):
+        TestCoap.setUp(self)
+        self.protocol._transaction_layer.leisure = 0.2
+
+    def receive_group_request(self, path=b"test"):
+        req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        req.opt.uri_path = (path, )
+        self.transport._receive(req.encode(), (TEST_ADDRESS, TEST_PORT), self.TEST_GROUP)
+
+    def test_coap_core_shall_delay_response_to_multicast_request(self):
+        self.test_resource.resource_handler = lambda request: message.Message.AckMessage(request, CONTENT, TEST_PAYLOAD)
+        self.receive_group_request()
+        self.assertEqual(self.test_resource.call_counter, 1)
+
+        time.sleep(0.3)
+        self.assertEqual(self.transport.output_count, 1)
+        rsp = message.Message.decode(self.transport.tester_data)
+        self.assertEqual(rsp.mtype, NON)
+        self.assertEqual(rsp.code, CONTENT)
+        self.assertEqual(rsp.token, TEST_TOKEN)
+
+    def test_coap_core_shall_suppress_error_response_to_multicast_request(self):
+        self.receive_group_request(b"missing")
+        time.sleep(0.3)
+        self.assertEqual(self.transport.output_count, 0)
+
+    def test_coap_core_shall_not_reset_multicast_request_without_request_handler(self):
+        self.protocol.remove_request_handler(self.request_handler)
+        self.receive_group_request()
+        self.assertEqual(self.transport.output_count, 0)
+
+    def test_leisure_shall_scale_with_group_size(self):
+        self.assertAlmostEqual(group.leisure(100, 100, 1000), 10.0)
+        self.assertAlmostEqual(group.leisure(200, 100, 1000), 20.0)
+
+class TestCoapCoalescing(TestCoap):
+
+    def setUp(self):
+        TestCoap.setUp(self)
+        self.protocol.coalesce_requests = True
+        self.remote = (TEST_ADDRESS, TEST_PORT)
+        self.results = []
+
+    def send_request(self, mid, token, etags=()):
+        req = message.Message(CON, mid, GET, b"", token)
+        req.opt.uri_path = (b"test", )
+        req.opt.etags = list(etags)
+        req.remote = self.remote
+        self.protocol.request(req, self.collecting_callback)
+        return req
+
+    def collecting_callback(self, result, request, response):
+        self.results.append((result, request.token, response.payload if response is not None else None))
+
+    def test_coap_core_shall_send_identical_GET_requests_once(self):
+        self.send_request(TEST_MID, b"t1")
+        self.send_request(TEST_MID + 1, b"t2")
+        self.assertEqual(self.transport.output_count, 1)
+
+        rsp = message.Message(ACK, TEST_MID, CONTENT, TEST_PAYLOAD, b"t1")
+        self.transport._receive(rsp.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(self.results, [(RESULT_SUCCESS, b"t1", TEST_PAYLOAD), (RESULT_SUCCESS, b"t2", TEST_PAYLOAD)])
+
+        # Once the response is received, a new request goes to the wire.
+        self.send_request(TEST_MID + 2, b"t3")
+        self.assertEqual(self.transport.output_count, 2)
+
+    def test_coap_core_shall_not_coalesce_requests_with_different_etags(self):
+        self.send_request(TEST_MID, b"t1", [b"e1"])
+        self.send_request(TEST_MID + 1, b"t2")
+        self.send_request(TEST_MID + 2, b"t3", [b"e1"])
+        self.assertEqual(self.transport.output_count, 2)
+
+        rsp = message.Message(ACK, TEST_MID, VALID, b"", b"t1")
+        self.transport._receive(rsp.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(self.results, [(RESULT_SUCCESS, b"t1", b""), (RESULT_SUCCESS, b"t3", b"")])
+
+        rsp = message.Message(ACK, TEST_MID + 1, CONTENT, TEST_PAYLOAD, b"t2")
+        self.transport._receive(rsp.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+        self.assertEqual(self.results[2], (RESULT_SUCCESS, b"t2", TEST_PAYLOAD))
+
+    def test_coap_core_shall_keep_coalesced_exchange_until_last_request_is_cancelled(self):
+        first = self.send_request(TEST_MID, b"t1")
+        second = self.send_request(TEST_MID + 1, b"t2")
+
+        self.protocol.cancel_request(first)
+        self.assertEqual(self.results, [(RESULT_CANCELLED, b"t1", None)])
+        self.assertInRetransmissionList(first)
+
+        self.protocol.cancel_request(second)
+        self.assertEqual(self.results[1], (RESULT_CANCELLED, b"t2", None))
+        self.assertNotInRetransmissionList(first.mid)
+
+class TestCoapExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.transport = tester.TesterTransport()
+        self.protocol = core.Coap(self.transport, executor=self.executor)
+        self.transport.register_receiver(self.protocol)
+        self.protocol.register_request_handler(self)
+        self.release = threading.Event()
+        self.handled = threading.Event()
+        self.remote = (TEST_ADDRESS, TEST_PORT)
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def receive_request(self, request):
+        self.release.wait(1)
+        return message.Message.AckMessage(request, CONTENT, TEST_PAYLOAD)
+
+    def send_request(self):
+        req = message.Message(CON, TEST_MID, GET, b"", TEST_TOKEN)
+        self.transport._receive(req.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+
+    def wait_for_output(self, count):
+        deadline = time.monotonic() + 1
+        while self.transport.output_count < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_coap_core_shall_piggyback_response_of_fast_handler(self):
+        self.release.set()
+        self.send_request()
+        self.wait_for_output(1)
+        rsp = message.Message.decode(self.transport.tester_data)
+        self.assertEqual((rsp.mtype, rsp.mid, rsp.code), (ACK, TEST_MID, CONTENT))
+
+    def test_coap_core_shall_acknowledge_slow_request_and_respond_separately(self):
+        self.send_request()
+        self.wait_for_output(1)
+        self.assertEqual(self.transport.tester_data, message.Message(ACK, TEST_MID, EMPTY).encode())
+
+        self.release.set()
+        self.wait_for_output(2)
+        rsp = message.Message.decode(self.transport.tester_data)
+        self.assertEqual((rsp.mtype, rsp.code, rsp.token, rsp.payload), (CON, CONTENT, TEST_TOKEN, TEST_PAYLOAD))
+
+    def test_coap_core_shall_call_callbacks_of_a_token_in_order(self):
+        results = []
+
+        def callback(result, request, response):
+            time.sleep(0.001)
+            results.append(response.payload)
+            if len(results) == 20:
+                self.handled.set()
+
+        req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        req.remote = self.remote
+        self.protocol.observe(req, callback)
+        for i in range(20):
+            rsp = message.Message(NON, 2000 + i, CONTENT, bytes([i]), TEST_TOKEN)
+            rsp.opt.observe = i + 1
+            self.transport._receive(rsp.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+
+        self.assertTrue(self.handled.wait(1))
+        self.assertEqual(results, [bytes([i]) for i in range(20)])
+
+    def test_coap_core_shall_allocate_distinct_message_ids_to_concurrent_senders(self):
+        message_layer = self.protocol._message_layer
+        start = threading.Barrier(4)
+
+        def send(count):
+            start.wait()
+            mids = []
+            for _ in range(count):
+                msg = message.Message(CON, None, GET, b"", TEST_TOKEN)
+                msg.remote = self.remote
+                message_layer.send_message(msg)
+                mids.append(msg.mid)
+            return mids
+
+        futures = [self.executor.submit(send, 200) for _ in range(4)]
+        mids = [mid for future in futures for mid in future.result()]
+        try:
+            self.assertEqual(len(set(mids)), len(mids))
+            self.assertEqual(len(message_layer._active_exchanges), len(mids))
+        finally:
+            for mid in mids:
+                message_layer.cancel_retransmission(mid)
+
+class TestCoapObservePath(TestCoap):
+
+    def setUp(self):
+        TestCoap.setUp(self)
+        self.notifications = []
+        self.remote = (TEST_ADDRESS, TEST_PORT)
+        self.req = message.Message(NON, TEST_MID, GET, b"", TEST_TOKEN)
+        self.req.remote = self.remote
+        self.subscription = self.protocol.observe(self.req, self.notification_callback)
+
+    def tearDown(self):
+        self.protocol.cancel_observation(self.subscription, deregister=False)
+        TestCoap.tearDown(self)
+
+    def notification_callback(self, result, request, response):
+        self.notifications.append((result, response.payload if response is not None else None))
+
+    def receive_notification(self, mid, observe, payload, max_age=None):
+        rsp = message.Message(NON, mid, CONTENT, payload, TEST_TOKEN)
+        rsp.opt.observe = observe
+        rsp.opt.max_age = max_age
+        self.transport._receive(rsp.encode(), self.remote, (TEST_LOCAL_ADDRESS, TEST_LOCAL_PORT))
+
+    def test_coap_core_shall_send_observe_registration(self):
+        self.assertEqual(self.req.opt.observe, 0)
+        self.assertMessageInTransport(self.req, self.remote, 1)
+
+    def test_coap_core_shall_deliver_notifications_in_order_and_drop_reordered_ones(self):
+        self.receive_notification(2000, 5, b"a")
+        self.receive_notification(2001, 7, b"b")
+        self.receive_notification(2002, 6, b"old")
+        self.receive_notification(2003, 0, b"wrapped")  # 0 is newer than 7 only after 2^23 wrap-around
+        self.assertEqual(self.notifications, [(RESULT_SUCCESS, b"a"), (RESULT_SUCCESS, b"b")])
+
+    def test_coap_core_shall_end_observation_on_response_without_observe_option(self):
+        self.receive_notification(2000, None, b"plain")
+        self.assertEqual(len(self.protocol._transaction_layer.subscriptions), 0)
+
+        # Further notifications are not recognized and rejected.
+        self.receive_notification(2001, 1, b"late")
+        self.assertEqual(self.notifications, [(RESULT_SUCCESS, b"plain")])
+        self.assertMessageInTransport(message.Message(RST, 2001, EMPTY), self.remote, 2)
+
+    def test_coap_core_shall_deregister_observation_on_cancel(self):
+        self.protocol.cancel_observation(self.subscription)
+        self.assertEqual(self.transport.output_count, 2)
+        deregistration = message.Message.decode(self.transport.tester_data)
+        self.assertEqual(deregistration.token, TEST_TOKEN)
+        self.assertEqual(deregistration.opt.observe, 1)
+        self.assertEqual(self.req.opt.observe, 0)
+
+    def test_coap_core_shall_reregister_observation_if_notifications_are_not_fresh(self):
+        self.protocol._transaction_layer.subscriptions.jitter = 0
+        self.receive_notification(2000, 1, b"a", max_age=0)
+        time.sleep(0.2)
+        self.assertEqual(self.notifications, [(RESULT_SUCCESS, b"a"), (RESULT_TIMEOUT, None)])
+        self.assertEqual(self.transport.output_count, 2)
+        registration = message.Message.decode(self.transport.tester_data)
+        self.assertEqual(registration.token, TEST_TOKEN)
+        self.assertEqual(registration.opt.observe, 0)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
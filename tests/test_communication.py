@@ -3,6 +3,7 @@ from piccata import core
 from piccata import message
 from piccata import resource
 from transport import tsocket
+from transport import virtual
 
 from ipaddress import ip_address
 import sys
@@ -79,5 +80,130 @@ class TestClientServerCommunication(unittest.TestCase):
         self.assertTrue(self.responseReceived)
         self.assertEqual(self.responsePayload, PAYLOAD)
 
+class TestVirtualNetworkCommunication(unittest.TestCase):
+
+    CLIENTS = 100
+
+    def setUp(self):
+        self.network = virtual.VirtualNetwork(seed=1, profile=virtual.LinkProfile(latency=0.05, jitter=0.01))
+
+        server_root = resource.CoapResource()
+        server_root.put_child(b'text', TextResource())
+        self.server_transport = virtual.VirtualTransport(self.network, u"10.0.0.1", SERVER_PORT)
+        self.server_protocol = core.Coap(self.server_transport, clock=self.network.clock)
+        self.server_transport.register_receiver(self.server_protocol)
+        self.server_protocol.register_request_handler(resource.ResourceManager(resource.CoapEndpoint(server_root),
+                                                                               self.server_protocol))
+        self.server_transport.open()
+
+        self.client_transports = []
+        self.client_protocols = []
+        for i in range(self.CLIENTS):
+            client_transport = virtual.VirtualTransport(self.network, u"10.1.%d.%d" % (i // 250, i % 250 + 1))
+            client_protocol = core.Coap(client_transport, clock=self.network.clock)
+            client_transport.register_receiver(client_protocol)
+            client_transport.open()
+            self.client_transports.append(client_transport)
+            self.client_protocols.append(client_protocol)
+
+        self.responses = []
+
+    def tearDown(self):
+        for client_transport in self.client_transports:
+            client_transport.close()
+        self.server_transport.close()
+
+    def _handle_text_response(self, result, request, response):
+        self.responses.append((result, response.payload if response is not None else None))
+
+    def test_clients_shall_receive_responses_over_virtual_network(self):
+        for client_protocol in self.client_protocols:
+            request = message.Message(mtype=CON, code=GET)
+            request.opt.uri_path = (b"text", )
+            request.remote = (ip_address(u"10.0.0.1"), SERVER_PORT)
+            client_protocol.request(request, self._handle_text_response)
+
+        self.network.run()
+        self.assertEqual(self.responses, [(RESULT_SUCCESS, PAYLOAD)] * self.CLIENTS)
+        self.assertEqual(self.network.stats()['delivered'], 2 * self.CLIENTS)
+        self.assertLess(self.network.now, 0.2)
+
+    def test_request_to_unreachable_server_shall_time_out_in_virtual_time(self):
+        request = message.Message(mtype=CON, code=GET)
+        request.opt.uri_path = (b"text", )
+        request.remote = (ip_address(u"10.0.0.99"), SERVER_PORT)
+        self.client_protocols[0].request(request, self._handle_text_response)
+
+        self.network.run(MAX_TRANSMIT_WAIT + 1)
+        self.assertEqual(self.responses, [(RESULT_TIMEOUT, None)])
+        self.assertEqual(self.network.stats()['undeliverable'], MAX_RETRANSMIT + 1)
+
+    def test_server_shall_forget_message_ids_after_exchange_lifetime(self):
+        request = message.Message(mtype=CON, code=GET)
+        request.opt.uri_path = (b"text", )
+        request.remote = (ip_address(u"10.0.0.1"), SERVER_PORT)
+        self.client_protocols[0].request(request, self._handle_text_response)
+        self.network.run(1)
+        self.assertEqual(len(self.server_protocol._message_layer._recent_remote_ids), 1)
+
+        # Expired message IDs are removed when the next message is received.
+        self.network.run(EXCHANGE_LIFETIME)
+        request = message.Message(mtype=NON, code=GET)
+        request.opt.uri_path = (b"text", )
+        request.remote = (ip_address(u"10.0.0.1"), SERVER_PORT)
+        self.client_protocols[1].request(request, self._handle_text_response)
+        self.network.run(1)
+        self.assertEqual(len(self.server_protocol._message_layer._recent_remote_ids), 1)
+
+    def test_requests_over_lossy_links_shall_be_recovered_by_retransmissions(self):
+        self.network.profile = virtual.LinkProfile(latency=0.05, loss=0.2, duplication=0.1)
+        for client_protocol in self.client_protocols:
+            request = message.Message(mtype=CON, code=GET)
+            request.opt.uri_path = (b"text", )
+            request.remote = (ip_address(u"10.0.0.1"), SERVER_PORT)
+            client_protocol.request(request, self._handle_text_response)
+
+        self.network.run(MAX_TRANSMIT_WAIT + 1)
+        self.assertEqual(len(self.responses), self.CLIENTS)
+        self.assertGreater(self.network.lost, 0)
+        self.assertGreater([result for result, _ in self.responses].count(RESULT_SUCCESS), self.CLIENTS * 0.9)
+
+    def test_simulation_with_same_seed_shall_be_reproducible(self):
+        traces = []
+        for _ in range(2):
+            trace = []
+            network = virtual.VirtualNetwork(seed=1, profile=virtual.LinkProfile(latency=0.05, jitter=0.01,
+                                                                                  loss=0.2, duplication=0.1))
+            transmit = network.transmit
+
+            def record(data, source, destination, network=network, transmit=transmit, trace=trace):
+                trace.append((network.now, data, source, destination))
+                transmit(data, source, destination)
+            network.transmit = record
+
+            server_transport = virtual.VirtualTransport(network, u"10.0.0.1", SERVER_PORT)
+            server_protocol = core.Coap(server_transport, clock=network.clock)
+            server_transport.register_receiver(server_protocol)
+            server_root = resource.CoapResource()
+            server_root.put_child(b'text', TextResource())
+            server_protocol.register_request_handler(resource.ResourceManager(resource.CoapEndpoint(server_root),
+                                                                              server_protocol))
+            server_transport.open()
+            for i in range(10):
+                client_transport = virtual.VirtualTransport(network, u"10.1.0.%d" % (i + 1))
+                client_protocol = core.Coap(client_transport, clock=network.clock)
+                client_transport.register_receiver(client_protocol)
+                client_transport.open()
+                request = message.Message(mtype=CON, code=GET)
+                request.opt.uri_path = (b"text", )
+                request.remote = (ip_address(u"10.0.0.1"), SERVER_PORT)
+                client_protocol.request(request, self._handle_text_response)
+
+            network.run(MAX_TRANSMIT_WAIT + 1)
+            traces.append(trace)
+
+        self.assertGreater(len(traces[0]), 20)
+        self.assertEqual(traces[0], traces[1])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+import multiprocessing
+import unittest
+
+from piccata import core
+from piccata import dedup
+from piccata import message
+from piccata.clock import VirtualClock
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+TEST_REMOTE_6 = (ip_address(u"2001:db8::1"), 12345)
+TEST_LOCAL = (ip_address(u"10.10.10.10"), 20000)
+
+def add_in_child(store, mid, queue):
+    queue.put(store.add(mid, TEST_REMOTE, EXCHANGE_LIFETIME))
+
+class TestSharedDeduplicationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = dedup.SharedDeduplicationStore(slots=64)
+
+    def tearDown(self):
+        self.store.close()
+        self.store.unlink()
+
+    def test_store_shall_detect_duplicates_until_they_expire(self):
+        self.assertTrue(self.store.add(1000, TEST_REMOTE, 10, now=0))
+        self.assertFalse(self.store.add(1000, TEST_REMOTE, 10, now=5))
+        self.assertTrue(self.store.add(1000, TEST_REMOTE_6, 10, now=5))
+        self.assertTrue(self.store.add(1000, TEST_REMOTE, 10, now=11))
+
+    def test_store_shall_replace_oldest_entries_when_full(self):
+        for mid in range(100):
+            self.assertTrue(self.store.add(mid, TEST_REMOTE, 10, now=mid))
+        self.assertTrue(self.store.contains(99, TEST_REMOTE, now=1))
+
+    def test_store_shall_be_shared_with_forked_processes(self):
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        store = dedup.SharedDeduplicationStore(slots=64, lock=context.Lock())
+        try:
+            store.add(1000, TEST_REMOTE, EXCHANGE_LIFETIME)
+            for mid in (1000, 1001):
+                child = context.Process(target=add_in_child, args=(store, mid, queue))
+                child.start()
+                child.join()
+            self.assertEqual([queue.get(), queue.get()], [False, True])
+            self.assertTrue(store.contains(1001, TEST_REMOTE))
+        finally:
+            store.close()
+            store.unlink()
+
+class TestCoapSharedDeduplication(unittest.TestCase):
+
+    def test_duplicate_received_by_other_protocol_instance_shall_be_ignored(self):
+        store = dedup.SharedDeduplicationStore(slots=64)
+        received = []
+
+        class Handler:
+            def receive_request(self, request):
+                received.append(request.mid)
+                return message.Message.AckMessage(request, CHANGED)
+
+        try:
+            transports = [tester.TesterTransport() for _ in range(2)]
+            for transport in transports:
+                protocol = core.Coap(transport, deduplication_store=store)
+                protocol.register_request_handler(Handler())
+                transport.register_receiver(protocol)
+
+            req = message.Message(CON, 1000, POST, b"", b"ab")
+            for transport in transports:
+                transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+            self.assertEqual(received, [1000])
+        finally:
+            store.close()
+            store.unlink()
+
+    def test_store_shall_use_clock_of_protocol_instance(self):
+        store = dedup.SharedDeduplicationStore(slots=64)
+        received = []
+
+        class Handler:
+            def receive_request(self, request):
+                received.append(request.mid)
+                return message.Message.AckMessage(request, CHANGED)
+
+        try:
+            clock = VirtualClock()
+            transport = tester.TesterTransport()
+            protocol = core.Coap(transport, deduplication_store=store, clock=clock)
+            protocol.register_request_handler(Handler())
+            transport.register_receiver(protocol)
+
+            req = message.Message(CON, 1000, POST, b"", b"ab")
+            transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+            self.assertTrue(store.contains(1000, TEST_REMOTE, clock.now() + EXCHANGE_LIFETIME - 1))
+            self.assertFalse(store.contains(1000, TEST_REMOTE, clock.now() + EXCHANGE_LIFETIME))
+
+            # The local cache has expired, so only the shared store could report the duplicate.
+            clock.run(EXCHANGE_LIFETIME)
+            transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+            self.assertEqual(received, [1000, 1000])
+        finally:
+            store.close()
+            store.unlink()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+
+from piccata import cache
+from piccata import core
+from piccata import message
+from piccata import proxy
+from piccata import resource
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+CLIENT = (ip_address(u"12.34.56.78"), 12345)
+SERVER = (ip_address(u"10.0.0.2"), COAP_PORT)
+LOCAL = (ip_address(u"10.10.10.10"), COAP_PORT)
+
+class RecordingTransport(tester.TesterTransport):
+
+    __test__ = False
+
+    def __init__(self):
+        tester.TesterTransport.__init__(self)
+        self.sent = []
+
+    def send(self, data, dest):
+        tester.TesterTransport.send(self, data, dest)
+        self.sent.append(message.Message.decode(data, dest))
+
+def create_proxy_request(mid, token, uri=b"coap://10.0.0.2/sensors/temp?unit=C"):
+    req = message.Message(CON, mid, GET, b"", token)
+    req.opt.proxy_uri = uri
+    return req
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.downstream = RecordingTransport()
+        self.upstream = RecordingTransport()
+        self.client_side = core.Coap(self.downstream)
+        self.server_side = core.Coap(self.upstream)
+        self.downstream.register_receiver(self.client_side)
+        self.upstream.register_receiver(self.server_side)
+
+        self.proxy = proxy.ProxyRequestHandler(self.client_side, self.server_side, cache.ResponseCache())
+        self.manager = resource.ResourceManager(resource.CoapEndpoint(resource.CoapResource()), proxy=self.proxy)
+        self.client_side.register_request_handler(self.manager)
+
+    def receive_from_client(self, req):
+        self.downstream._receive(req.encode(), CLIENT, LOCAL)
+
+    def respond_from_server(self, forwarded, payload=b"21.5", max_age=None):
+        rsp = message.Message(ACK, forwarded.mid, CONTENT, payload, forwarded.token)
+        rsp.opt.max_age = max_age
+        self.upstream._receive(rsp.encode(), SERVER, LOCAL)
+
+    def test_proxy_shall_forward_request_and_relay_response(self):
+        self.receive_from_client(create_proxy_request(1000, b"c1"))
+        self.assertEqual(self.downstream.sent[-1].code, EMPTY)
+
+        forwarded = self.upstream.sent[-1]
+        self.assertEqual(forwarded.remote, SERVER)
+        self.assertEqual(forwarded.opt.uri_path, [b"sensors", b"temp"])
+        self.assertEqual(forwarded.opt.uri_query, [b"unit=C"])
+        self.assertIsNone(forwarded.opt.proxy_uri)
+
+        self.respond_from_server(forwarded)
+        rsp = self.downstream.sent[-1]
+        self.assertEqual((rsp.mtype, rsp.code, rsp.payload, rsp.token), (CON, CONTENT, b"21.5", b"c1"))
+        self.assertEqual(len(self.proxy), 0)
+
+    def test_proxy_shall_coalesce_requests_and_serve_cached_responses(self):
+        self.receive_from_client(create_proxy_request(1000, b"c1"))
+        self.receive_from_client(create_proxy_request(1001, b"c2"))
+        self.assertEqual(len(self.upstream.sent), 1)
+
+        self.respond_from_server(self.upstream.sent[-1])
+        self.assertEqual([m.token for m in self.downstream.sent if m.code == CONTENT], [b"c1", b"c2"])
+
+        self.receive_from_client(create_proxy_request(1002, b"c3"))
+        self.assertEqual(len(self.upstream.sent), 1)
+        rsp = self.downstream.sent[-1]
+        self.assertEqual((rsp.mtype, rsp.mid, rsp.payload), (ACK, 1002, b"21.5"))
+
+    def test_proxy_shall_not_coalesce_requests_with_different_etags(self):
+        req = create_proxy_request(1000, b"c1")
+        req.opt.etag = b"e1"
+        self.receive_from_client(req)
+        self.receive_from_client(create_proxy_request(1001, b"c2"))
+        self.assertEqual(len(self.proxy), 2)
+
+        rsp = message.Message(ACK, self.upstream.sent[0].mid, VALID, b"", self.upstream.sent[0].token)
+        rsp.opt.etag = b"e1"
+        self.upstream._receive(rsp.encode(), SERVER, LOCAL)
+        # The plain request waited for the upstream slot instead of sharing the exchange.
+        self.assertEqual([m.opt.etags for m in self.upstream.sent], [[b"e1"], []])
+        self.respond_from_server(self.upstream.sent[1])
+        self.assertEqual([(m.token, m.code) for m in self.downstream.sent if m.code != EMPTY],
+                         [(b"c1", VALID), (b"c2", CONTENT)])
+
+    def test_proxy_shall_fetch_again_when_revalidated_entry_was_evicted(self):
+        self.receive_from_client(create_proxy_request(1000, b"c1"))
+        forwarded = self.upstream.sent[-1]
+        rsp = message.Message(ACK, forwarded.mid, CONTENT, b"21.5", forwarded.token)
+        rsp.opt.max_age = 0
+        rsp.opt.etag = b"e1"
+        self.upstream._receive(rsp.encode(), SERVER, LOCAL)
+
+        self.receive_from_client(create_proxy_request(1001, b"c2"))
+        revalidation = self.upstream.sent[-1]
+        self.assertEqual(revalidation.opt.etags, [b"e1"])
+        self.proxy.response_cache.invalidate(cache.cache_key(revalidation))
+
+        rsp = message.Message(ACK, revalidation.mid, VALID, b"", revalidation.token)
+        rsp.opt.etag = b"e1"
+        self.upstream._receive(rsp.encode(), SERVER, LOCAL)
+        self.assertNotEqual(self.downstream.sent[-1].code, VALID)
+
+        refetch = self.upstream.sent[-1]
+        self.assertNotEqual(refetch.token, revalidation.token)
+        self.assertEqual(refetch.opt.etags, [])
+        self.respond_from_server(refetch, b"22.0")
+        rsp = self.downstream.sent[-1]
+        self.assertEqual((rsp.code, rsp.payload, rsp.token), (CONTENT, b"22.0", b"c2"))
+        self.assertEqual(len(self.proxy), 0)
+
+    def test_proxy_shall_limit_outstanding_requests_per_server(self):
+        self.receive_from_client(create_proxy_request(1000, b"c1", b"coap://10.0.0.2/a"))
+        self.receive_from_client(create_proxy_request(1001, b"c2", b"coap://10.0.0.2/b"))
+        self.assertEqual(len(self.upstream.sent), 1)
+
+        self.respond_from_server(self.upstream.sent[-1])
+        self.assertEqual(len(self.upstream.sent), 2)
+        self.assertEqual(self.upstream.sent[-1].opt.uri_path, [b"b"])
+
+    def test_proxy_shall_reject_unsupported_scheme(self):
+        self.receive_from_client(create_proxy_request(1000, b"c1", b"http://10.0.0.2/a"))
+        self.assertEqual(self.downstream.sent[-1].code, PROXYING_NOT_SUPPORTED)
+
+    def test_server_without_proxy_shall_reject_proxied_requests(self):
+        self.manager.proxy = None
+        self.receive_from_client(create_proxy_request(1000, b"c1"))
+        self.assertEqual(self.downstream.sent[-1].code, PROXYING_NOT_SUPPORTED)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from piccata import core
+from piccata import message
+from piccata import ratelimit
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+OTHER_REMOTE = (ip_address(u"12.34.56.79"), 12345)
+TEST_LOCAL = (ip_address(u"10.10.10.10"), 20000)
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_bucket_shall_refill_at_configured_rate(self):
+        bucket = ratelimit.TokenBucket(rate=10, burst=2, now=0)
+        self.assertTrue(bucket.consume(now=0))
+        self.assertTrue(bucket.consume(now=0))
+        self.assertFalse(bucket.consume(now=0))
+        self.assertAlmostEqual(bucket.delay(now=0), 0.1)
+        self.assertTrue(bucket.consume(now=0.1))
+
+class TestPeerRateLimiter(unittest.TestCase):
+
+    def test_limiter_shall_track_peers_separately(self):
+        limiter = ratelimit.PeerRateLimiter(rate=1, burst=1)
+        self.assertEqual(limiter.delay(TEST_REMOTE, now=0), 0)
+        self.assertGreater(limiter.delay(TEST_REMOTE, now=0), 0)
+        self.assertEqual(limiter.delay(OTHER_REMOTE, now=0), 0)
+        self.assertEqual(limiter.limited, 1)
+
+    def test_limiter_shall_forget_least_recently_active_peer(self):
+        limiter = ratelimit.PeerRateLimiter(rate=1, burst=1, max_peers=1)
+        limiter.delay(TEST_REMOTE, now=0)
+        limiter.delay(OTHER_REMOTE, now=0)
+        self.assertEqual(len(limiter), 1)
+        self.assertEqual(limiter.delay(TEST_REMOTE, now=0), 0)
+
+class TestCoapRateLimiting(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = tester.TesterTransport()
+        self.received = []
+        self.protocol = core.Coap(self.transport)
+        self.protocol.register_request_handler(self)
+        self.transport.register_receiver(self.protocol)
+
+    def receive_request(self, request):
+        self.received.append(request.mid)
+        return message.Message.AckMessage(request, CONTENT)
+
+    def send_requests(self, action, count=3):
+        self.protocol._message_layer.rate_limiter = ratelimit.PeerRateLimiter(rate=0.5, burst=2, action=action)
+        for mid in range(1000, 1000 + count):
+            req = message.Message(CON, mid, GET, b"", b"ab")
+            self.transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+
+    def test_excess_requests_shall_be_dropped(self):
+        self.send_requests(ratelimit.ACTION_DROP)
+        self.assertEqual(self.received, [1000, 1001])
+        self.assertEqual(self.transport.output_count, 2)
+
+    def test_excess_requests_shall_be_reset(self):
+        self.send_requests(ratelimit.ACTION_RESET)
+        self.assertEqual(self.received, [1000, 1001])
+        self.assertEqual(self.transport.tester_data, message.Message(RST, 1002, EMPTY).encode())
+
+    def test_excess_requests_shall_be_answered_with_too_many_requests(self):
+        self.send_requests(ratelimit.ACTION_RESPOND)
+        rsp = message.Message.decode(self.transport.tester_data)
+        self.assertEqual((rsp.mtype, rsp.mid, rsp.code, rsp.token), (ACK, 1002, TOO_MANY_REQUESTS, b"ab"))
+        self.assertEqual(rsp.opt.max_age, 2)
+
+    def test_retransmissions_shall_not_be_charged_and_get_cached_response(self):
+        self.send_requests(ratelimit.ACTION_RESPOND, count=1)
+        req = message.Message(CON, 1000, GET, b"", b"ab")
+        for _ in range(3):
+            self.transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+            rsp = message.Message.decode(self.transport.tester_data)
+            self.assertEqual((rsp.mtype, rsp.mid, rsp.code), (ACK, 1000, CONTENT))
+        self.assertEqual(self.received, [1000])
+
+        # The peer has a token left for a new request.
+        req = message.Message(CON, 1001, GET, b"", b"ab")
+        self.transport._receive(req.encode(), TEST_REMOTE, TEST_LOCAL)
+        self.assertEqual(self.received, [1000, 1001])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,503 @@
+import time
+import unittest
+
+from piccata import core
+from piccata import message
+from piccata import resource
+from piccata.constants import *
+from transport import tester
+
+from ipaddress import ip_address
+
+TEST_REMOTE = (ip_address(u"12.34.56.78"), 12345)
+
+class NamedResource(resource.CoapResource):
+
+    __test__ = False
+
+    def __init__(self, name):
+        resource.CoapResource.__init__(self)
+        self.name = name
+
+    def render_GET(self, request):
+        return message.Message(code=CONTENT, payload=self.name)
+
+class LeafResource(NamedResource):
+
+    is_leaf = True
+
+def create_request(path, code=GET):
+    req = message.Message(CON, 1000, code, b"", b"abcd")
+    req.opt.uri_path = path
+    req.remote = TEST_REMOTE
+    return req
+
+class TestCoapEndpointRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.root = resource.CoapResource()
+        self.devices = NamedResource(b"devices")
+        self.root.put_child(b"devices", self.devices)
+        self.endpoint = resource.CoapEndpoint(self.root)
+
+    def find(self, *path):
+        return self.endpoint.find_resource(create_request(path))
+
+    def test_endpoint_shall_resolve_static_paths(self):
+        self.assertIs(self.find(), self.root)
+        self.assertIs(self.find(b"devices"), self.devices)
+        self.assertIsNone(self.find(b"unknown"))
+        self.assertRaises(resource.NoResource, self.endpoint.get_resource_for, create_request((b"unknown", )))
+
+    def test_endpoint_shall_update_routes_when_children_change(self):
+        status = NamedResource(b"status")
+        self.devices.put_child(b"status", status)
+        self.assertIs(self.find(b"devices", b"status"), status)
+
+        replacement = NamedResource(b"replacement")
+        self.devices.put_child(b"status", replacement)
+        self.assertIs(self.find(b"devices", b"status"), replacement)
+
+        self.devices.delete_child(b"status")
+        self.assertIsNone(self.find(b"devices", b"status"))
+
+    def test_endpoint_shall_resolve_wildcard_segments(self):
+        device = NamedResource(b"device")
+        sensor = NamedResource(b"sensor")
+        gateway = NamedResource(b"gateway")
+        device.put_child(b"sensor", sensor)
+        self.devices.put_child(resource.WILDCARD, device)
+        self.devices.put_child(b"gateway", gateway)
+
+        self.assertIs(self.find(b"devices", b"0011223344556677"), device)
+        self.assertIs(self.find(b"devices", b"0011223344556677", b"sensor"), sensor)
+        self.assertIs(self.find(b"devices", b"gateway"), gateway)
+        self.assertIsNone(self.find(b"devices", b"0011223344556677", b"unknown"))
+
+        self.devices.delete_child(resource.WILDCARD)
+        self.assertIsNone(self.find(b"devices", b"0011223344556677"))
+        self.assertIs(self.find(b"devices", b"gateway"), gateway)
+
+    def test_endpoint_shall_resolve_wildcard_segments_without_walking_the_tree(self):
+        device = NamedResource(b"device")
+        sensor = NamedResource(b"sensor")
+        device.put_child(b"sensor", sensor)
+        self.devices.put_child(resource.WILDCARD, device)
+        self.root.put_child(resource.WILDCARD, NamedResource(b"any"))
+        self.endpoint._walk = None
+
+        self.assertIs(self.find(b"devices", b"0011223344556677", b"sensor"), sensor)
+        self.assertIs(self.find(b"devices", b"0011223344556677"), device)
+        self.assertEqual(self.find(b"other").name, b"any")
+        self.assertIsNone(self.find(b"devices", b"0011223344556677", b"unknown"))
+
+    def test_endpoint_shall_not_change_server_of_resources(self):
+        server = object()
+        root = resource.CoapResource()
+        root.server = server
+        child = NamedResource(b"child")
+        root.put_child(b"child", child)
+        resource.CoapEndpoint(root)
+        self.assertIs(root.server, server)
+        self.assertIs(child.server, server)
+
+    def test_endpoint_shall_stop_at_leaf_resources(self):
+        leaf = LeafResource(b"leaf")
+        self.root.put_child(b"leaf", leaf)
+        self.assertIs(self.find(b"leaf", b"any", b"path"), leaf)
+
+    def test_resource_manager_shall_respond_not_found_for_unknown_path(self):
+        manager = resource.ResourceManager(self.endpoint)
+        rsp = manager.receive_request(create_request((b"unknown", )))
+        self.assertEqual(rsp.code, NOT_FOUND)
+
+class PatchableResource(NamedResource):
+
+    __test__ = False
+
+    def render_iPATCH(self, request):
+        return message.Message(code=CHANGED)
+
+class TestCoapResourceRender(unittest.TestCase):
+
+    def test_resource_shall_dispatch_request_to_render_method(self):
+        res = PatchableResource(b"patchable")
+        self.assertEqual(res.render(create_request(())).payload, b"patchable")
+        self.assertEqual(res.render(create_request((), IPATCH)).code, CHANGED)
+
+    def test_resource_shall_answer_method_not_allowed_for_unhandled_methods(self):
+        res = PatchableResource(b"patchable")
+        rsp = res.render(create_request((), DELETE))
+        self.assertEqual(rsp.code, METHOD_NOT_ALLOWED)
+        self.assertEqual(rsp.payload, b"Error: Method not allowed!")
+
+        rsp = res.render(create_request((), 31))
+        self.assertEqual(rsp.code, METHOD_NOT_ALLOWED)
+        self.assertEqual(rsp.payload, b"Error: Method not recognized!")
+
+    def test_resource_shall_resolve_render_methods_when_attached(self):
+        root = resource.CoapResource()
+        res = NamedResource(b"named")
+        root.put_child(b"named", res)
+        self.assertIsNotNone(res._handlers)
+        self.assertIsNone(res._handlers[IPATCH])
+
+    def test_resource_shall_dispatch_to_render_methods_added_after_invalidation(self):
+        res = NamedResource(b"named")
+        self.assertEqual(res.render(create_request((), IPATCH)).code, METHOD_NOT_ALLOWED)
+
+        res.render_iPATCH = lambda request: message.Message(code=CHANGED)
+        self.assertEqual(res.render(create_request((), IPATCH)).code, METHOD_NOT_ALLOWED)
+        res.invalidate_handlers()
+        self.assertEqual(res.render(create_request((), IPATCH)).code, CHANGED)
+
+        other = NamedResource(b"other")
+        self.assertEqual(other.render(create_request((), FETCH)).code, METHOD_NOT_ALLOWED)
+        NamedResource.render_FETCH = lambda self, request: message.Message(code=CONTENT)
+        try:
+            other.invalidate_handlers()
+            self.assertEqual(other.render(create_request((), FETCH)).code, CONTENT)
+        finally:
+            del NamedResource.render_FETCH
+
+class TestWellKnownCore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = resource.CoapResource()
+        self.well_known = resource.WellKnownCoreResource(size_exp=2)
+        well_known_dir = resource.CoapResource()
+        well_known_dir.put_child(b"core", self.well_known)
+        self.root.put_child(b".well-known", well_known_dir)
+
+        self.sensors = resource.CoapResource()
+        self.actuators = resource.CoapResource()
+        self.root.put_child(b"sensors", self.sensors)
+        self.root.put_child(b"actuators", self.actuators)
+        for name, rt in ((b"temp", "temperature"), (b"hum", "humidity")):
+            res = resource.CoapResource()
+            res.visible = True
+            res.add_param(resource.LinkParam("rt", rt))
+            self.sensors.put_child(name, res)
+        self.led = resource.CoapResource()
+        self.led.visible = True
+        self.led.add_param(resource.LinkParam("if", "core.a"))
+        self.actuators.put_child(b"led", self.led)
+
+        self.manager = resource.ResourceManager(resource.CoapEndpoint(self.root))
+
+    def discover(self, query=(), block2=None):
+        req = create_request((b".well-known", b"core"))
+        req.opt.uri_query = query
+        if block2 is not None:
+            req.opt.block2 = block2
+        return self.manager.receive_request(req)
+
+    def test_well_known_core_shall_list_visible_resources(self):
+        self.well_known.size_exp = MAX_BLOCK_SIZE_EXP
+        rsp = self.discover()
+        self.assertEqual(rsp.code, CONTENT)
+        self.assertEqual(rsp.opt.content_format, 40)
+        self.assertEqual(rsp.payload, b'</sensors/temp>;rt="temperature",</sensors/hum>;rt="humidity",</actuators/led>;if="core.a"')
+
+    def test_well_known_core_shall_filter_by_query(self):
+        self.assertEqual(self.discover((b"rt=humidity", )).payload, b'</sensors/hum>;rt="humidity"')
+        self.assertEqual(self.discover((b"if=core*", )).payload, b'</actuators/led>;if="core.a"')
+        self.assertEqual(self.discover((b"href=/sensors/t*", )).payload, b'</sensors/temp>;rt="temperature"')
+        self.assertEqual(self.discover((b"rt=unknown", )).payload, b'')
+
+    def test_well_known_core_shall_match_every_link_for_href_without_value(self):
+        self.well_known.size_exp = MAX_BLOCK_SIZE_EXP
+        self.assertEqual(self.discover((b"href", )).payload, self.discover().payload)
+        self.assertEqual(self.discover((b"href", b"rt=humidity")).payload, b'</sensors/hum>;rt="humidity"')
+
+        self.root.put_child(b"devices", resource.VirtualResource(lambda path: None, lambda offset, count: []))
+        self.assertEqual(self.discover((b"href", b"if=core.a")).payload, b'</actuators/led>;if="core.a"')
+
+    def test_well_known_core_shall_serve_large_description_with_block2(self):
+        rsp = self.discover()
+        self.assertEqual(rsp.opt.block2, (0, True, 2))
+        self.assertEqual(rsp.payload, b'</sensors/temp>;rt="temperature",</sensors/hum>;rt="humidity",</')
+
+        rsp = self.discover(block2=(1, False, 2))
+        self.assertEqual(rsp.opt.block2, (1, False, 2))
+        self.assertEqual(rsp.payload, b'actuators/led>;if="core.a"')
+
+    def test_well_known_core_shall_invalidate_only_changed_subtree(self):
+        self.discover()
+        sensors_cache = self.sensors._link_cache
+        self.led.add_param(resource.LinkParam("rt", "light"))
+
+        self.assertIsNone(self.root._link_cache)
+        self.assertIs(self.sensors._link_cache, sensors_cache)
+        self.assertEqual(self.discover((b"rt=light", )).payload, b'</actuators/led>;if="core.a";rt="light"')
+
+class TestVirtualResource(unittest.TestCase):
+
+    DEVICE_COUNT = 1000
+
+    def setUp(self):
+        self.resolved = []
+        self.enumerated = []
+        self.devices = resource.VirtualResource(self.resolve, self.enumerate, max_children=2, page_size=100)
+        root = resource.CoapResource()
+        root.put_child(b"devices", self.devices)
+        self.endpoint = resource.CoapEndpoint(root)
+
+    def resolve(self, path):
+        if not path.startswith(b"dev") or int(path[3:]) >= self.DEVICE_COUNT:
+            return None
+        self.resolved.append(path)
+        device = NamedResource(path)
+        device.visible = True
+        return device
+
+    def enumerate(self, offset, count):
+        self.enumerated.append(offset)
+        return [b"dev%d" % i for i in range(offset, min(offset + count, self.DEVICE_COUNT))]
+
+    def find(self, *path):
+        return self.endpoint.find_resource(create_request(path))
+
+    def test_virtual_resource_shall_resolve_children_on_demand(self):
+        self.assertEqual(self.find(b"devices", b"dev7").name, b"dev7")
+        self.assertIs(self.find(b"devices", b"dev7"), self.find(b"devices", b"dev7"))
+        self.assertIsNone(self.find(b"devices", b"unknown"))
+        self.assertEqual(self.resolved, [b"dev7"])
+
+    def test_virtual_resource_shall_keep_bounded_number_of_children(self):
+        for name in (b"dev1", b"dev2", b"dev3"):
+            self.find(b"devices", name)
+        self.assertEqual(list(self.devices._resolved), [b"dev2", b"dev3"])
+
+    def test_virtual_children_shall_be_listed_by_page(self):
+        data = []
+        self.endpoint.root.generate_resource_list(data, offset=10, count=3)
+        self.assertEqual(data, ["</devices/dev10>", "</devices/dev11>", "</devices/dev12>"])
+        self.assertEqual(len(self.resolved), 13)
+        self.assertEqual(len(self.devices._resolved), 0)
+
+    def test_virtual_children_listing_shall_resume_from_known_page(self):
+        data = []
+        self.endpoint.root.generate_resource_list(data, offset=950, count=2)
+        self.assertEqual(data, ["</devices/dev950>", "</devices/dev951>"])
+
+        del self.resolved[:]
+        del self.enumerated[:]
+        data = []
+        self.endpoint.root.generate_resource_list(data, offset=960, count=2)
+        self.assertEqual(data, ["</devices/dev960>", "</devices/dev961>"])
+        self.assertEqual(self.enumerated, [900])
+        self.assertEqual(len(self.resolved), 62)
+
+    def test_virtual_children_listing_shall_skip_enumerated_subtree(self):
+        self.endpoint.root.put_child(b"extra", NamedResource(b"extra"))
+        self.endpoint.root.children[b"extra"].visible = True
+        data = []
+        self.endpoint.root.generate_resource_list(data, offset=self.DEVICE_COUNT, count=2)
+        self.assertEqual(data, ["</extra>"])
+
+        del self.enumerated[:]
+        data = []
+        self.endpoint.root.generate_resource_list(data, offset=self.DEVICE_COUNT, count=2)
+        self.assertEqual(data, ["</extra>"])
+        self.assertEqual(self.enumerated, [])
+
+        self.devices.invalidate_links()
+        self.assertIsNone(self.devices.virtual_link_count("/devices"))
+
+    def test_well_known_core_shall_enumerate_virtual_children_up_to_requested_block(self):
+        well_known = resource.WellKnownCoreResource(size_exp=2)
+        self.endpoint.root.put_child(b"core", well_known)
+        req = create_request((b"core", ))
+        req.opt.block2 = (1, False, 2)
+
+        rsp = well_known.render(req)
+        self.assertEqual(rsp.opt.block2, (1, True, 2))
+        self.assertLess(len(self.resolved), 10)
+
+    def test_well_known_core_shall_resume_listing_from_previous_block(self):
+        well_known = resource.WellKnownCoreResource(size_exp=2)
+        self.endpoint.root.put_child(b"core", well_known)
+        payload = b""
+        number = 0
+        more = True
+        while more:
+            req = create_request((b"core", ))
+            req.opt.block2 = (number, False, 2)
+            rsp = well_known.render(req)
+            payload += rsp.payload
+            number, more = number + 1, rsp.opt.block2.m
+
+        data = []
+        self.endpoint.root.generate_resource_list(data)
+        self.assertEqual(payload, ",".join(data).encode('utf-8'))
+        # Every block resolves at most a page before it, rather than the whole listing before it.
+        self.assertLess(len(self.resolved), 2 * self.DEVICE_COUNT + number * self.devices.page_size)
+
+class CountingTransport(tester.TesterTransport):
+
+    __test__ = False
+
+    def __init__(self):
+        tester.TesterTransport.__init__(self)
+        self.sent = []
+
+    def send(self, data, dest):
+        tester.TesterTransport.send(self, data, dest)
+        self.sent.append((message.Message.decode(data, dest), dest))
+
+class ObservableResource(NamedResource):
+
+    __test__ = False
+
+    observable = True
+
+    def __init__(self, name):
+        NamedResource.__init__(self, name)
+        self.render_count = 0
+
+    def render_GET(self, request):
+        self.render_count += 1
+        return NamedResource.render_GET(self, request)
+
+class TestObserve(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = CountingTransport()
+        self.protocol = core.Coap(self.transport)
+        self.transport.register_receiver(self.protocol)
+
+        root = resource.CoapResource()
+        self.sensor = ObservableResource(b"22.5")
+        root.put_child(b"sensor", self.sensor)
+        self.manager = resource.ResourceManager(resource.CoapEndpoint(root), self.protocol, notification_rate=None)
+        self.protocol.register_request_handler(self.manager)
+
+    def register(self, port, token, observe=0):
+        req = message.Message(CON, 100 + port + 1000 * observe, GET, b"", token)
+        req.opt.uri_path = (b"sensor", )
+        req.opt.observe = observe
+        self.transport._receive(req.encode(), (TEST_REMOTE[0], port), None)
+        return self.transport.sent[-1][0]
+
+    def test_observe_shall_register_observer(self):
+        rsp = self.register(1, b"a")
+        self.assertEqual(rsp.code, CONTENT)
+        self.assertEqual(rsp.opt.observe, 0)
+        self.assertEqual(len(self.sensor.observers), 1)
+
+        self.register(1, b"a", observe=1)
+        self.assertEqual(len(self.sensor.observers), 0)
+
+    def test_notify_shall_render_once_for_all_observers(self):
+        for port in range(10):
+            self.register(port, b"t%d" % port)
+        self.transport.sent = []
+        self.sensor.render_count = 0
+
+        self.sensor.name = b"23.0"
+        self.manager.notify(self.sensor)
+
+        self.assertEqual(self.sensor.render_count, 1)
+        self.assertEqual(len(self.transport.sent), 10)
+        for port, (msg, remote) in enumerate(self.transport.sent):
+            self.assertEqual(remote[1], port)
+            self.assertEqual(msg.token, b"t%d" % port)
+            self.assertEqual(msg.mtype, NON)
+            self.assertEqual(msg.opt.observe, 1)
+            self.assertEqual(msg.payload, b"23.0")
+        self.assertEqual(len(set(msg.mid for msg, _ in self.transport.sent)), 10)
+
+    def test_observer_shall_be_removed_when_notification_is_rejected(self):
+        self.register(1, b"a")
+        self.manager.notify(self.sensor)
+        notification = self.transport.sent[-1][0]
+
+        rst = message.Message(RST, notification.mid, EMPTY)
+        self.transport._receive(rst.encode(), (TEST_REMOTE[0], 1), None)
+        self.assertEqual(len(self.sensor.observers), 0)
+
+    def test_notifications_shall_be_rate_limited(self):
+        self.manager = resource.ResourceManager(self.manager.endpoint, self.protocol, notification_rate=1000, notification_burst=2)
+        self.protocol.register_request_handler(self.manager)
+        for port in range(5):
+            self.register(port, b"t%d" % port)
+        self.transport.sent = []
+
+        self.manager.notify(self.sensor)
+        self.assertEqual(len(self.transport.sent), 2)
+        time.sleep(0.1)
+        self.assertEqual(len(self.transport.sent), 5)
+
+    def test_CON_notifications_shall_be_conflated_while_previous_one_is_in_flight(self):
+        self.manager.notifier.mtype = CON
+        self.register(1, b"a")
+        self.register(2, b"b")
+        self.transport.sent = []
+
+        for value in (b"1", b"2", b"3"):
+            self.sensor.name = value
+            self.manager.notify(self.sensor)
+
+        # Every observer has a single notification in flight.
+        self.assertEqual([msg.payload for msg, _ in self.transport.sent], [b"1", b"1"])
+
+        ack = message.Message(ACK, self.transport.sent[0][0].mid, EMPTY)
+        self.transport._receive(ack.encode(), (TEST_REMOTE[0], 1), None)
+
+        # Only the latest state follows the acknowledged notification.
+        self.assertEqual(len(self.transport.sent), 3)
+        msg, remote = self.transport.sent[-1]
+        self.assertEqual(remote[1], 1)
+        self.assertEqual(msg.payload, b"3")
+        self.assertEqual(msg.opt.observe, 3)
+
+class CachedResource(ObservableResource):
+
+    __test__ = False
+
+    cacheable = True
+
+    def render_PUT(self, request):
+        self.name = request.payload
+        return message.Message(code=CHANGED)
+
+class TestRepresentationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = resource.CoapResource()
+        self.sensor = CachedResource(b"21.5")
+        self.root.put_child(b"sensor", self.sensor)
+        self.manager = resource.ResourceManager(resource.CoapEndpoint(self.root))
+
+    def test_cached_representation_shall_be_served_without_rendering(self):
+        first = self.manager.receive_request(create_request((b"sensor", )))
+        second = self.manager.receive_request(create_request((b"sensor", )))
+        self.assertEqual(self.sensor.render_count, 1)
+        self.assertEqual(second.payload, b"21.5")
+        self.assertIsNotNone(first.opt.etag)
+        self.assertEqual(second.opt.etag, first.opt.etag)
+
+    def test_matching_etag_shall_be_answered_with_valid(self):
+        etag = self.manager.receive_request(create_request((b"sensor", ))).opt.etag
+        req = create_request((b"sensor", ))
+        req.opt.etags = [etag]
+        rsp = self.manager.receive_request(req)
+        self.assertEqual(rsp.code, VALID)
+        self.assertEqual(rsp.payload, b"")
+        self.assertEqual(self.sensor.render_count, 1)
+
+    def test_cache_shall_be_invalidated_when_resource_changes(self):
+        self.manager.receive_request(create_request((b"sensor", )))
+        put = create_request((b"sensor", ), PUT)
+        put.payload = b"22.0"
+        self.manager.receive_request(put)
+        self.assertEqual(self.manager.receive_request(create_request((b"sensor", ))).payload, b"22.0")
+
+        self.sensor.name = b"23.0"
+        self.manager.notify(self.sensor)
+        self.assertEqual(self.manager.receive_request(create_request((b"sensor", ))).payload, b"23.0")
+        self.assertEqual(self.sensor.render_count, 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,26 @@
+import io
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
 import unittest
 import time
 
+from ipaddress import ip_address
+
+from piccata import core
+from piccata import message
+from piccata import resource
+from piccata.constants import *
+
+import transport.capture
+import transport.reuseport
 import transport.tester
 import transport.tsocket
+import transport.tunix
+import transport.virtual
 
 class TestUtils:
 
@@ -35,6 +53,11 @@ class TestReceiver:
         self.remote = remote
         self.local = local
 
+class TextResource(resource.CoapResource):
+
+    def render_GET(self, request):
+        return message.Message(code=CONTENT, payload=b"text")
+
 class TestTransport(unittest.TestCase):
 
     receiver_names = ["receiver_1", "receiver_2", "receiver_3"]
@@ -119,5 +142,368 @@ class TestSocketTransport(unittest.TestCase):
         self.assertEqual(self.receivers["client"].counter, 1)
         self.assertEqual(self.receivers["client"].data, test_response)
 
+@unittest.skipUnless(socket.has_ipv6, "IPv6 not available")
+class TestDualStackSocketTransport(unittest.TestCase):
+
+    TEST_PORT = 5698
+
+    def setUp(self):
+        self.server = transport.tsocket.SocketTransport(self.TEST_PORT, family=socket.AF_INET6, pktinfo=True)
+        self.receiver = TestReceiver("server")
+        self.server.register_receiver(self.receiver)
+        self.server.open()
+
+    def tearDown(self):
+        self.server.close()
+
+    def exchange(self, family, address):
+        client = socket.socket(family, socket.SOCK_DGRAM)
+        client.settimeout(1)
+        try:
+            client.sendto(b"request", (address, self.TEST_PORT))
+            time.sleep(0.1)
+            self.server.send(b"response", self.receiver.remote, self.receiver.local)
+            data, server_address = client.recvfrom(100)
+        finally:
+            client.close()
+        self.assertEqual(data, b"response")
+        return server_address
+
+    def test_transport_shall_report_destination_of_IPv4_datagram(self):
+        server_address = self.exchange(socket.AF_INET, "127.0.0.1")
+        self.assertEqual(self.receiver.local, (ip_address(u"127.0.0.1"), self.TEST_PORT))
+        self.assertEqual(self.receiver.remote[0], ip_address(u"127.0.0.1"))
+        self.assertEqual(server_address, ("127.0.0.1", self.TEST_PORT))
+
+    def test_transport_shall_report_destination_of_IPv6_datagram(self):
+        self.exchange(socket.AF_INET6, "::1")
+        self.assertEqual(self.receiver.local, (ip_address(u"::1"), self.TEST_PORT))
+
+    def test_scoped_addresses_shall_keep_their_interface(self):
+        self.assertEqual(transport.tsocket._remote_endpoint(("fe80::1", 5683, 0, 7)).addr, ip_address(u"fe80::1%7"))
+        self.assertEqual(transport.tsocket._interface_index(ip_address(u"fe80::1%7")), 7)
+        self.assertEqual(transport.tsocket._interface_index(ip_address(u"fe80::1%lo")), socket.if_nametoindex("lo"))
+        self.assertEqual(transport.tsocket._interface_index(ip_address(u"::1")), 0)
+        self.assertEqual(transport.tsocket._interface_index(ip_address(u"127.0.0.1")), 0)
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "SO_REUSEPORT steering requires Linux")
+class TestReusePortTransport(unittest.TestCase):
+
+    TEST_PORT = 5699
+
+    def setUp(self):
+        self.servers = [transport.tsocket.SocketTransport(self.TEST_PORT, reuse_port=True, steering_workers=2)
+                        for _ in range(2)]
+        self.receivers = TestUtils.create_test_receivers(["server_0", "server_1"])
+        for server, receiver in zip(self.servers, self.receivers.values()):
+            server.register_receiver(receiver)
+            server.open()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def test_steering_program_shall_hash_source_address_and_port(self):
+        program = transport.reuseport.source_steering_program(3)
+        self.assertEqual(program[-2], (0x94, 0, 0, 3))
+        self.assertEqual(program[0][3], (-0x100000 + 12) & 0xFFFFFFFF)
+
+    @staticmethod
+    def run_steering_program(program, packet):
+        """Interpret the classic BPF instructions used by the steering program on a network layer packet."""
+        a = x = 0
+        pc = 0
+        while True:
+            code, jt, jf, k = program[pc]
+            pc += 1
+            offset = (k - 0x100000000 + 0x100000) if code in (0x20, 0x28, 0x30) else None
+            if code == 0x20:
+                a = struct.unpack_from("!I", packet, offset)[0]
+            elif code == 0x28:
+                a = struct.unpack_from("!H", packet, offset)[0]
+            elif code == 0x30:
+                a = packet[offset]
+            elif code == 0x07:
+                x = a
+            elif code == 0x54:
+                a &= k
+            elif code == 0xac:
+                a ^= x
+            elif code == 0x94:
+                a %= k
+            elif code == 0x15:
+                pc += jt if a == k else jf
+            elif code == 0x16:
+                return a
+
+    def test_dual_stack_steering_program_shall_hash_ipv4_and_ipv6_sources(self):
+        program = transport.reuseport.source_steering_program(1000, socket.AF_INET6)
+        udp = struct.pack("!HHHH", 41000, 5683, 12, 0) + b"\x40\x01\x12\x34"
+
+        ipv4 = b"\x45" + bytes(11) + socket.inet_aton("10.0.0.7") + socket.inet_aton("10.0.0.1") + udp
+        self.assertEqual(self.run_steering_program(program, ipv4), (0x0A000007 ^ 41000) % 1000)
+
+        ipv6 = (b"\x60" + bytes(7) + socket.inet_pton(socket.AF_INET6, "2001:db8::a:7") +
+                socket.inet_pton(socket.AF_INET6, "2001:db8::1") + udp)
+        self.assertEqual(self.run_steering_program(program, ipv6), (0x000A0007 ^ 41000) % 1000)
+
+    def test_datagrams_from_one_remote_shall_reach_one_socket(self):
+        for port in (41000, 41001):
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.bind(("127.0.0.1", port))
+            for _ in range(3):
+                client.sendto(b"data", ("127.0.0.1", self.TEST_PORT))
+            client.close()
+
+        time.sleep(0.1)
+        self.assertEqual(sorted(receiver.counter for receiver in self.receivers.values()), [3, 3])
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "Multicast membership options require Linux")
+class TestMulticastSocketTransport(unittest.TestCase):
+
+    TEST_PORT = 5700
+    TEST_GROUP = ip_address(u"224.0.1.187")
+
+    def setUp(self):
+        self.members = [transport.tsocket.MulticastSocketTransport(self.TEST_PORT, groups=[self.TEST_GROUP], interface="lo")
+                        for _ in range(2)]
+        self.receivers = TestUtils.create_test_receivers(["member_0", "member_1"])
+        for member, receiver in zip(self.members, self.receivers.values()):
+            member.register_receiver(receiver)
+            member.open()
+        self.sender = transport.tsocket.MulticastSocketTransport(interface="lo")
+        self.sender.open()
+
+    def tearDown(self):
+        for member in self.members + [self.sender]:
+            member.close()
+
+    def test_datagram_sent_to_group_shall_reach_all_members(self):
+        self.sender.send(b"data", (self.TEST_GROUP, self.TEST_PORT))
+        time.sleep(0.1)
+        for receiver in self.receivers.values():
+            self.assertEqual(receiver.counter, 1)
+            self.assertEqual(receiver.local, (self.TEST_GROUP, self.TEST_PORT))
+
+    def test_member_shall_not_receive_datagrams_after_leaving_group(self):
+        self.members[0].leave(self.TEST_GROUP)
+        self.sender.send(b"data", (self.TEST_GROUP, self.TEST_PORT))
+        time.sleep(0.1)
+        self.assertEqual(self.receivers["member_0"].counter, 0)
+        self.assertEqual(self.receivers["member_1"].counter, 1)
+
+    def test_transport_shall_reject_unicast_group(self):
+        with self.assertRaises(ValueError):
+            self.members[0].join(ip_address(u"127.0.0.1"))
+
+class TestVirtualNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.network = transport.virtual.VirtualNetwork(seed=1)
+        self.transports = [transport.virtual.VirtualTransport(self.network, u"10.0.0.%d" % (i + 1), 5683) for i in range(2)]
+        self.receivers = TestUtils.create_test_receivers(["node_0", "node_1"])
+        for node, receiver in zip(self.transports, self.receivers.values()):
+            node.register_receiver(receiver)
+            node.open()
+
+    def tearDown(self):
+        for node in self.transports:
+            node.close()
+
+    def test_datagram_shall_be_delivered_after_link_latency(self):
+        self.network.set_link(u"10.0.0.1", u"10.0.0.2", transport.virtual.LinkProfile(latency=0.5))
+        self.transports[0].send(b"data", (ip_address(u"10.0.0.2"), 5683))
+
+        self.network.run(0.4)
+        self.assertEqual(self.receivers["node_1"].counter, 0)
+        self.network.run(0.2)
+        self.assertEqual(self.receivers["node_1"].counter, 1)
+        self.assertEqual(self.receivers["node_1"].remote, (ip_address(u"10.0.0.1"), 5683))
+        self.assertEqual(self.receivers["node_1"].local, (ip_address(u"10.0.0.2"), 5683))
+
+    def test_lossy_link_shall_drop_datagrams_reproducibly(self):
+        def simulate(seed):
+            network = transport.virtual.VirtualNetwork(seed, transport.virtual.LinkProfile(loss=0.5))
+            sender = transport.virtual.VirtualTransport(network, u"10.0.0.1")
+            sender.open()
+            for _ in range(100):
+                sender.send(b"data", (ip_address(u"10.0.0.2"), 5683))
+            network.run()
+            return network.lost
+
+        lost = simulate(7)
+        self.assertGreater(lost, 30)
+        self.assertLess(lost, 70)
+        self.assertEqual(simulate(7), lost)
+
+    def test_bandwidth_shall_serialize_datagrams_on_link(self):
+        self.network.set_link(u"10.0.0.1", u"10.0.0.2", transport.virtual.LinkProfile(latency=0, bandwidth=100))
+        for _ in range(3):
+            self.transports[0].send(b"x" * 100, (ip_address(u"10.0.0.2"), 5683))
+
+        self.network.run(2.5)
+        self.assertEqual(self.receivers["node_1"].counter, 2)
+        self.network.run()
+        self.assertEqual(self.receivers["node_1"].counter, 3)
+        self.assertAlmostEqual(self.network.now, 3.0)
+
+    def test_duplicating_link_shall_deliver_datagram_twice(self):
+        self.network.set_link(u"10.0.0.1", u"10.0.0.2", transport.virtual.LinkProfile(duplication=1.0))
+        self.transports[0].send(b"data", (ip_address(u"10.0.0.2"), 5683))
+        self.network.run()
+        self.assertEqual(self.receivers["node_1"].counter, 2)
+
+    def test_datagram_sent_to_group_shall_reach_members(self):
+        group = ip_address(u"224.0.1.187")
+        self.transports[1].join(group)
+        self.transports[0].send(b"data", (group, 5683))
+        self.network.run()
+        self.assertEqual(self.receivers["node_1"].counter, 1)
+        self.assertEqual(self.receivers["node_1"].local, (group, 5683))
+
+class TestCaptureTransport(unittest.TestCase):
+
+    SERVER = (ip_address(u"10.0.0.1"), 5683)
+    CLIENT = (ip_address(u"10.0.0.2"), 40000)
+
+    def create_server(self, server_transport):
+        root = resource.CoapResource()
+        root.put_child(b"text", TextResource())
+        protocol = core.Coap(server_transport)
+        server_transport.register_receiver(protocol)
+        protocol.register_request_handler(resource.ResourceManager(resource.CoapEndpoint(root)))
+        return protocol
+
+    def record(self, count):
+        capture = io.BytesIO()
+        recorder = transport.capture.RecordingTransport(transport.tester.TesterTransport(5683), capture, self.SERVER)
+        self.create_server(recorder)
+        recorder.open()
+        for mid in range(count):
+            req = message.Message(CON, mid, GET, b"", bytes([mid]))
+            req.opt.uri_path = (b"text", )
+            recorder.transport._receive(req.encode(), self.CLIENT, self.SERVER)
+        recorder.close()
+        self.assertEqual(recorder.recorded, 2 * count)
+        capture.seek(0)
+        return capture
+
+    def test_ip_packet_shall_carry_valid_checksums(self):
+        for source, destination in ((self.CLIENT, self.SERVER),
+                                    ((ip_address(u"fe80::1"), 40000), (ip_address(u"12.34.56.78"), 5683))):
+            packet = transport.capture.ip_packet(b"payload", source, destination)
+            data, parsed_source, parsed_destination = transport.capture.parse_ip_packet(packet)
+            self.assertEqual(data, b"payload")
+            self.assertEqual(parsed_source[1], source[1])
+            self.assertEqual(parsed_destination[1], destination[1])
+        packet = transport.capture.ip_packet(b"payload", self.CLIENT, self.SERVER)
+        self.assertEqual(transport.capture._checksum(packet[:20]), 0)
+        pseudo_header = packet[12:20] + bytes([0, 17]) + packet[24:26]
+        self.assertEqual(transport.capture._checksum(pseudo_header + packet[20:]), 0)
+
+    def test_recorded_capture_shall_contain_inbound_and_outbound_datagrams(self):
+        datagrams = list(transport.capture.read_capture(self.record(2)))
+        self.assertEqual(len(datagrams), 4)
+        _, request, source, destination = datagrams[0]
+        self.assertEqual((source, destination), (self.CLIENT, self.SERVER))
+        self.assertEqual(message.Message.decode(request).code, GET)
+        _, response, source, destination = datagrams[1]
+        self.assertEqual((source, destination), (self.SERVER, self.CLIENT))
+        self.assertEqual(message.Message.decode(response).payload, b"text")
+
+    def test_replay_shall_feed_requests_and_measure_responses(self):
+        replay = transport.capture.ReplayTransport(self.record(10), port=5683)
+        self.create_server(replay)
+        stats = replay.replay()
+        self.assertEqual(stats["replayed"], 10)
+        self.assertEqual(stats["sent"], 10)
+        self.assertEqual(stats["responses"], 10)
+        self.assertGreater(stats["throughput"], 0)
+        self.assertLessEqual(stats["latency_p50"], stats["latency_max"])
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix domain sockets not available")
+class TestUnixSocketTransport(unittest.TestCase):
+
+    receiver_names = ["server", "client"]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_path = os.path.join(self.directory.name, "server.sock")
+        self.server = transport.tunix.UnixSocketTransport(self.server_path)
+        self.client = transport.tunix.UnixSocketTransport(os.path.join(self.directory.name, "client.sock"))
+        self.receivers = TestUtils.create_test_receivers(self.receiver_names)
+
+        self.server.register_receiver(self.receivers["server"])
+        self.client.register_receiver(self.receivers["client"])
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+        self.directory.cleanup()
+
+    def test_unix_transport_data_from_client_shall_reach_server(self):
+        self.server.open()
+        self.client.open()
+
+        self.client.send(b"test request", transport.tunix.unix_endpoint(self.server_path))
+        time.sleep(0.1)
+
+        self.assertEqual(self.receivers["server"].counter, 1)
+        self.assertEqual(self.receivers["server"].data, b"test request")
+        self.assertEqual(self.receivers["server"].remote, self.client.local)
+        self.assertEqual(self.receivers["server"].local, (self.server_path, 0))
+
+        self.server.send(b"test response", self.receivers["server"].remote)
+        time.sleep(0.1)
+
+        self.assertEqual(self.receivers["client"].counter, 1)
+        self.assertEqual(self.receivers["client"].data, b"test response")
+
+    def test_unix_transport_shall_replace_stale_socket_and_remove_it_on_close(self):
+        self.server.open()
+        self.server.close()
+        self.assertFalse(os.path.exists(self.server_path))
+
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.server_path)
+        stale.close()
+        self.server.open()
+        self.assertTrue(os.path.exists(self.server_path))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Abstract namespace is Linux only")
+    def test_unbound_unix_transport_shall_get_abstract_address(self):
+        client = transport.tunix.UnixSocketTransport()
+        client.open()
+        try:
+            self.assertTrue(client.local.addr.startswith("\0"))
+        finally:
+            client.close()
+
+    def test_coap_request_over_unix_transport_shall_get_response(self):
+        root = resource.CoapResource()
+        root.put_child(b"text", TextResource())
+        server_protocol = core.Coap(self.server)
+        self.server.register_receiver(server_protocol)
+        server_protocol.register_request_handler(resource.ResourceManager(resource.CoapEndpoint(root)))
+        client_protocol = core.Coap(self.client)
+        self.client.register_receiver(client_protocol)
+        self.server.open()
+        self.client.open()
+
+        responses = []
+        done = threading.Event()
+
+        def handle_response(result, request, response):
+            responses.append((result, response.payload if response is not None else None))
+            done.set()
+
+        request = message.Message(mtype=CON, code=GET)
+        request.opt.uri_path = (b"text", )
+        request.remote = transport.tunix.unix_endpoint(self.server_path)
+        client_protocol.request(request, handle_response)
+
+        self.assertTrue(done.wait(2))
+        self.assertEqual(responses, [(RESULT_SUCCESS, b"text")])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
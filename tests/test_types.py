@@ -0,0 +1,50 @@
+import unittest
+
+from piccata import types
+
+from ipaddress import ip_address
+
+
+class TestEndpoint(unittest.TestCase):
+
+    def test_endpoint_shall_return_the_same_object_for_the_same_address(self):
+        first = types.endpoint(u"12.34.56.78", 5683)
+        self.assertIs(types.endpoint(u"12.34.56.78", 5683), first)
+        self.assertEqual(first, (ip_address(u"12.34.56.78"), 5683))
+        self.assertIsNot(types.endpoint(u"12.34.56.78", 5684), first)
+
+    def test_endpoint_shall_hash_as_a_plain_tuple(self):
+        remote = types.endpoint(u"12.34.56.78", 5683)
+        entries = {(b"token", remote): 1}
+        self.assertEqual(entries[(b"token", (ip_address(u"12.34.56.78"), 5683))], 1)
+
+    def test_endpoint_shall_unmap_ipv4_mapped_addresses_and_keep_scope(self):
+        self.assertEqual(types.endpoint(u"::ffff:12.34.56.78", 5683).addr, ip_address(u"12.34.56.78"))
+        self.assertEqual(types.endpoint(u"fe80::1%eth0", 5683).addr, ip_address(u"fe80::1%eth0"))
+        self.assertNotEqual(types.endpoint(u"fe80::1%eth0", 5683), types.endpoint(u"fe80::1%eth1", 5683))
+        self.assertEqual(types.endpoint(ip_address(u"12.34.56.78").packed, 5683).addr, ip_address(u"12.34.56.78"))
+
+    def test_endpoint_table_size_shall_be_configurable(self):
+        try:
+            types.set_max_interned_endpoints(20000)
+            endpoints = [types.endpoint(u"10.0.%d.%d" % (i // 250, i % 250), 5683) for i in range(15000)]
+            self.assertIs(types.endpoint(u"10.0.0.0", 5683), endpoints[0])
+
+            types.set_max_interned_endpoints(10)
+            self.assertLessEqual(len(types._interned_endpoints), 10)
+            self.assertIsNot(types.endpoint(u"10.0.0.0", 5683), endpoints[0])
+
+            with self.assertRaises(ValueError):
+                types.set_max_interned_endpoints(0)
+        finally:
+            types.set_max_interned_endpoints(types.MAX_INTERNED_ENDPOINTS)
+
+    def test_endpoint_shall_raise_error_on_invalid_address(self):
+        with self.assertRaises(ValueError):
+            types.endpoint(u"example.com", 5683)
+
+    def test_endpoint_shall_keep_unix_socket_paths(self):
+        remote = types.endpoint(types.UnixAddress(u"/run/gateway%1.sock"), 0)
+        self.assertEqual(remote.addr, u"/run/gateway%1.sock")
+        self.assertIsInstance(remote.addr, types.UnixAddress)
+        self.assertFalse(remote.addr.is_multicast)
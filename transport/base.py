@@ -7,6 +7,13 @@ An abstract base class for specific transport classes.
 from abc import ABC, abstractmethod
 
 class TransportBase(ABC):
+
+    mtu = None
+    """Largest datagram the transport is able to carry in bytes, None if unknown."""
+
+    source_selection = False
+    """True if send accepts a source address, so responses can be sent from the address a request was received on."""
+
     @abstractmethod
     def __init__(self, port):
         """Initializes transport.
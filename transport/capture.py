@@ -0,0 +1,344 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Recording of datagrams to pcap files and replaying of captures into a protocol instance.
+"""
+import logging
+import struct
+import threading
+import time
+
+from ipaddress import IPv4Address, IPv6Address
+
+from piccata.types import endpoint
+from transport.base import TransportBase
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+
+_PCAP_MAGIC = 0xa1b2c3d4
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+"""pcap file header: magic, version, time zone, accuracy, snapshot length, link type."""
+
+_PCAP_RECORD = struct.Struct('<IIII')
+"""pcap record header: seconds, microseconds, captured length, original length."""
+
+_IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_IPV6_HEADER = struct.Struct('!IHBB16s16s')
+_UDP_HEADER = struct.Struct('!HHHH')
+
+_IPPROTO_UDP = 17
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPE_VLAN = 0x8100
+
+
+def _checksum(data):
+    if len(data) & 1:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _common_family(source, destination):
+    """Get addresses of a single family, mapping IPv4 addresses to IPv6 if the families differ."""
+    if source.version == destination.version:
+        return source, destination
+    return tuple(IPv6Address('::ffff:' + str(address)) if address.version == 4 else address
+                 for address in (source, destination))
+
+
+def ip_packet(data, source, destination):
+    """Build an IP packet carrying a UDP datagram.
+
+    Args:
+        data (bytes): A UDP payload.
+        source (piccata.types.Endpoint): A source address and port.
+        destination (piccata.types.Endpoint): A destination address and port.
+
+    Returns:
+        bytes: An IPv4 or IPv6 packet with a UDP header.
+    """
+    source_address, destination_address = _common_family(source[0], destination[0])
+    length = _UDP_HEADER.size + len(data)
+    pseudo_header = source_address.packed + destination_address.packed
+    if source_address.version == 4:
+        pseudo_header += struct.pack('!BBH', 0, _IPPROTO_UDP, length)
+    else:
+        pseudo_header += struct.pack('!IxxxB', length, _IPPROTO_UDP)
+    checksum = _checksum(pseudo_header + _UDP_HEADER.pack(source[1], destination[1], length, 0) + data) or 0xFFFF
+    udp = _UDP_HEADER.pack(source[1], destination[1], length, checksum) + data
+
+    if source_address.version == 4:
+        header = _IPV4_HEADER.pack(0x45, 0, _IPV4_HEADER.size + len(udp), 0, 0x4000, 64, _IPPROTO_UDP, 0,
+                                   source_address.packed, destination_address.packed)
+        header = header[:10] + struct.pack('!H', _checksum(header)) + header[12:]
+    else:
+        header = _IPV6_HEADER.pack(6 << 28, len(udp), _IPPROTO_UDP, 64,
+                                   source_address.packed, destination_address.packed)
+    return header + udp
+
+
+def parse_ip_packet(packet):
+    """Get the UDP datagram carried by an IP packet.
+
+    Args:
+        packet (bytes): An IPv4 or IPv6 packet.
+
+    Returns:
+        tuple: A (data, source, destination) tuple, or None if the packet does not carry an unfragmented UDP datagram.
+    """
+    if not packet:
+        return None
+    version = packet[0] >> 4
+    if version == 4 and len(packet) >= _IPV4_HEADER.size:
+        header = _IPV4_HEADER.unpack_from(packet)
+        if header[6] != _IPPROTO_UDP or header[4] & 0x3FFF:
+            return None
+        offset = (header[0] & 0x0F) * 4
+        source, destination = IPv4Address(header[8]), IPv4Address(header[9])
+    elif version == 6 and len(packet) >= _IPV6_HEADER.size:
+        header = _IPV6_HEADER.unpack_from(packet)
+        if header[2] != _IPPROTO_UDP:
+            return None
+        offset = _IPV6_HEADER.size
+        source, destination = IPv6Address(header[4]), IPv6Address(header[5])
+    else:
+        return None
+
+    if len(packet) < offset + _UDP_HEADER.size:
+        return None
+    source_port, destination_port, length, _ = _UDP_HEADER.unpack_from(packet, offset)
+    data = packet[offset + _UDP_HEADER.size:offset + length]
+    return data, endpoint(source, source_port), endpoint(destination, destination_port)
+
+
+def read_capture(capture):
+    """Read UDP datagrams from a pcap file. Packets other than UDP over IP are skipped.
+
+    Args:
+        capture (file): A binary file with LINKTYPE_RAW or LINKTYPE_ETHERNET capture.
+
+    Returns:
+        generator: (timestamp, data, source, destination) tuples.
+    """
+    header = capture.read(_PCAP_HEADER.size)
+    if len(header) < _PCAP_HEADER.size:
+        raise ValueError("Not a pcap file")
+    magic = struct.unpack('<I', header[:4])[0]
+    if magic in (_PCAP_MAGIC, 0xa1b23c4d):
+        endianness = '<'
+    elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+        endianness = '>'
+    else:
+        raise ValueError("Not a pcap file")
+    fraction = 1e-9 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1e-6
+    linktype = struct.unpack(endianness + 'I', header[20:24])[0]
+    if linktype not in (LINKTYPE_RAW, LINKTYPE_ETHERNET):
+        raise ValueError("Unsupported link type %d" % linktype)
+    record_header = struct.Struct(endianness + 'IIII')
+
+    while True:
+        record = capture.read(record_header.size)
+        if len(record) < record_header.size:
+            return
+        seconds, fractions, captured, _ = record_header.unpack(record)
+        packet = capture.read(captured)
+        if linktype == LINKTYPE_ETHERNET:
+            if len(packet) < 18:
+                continue
+            ethertype, offset = struct.unpack_from('!H', packet, 12)[0], 14
+            if ethertype == _ETHERTYPE_VLAN:
+                ethertype, offset = struct.unpack_from('!H', packet, 16)[0], 18
+            if ethertype not in (_ETHERTYPE_IPV4, _ETHERTYPE_IPV6):
+                continue
+            packet = packet[offset:]
+        datagram = parse_ip_packet(packet)
+        if datagram is not None:
+            yield (seconds + fractions * fraction, ) + datagram
+
+
+class RecordingTransport(TransportBase):
+    """A transport wrapper writing every datagram sent and received to a pcap file (LINKTYPE_RAW).
+
+    IP and UDP headers are synthesized from the endpoints of datagrams, so captures can be inspected
+    with common tools and replayed with ReplayTransport.
+    """
+
+    def __init__(self, transport, capture, local=None, clock=None):
+        """Initializes transport.
+
+        Args:
+            transport (transport.TransportBase): A transport that is wrapped.
+            capture (file): A binary file the capture is written to. It is not closed by the transport.
+            local (piccata.types.Endpoint): An address used as the source of datagrams sent, and as the destination
+                of datagrams received without one. May be None for the unspecified address and port of the transport.
+            clock (piccata.clock.Clock): A clock giving timestamps. May be None for the wall clock.
+        """
+        TransportBase.__init__(self, transport._port)
+
+        self.transport = transport
+        self.mtu = transport.mtu
+        self.source_selection = transport.source_selection
+        self.local = local
+        self.clock = clock
+        self.recorded = 0
+
+        self._capture = capture
+        self._lock = threading.Lock()
+        self._capture.write(_PCAP_HEADER.pack(_PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        transport.register_receiver(self)
+
+    def _local(self, remote):
+        if self.local is not None:
+            return self.local
+        unspecified = IPv4Address(0) if remote[0].version == 4 else IPv6Address(0)
+        return endpoint(unspecified, self._port or 0)
+
+    def _record(self, data, source, destination):
+        timestamp = self.clock.now() if self.clock is not None else time.time()
+        packet = ip_packet(data, source, destination)
+        seconds = int(timestamp)
+        with self._lock:
+            self._capture.write(_PCAP_RECORD.pack(seconds, int((timestamp - seconds) * 1e6), len(packet), len(packet)))
+            self._capture.write(packet)
+            self.recorded += 1
+
+    def open(self):
+        self.transport.open()
+
+    def close(self):
+        self.transport.close()
+        with self._lock:
+            self._capture.flush()
+
+    def send(self, data, dest, source=None):
+        """Sends data to the specified destination and records it.
+
+        Args:
+            data (bytes): A data to send.
+            dest (piccata.types.Endpoint): A tuple of destination IP address an UDP port.
+            source (piccata.types.Endpoint): A local address to send from. Passed to the wrapped transport
+                if it supports source selection.
+        """
+        self._record(data, source if source is not None and not source[0].is_multicast else self._local(dest), dest)
+        if source is not None and self.source_selection:
+            self.transport.send(data, dest, source)
+        else:
+            self.transport.send(data, dest)
+
+    def receive(self, data, remote, local):
+        """Record a datagram received by the wrapped transport and pass it to the receivers."""
+        self._record(data, remote, local if local is not None else self._local(remote))
+        self._receive(data, remote, local)
+
+
+def _token_key(data, remote):
+    """Get the (remote, token) key of a CoAP message, None if the message is too short."""
+    if len(data) < 4:
+        return None
+    return (remote, data[4:4 + (data[0] & 0x0F)])
+
+
+class ReplayTransport(TransportBase):
+    """A transport feeding datagrams from a capture into the registered receivers (e.g. a Coap instance).
+
+    Datagrams sent by the receivers are not transmitted, but are matched by remote address and token to the
+    replayed datagrams, so the time from feeding a request to sending its response is measured. Handlers shall
+    respond in the thread calling replay (no executor) for the throughput to include processing.
+    """
+
+    def __init__(self, capture, port=None, speed=None):
+        """Initializes transport.
+
+        Args:
+            capture (file): A binary pcap file, as written by RecordingTransport or captured from a network.
+            port (int): A destination port of datagrams replayed. May be None to replay all UDP datagrams.
+            speed (float): A factor the original pace of the capture is multiplied by (e.g. 1.0 for the original speed,
+                10.0 for ten times faster). May be None to replay as fast as possible.
+        """
+        TransportBase.__init__(self, port)
+
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed shall be positive")
+
+        self.speed = speed
+        self._capture = capture
+        self._lock = threading.Lock()
+        self._fed = {}  # feeding times of datagrams waiting for a response (identified by remote and token)
+        self._latencies = []
+        self.replayed = 0
+        self.sent = 0
+        self.duration = 0.0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, data, dest, source=None):
+        """Count a datagram sent by a receiver and measure its latency if it answers a replayed datagram."""
+        now = time.perf_counter()
+        key = _token_key(data, dest)
+        with self._lock:
+            self.sent += 1
+            fed = self._fed.pop(key, None)
+            if fed is not None:
+                self._latencies.append(now - fed)
+
+    def replay(self, limit=None):
+        """Feed the capture to the receivers.
+
+        Args:
+            limit (int): A maximum number of datagrams replayed. May be None to replay the whole capture.
+
+        Returns:
+            dict: Replay statistics, see stats.
+        """
+        started = time.perf_counter()
+        first = None
+        for timestamp, data, source, destination in read_capture(self._capture):
+            if limit is not None and self.replayed >= limit:
+                break
+            if self._port is not None and destination[1] != self._port:
+                continue
+            if self.speed is not None:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            key = _token_key(data, source)
+            if key is not None:
+                with self._lock:
+                    self._fed[key] = time.perf_counter()
+            self.replayed += 1
+            try:
+                self._receive(data, source, destination)
+            except Exception:
+                logging.exception("Exception while processing replayed datagram")
+        self.duration = time.perf_counter() - started
+        return self.stats()
+
+    def stats(self):
+        """Get replay statistics.
+
+        Returns:
+            dict: Numbers of datagrams replayed and sent, the replay duration in seconds, the throughput in datagrams
+                per second, and the mean, median, 99th percentile and maximum latency in seconds of responses.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        stats = {'replayed': self.replayed, 'sent': self.sent, 'duration': self.duration,
+                 'throughput': self.replayed / self.duration if self.duration > 0 else 0.0,
+                 'responses': len(latencies)}
+        if latencies:
+            stats.update({'latency_mean': sum(latencies) / len(latencies),
+                          'latency_p50': latencies[len(latencies) // 2],
+                          'latency_p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                          'latency_max': latencies[-1]})
+        return stats
@@ -0,0 +1,175 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+Sharding of a CoAP server across worker processes sharing a UDP port with SO_REUSEPORT.
+"""
+import ctypes
+import logging
+import multiprocessing
+import socket
+
+from piccata.core import Coap
+from piccata.dedup import SharedDeduplicationStore
+
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51)
+
+# Classic BPF instruction encoding (linux/filter.h).
+_BPF_LD_W_ABS = 0x00 | 0x00 | 0x20
+_BPF_LD_H_ABS = 0x00 | 0x08 | 0x20
+_BPF_LD_B_ABS = 0x00 | 0x10 | 0x20
+_BPF_MISC_TAX = 0x07 | 0x00
+_BPF_ALU_AND_K = 0x04 | 0x50 | 0x00
+_BPF_ALU_XOR_X = 0x04 | 0xa0 | 0x08
+_BPF_ALU_MOD_K = 0x04 | 0x90 | 0x00
+_BPF_JMP_JEQ_K = 0x05 | 0x10 | 0x00
+_BPF_RET_A = 0x06 | 0x10
+
+_SKF_NET_OFF = -0x100000
+"""Offset of the network header in classic BPF absolute loads."""
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16),
+                ('jt', ctypes.c_uint8),
+                ('jf', ctypes.c_uint8),
+                ('k', ctypes.c_uint32)]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_ushort),
+                ('filter', ctypes.POINTER(_SockFilter))]
+
+
+def _source_hash(address_offset, port_offset, workers):
+    """Assemble instructions returning (source address ^ source port) % workers for given header offsets."""
+    return [(_BPF_LD_W_ABS, 0, 0, (_SKF_NET_OFF + address_offset) & 0xFFFFFFFF),
+            (_BPF_MISC_TAX, 0, 0, 0),
+            (_BPF_LD_H_ABS, 0, 0, (_SKF_NET_OFF + port_offset) & 0xFFFFFFFF),
+            (_BPF_ALU_XOR_X, 0, 0, 0),
+            (_BPF_ALU_MOD_K, 0, 0, workers),
+            (_BPF_RET_A, 0, 0, 0)]
+
+
+def source_steering_program(workers, family=socket.AF_INET):
+    """Assemble a classic BPF program selecting a socket by the source address of a datagram.
+
+    The program returns (source address ^ source port) % workers, so all datagrams of a remote endpoint
+    reach the same socket of the SO_REUSEPORT group. For IPv6 the last 32 bits of the address are used.
+    IPv4 headers are assumed to carry no options. AF_INET6 sockets are dual-stack, so their program checks
+    the IP version of every datagram and hashes IPv4 ones by the IPv4 header.
+
+    Args:
+        workers (int): A number of sockets in the group.
+        family (int): An address family of the sockets, AF_INET or AF_INET6.
+
+    Returns:
+        list: A list of (code, jt, jf, k) instructions.
+    """
+    if workers < 1:
+        raise ValueError("At least one worker is required")
+    ipv4 = _source_hash(12, 20, workers)
+    if family == socket.AF_INET:
+        return ipv4
+    elif family != socket.AF_INET6:
+        raise ValueError("Unsupported address family")
+
+    # IPv4 datagrams received by a dual-stack socket carry an IPv4 header.
+    return ([(_BPF_LD_B_ABS, 0, 0, _SKF_NET_OFF & 0xFFFFFFFF),
+             (_BPF_ALU_AND_K, 0, 0, 0xF0),
+             (_BPF_JMP_JEQ_K, 0, len(ipv4), 0x40)] +
+            ipv4 + _source_hash(20, 40, workers))
+
+
+def attach_steering_program(sock, program):
+    """Attach a classic BPF program selecting sockets of the SO_REUSEPORT group of a socket (Linux only).
+
+    Args:
+        sock (socket.socket): A socket bound with SO_REUSEPORT.
+        program (list): A list of (code, jt, jf, k) instructions.
+    """
+    instructions = (_SockFilter * len(program))(*[_SockFilter(*instruction) for instruction in program])
+    fprog = _SockFprog(len(program), instructions)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, bytes(fprog))
+
+
+def _run_worker(index, transport_factory, setup, stop_event, deduplication_store):
+    transport = transport_factory(index)
+    protocol = Coap(transport, deduplication_store=deduplication_store)
+    transport.register_receiver(protocol)
+    setup(protocol, index)
+    transport.open()
+    logging.info("Worker %d serving" % index)
+    try:
+        stop_event.wait()
+    finally:
+        transport.close()
+
+
+class ReusePortServer(object):
+    """Runs independent CoAP servers in worker processes sharing a single UDP port.
+
+    Every worker binds its own SocketTransport with SO_REUSEPORT and runs its own Coap instance.
+    Datagrams are steered to workers by their source address (with a BPF program, or the kernel
+    flow hash if steering is disabled), so deduplication and transaction state of a remote
+    endpoint stay in a single worker.
+    """
+
+    def __init__(self, port, workers, setup, steering=True, shared_deduplication=False, deduplication_slots=65536):
+        """Initialize.
+
+        Args:
+            port (int): A UDP port served.
+            workers (int): A number of worker processes.
+            setup (function): A function called in every worker as setup(protocol, index) to register
+                a request handler (e.g. a ResourceManager) with the protocol.
+            steering (bool): If True, a BPF program assigns remote endpoints to workers. Otherwise
+                the kernel hash of the 4-tuple is used, which changes when the number of sockets does.
+            shared_deduplication (bool): If True, workers share a table of received message IDs, so duplicates
+                landing in a different worker (e.g. after a worker restart) are not processed again.
+            deduplication_slots (int): A size of the shared table, a power of two.
+        """
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+
+        self.port = port
+        self.workers = workers
+        self.setup = setup
+        self.steering = steering
+
+        self._context = multiprocessing.get_context('fork')
+        self._stop_event = self._context.Event()
+        self._processes = []
+        self.deduplication_store = None
+        if shared_deduplication:
+            self.deduplication_store = SharedDeduplicationStore(deduplication_slots, lock=self._context.Lock())
+
+    def _create_transport(self, index):
+        from transport.tsocket import SocketTransport
+
+        return SocketTransport(self.port, reuse_port=True, steering_workers=self.workers if self.steering else None)
+
+    def start(self):
+        """Fork the worker processes."""
+        for index in range(self.workers):
+            process = self._context.Process(target=_run_worker,
+                                            args=(index, self._create_transport, self.setup, self._stop_event,
+                                                  self.deduplication_store),
+                                            daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def stop(self):
+        """Stop the worker processes and wait for them to exit."""
+        self._stop_event.set()
+        for process in self._processes:
+            process.join()
+        self._processes = []
+        if self.deduplication_store is not None:
+            self.deduplication_store.close()
+            self.deduplication_store.unlink()
+            self.deduplication_store = None
+
+    def join(self):
+        """Wait for the worker processes to exit."""
+        for process in self._processes:
+            process.join()
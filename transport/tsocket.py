@@ -4,31 +4,93 @@ Copyright (c) 2017 Nordic Semiconductor ASA
 CoAP transport implmentation based on sockets.
 """
 import socket
+import struct
 import time
 import errno
+import ipaddress
 
 from threading import Thread
-from ipaddress import ip_address
+from piccata.types import endpoint
 from transport.base import TransportBase
+from transport.reuseport import attach_steering_program, source_steering_program
 
 MTU = 1500
 
+POLL_INTERVAL = 0.1
+"""Time in seconds the listener thread waits for a datagram before checking whether it shall terminate."""
+
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+IPV6_MULTICAST_ALL = getattr(socket, 'IPV6_MULTICAST_ALL', 29)
+
+_IN_PKTINFO = struct.Struct('=I4s4s')
+"""struct in_pktinfo: interface index, local address (used as source when sending), destination address."""
+
+_IN6_PKTINFO = struct.Struct('=16sI')
+"""struct in6_pktinfo: address, interface index."""
+
+_ANCILLARY_SIZE = socket.CMSG_SPACE(_IN6_PKTINFO.size)
+
+
+def _interface_index(address):
+    """Get the index of the interface an IPv6 address is scoped to.
+
+    Args:
+        address (ipaddress.IPv4Address or ipaddress.IPv6Address): An address, e.g. fe80::1%eth0 or fe80::1%2.
+
+    Returns:
+        int: An interface index, 0 if the address has no known scope.
+    """
+    scope = getattr(address, 'scope_id', None)
+    if not scope:
+        return 0
+    if scope.isdigit():
+        return int(scope)
+    try:
+        return socket.if_nametoindex(scope)
+    except OSError:
+        return 0
+
+
+def _remote_endpoint(addr):
+    """Get the endpoint of a socket address, keeping the scope ID of IPv6 (host, port, flowinfo, scope_id) addresses."""
+    if len(addr) == 4 and addr[3]:
+        return endpoint("%s%%%d" % (addr[0], addr[3]), addr[1])
+    return endpoint(addr[0], addr[1])
+
+
 class ListenerThread(Thread):
 
-    def __init__(self, sock, receive_callback):
+    def __init__(self, sock, receive_callback, read=None):
+        """Initialize.
+
+        Args:
+            sock (socket.socket): A socket to read from.
+            receive_callback (function): A function called as receive_callback(data, remote, local).
+            read (function): A function reading a datagram from the socket, returning (data, remote, local).
+                May be None to read with recvfrom and report the socket address as local.
+        """
         Thread.__init__(self)
 
         self.daemon = True
 
         self._sock = sock
         self._receive_callback = receive_callback
+        self._read = read if read is not None else self._recvfrom
         self._terminate = False
 
+    def _recvfrom(self):
+        data, addr = self._sock.recvfrom(MTU)
+        own_addr = self._sock.getsockname()
+        return data, _remote_endpoint(addr), endpoint(own_addr[0], own_addr[1])
+
     def run(self):
         while not self._terminate:
             try:
-                data, addr = self._sock.recvfrom(MTU)
-                addr = (ip_address(addr[0]), addr[1])
+                data, addr, own_addr = self._read()
+            except socket.timeout:
+                # Blocking sockets time out periodically to check for termination.
+                continue
             except socket.error as e:
                 err = e.args[0]
                 if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
@@ -44,8 +106,6 @@ class ListenerThread(Thread):
                     print("shutdown!")
                     break
                 else:
-                    own_addr = self._sock.getsockname()
-                    own_addr = (ip_address(own_addr[0]), own_addr[1])
                     self._receive_callback(data, addr, own_addr)
 
     def stop(self):
@@ -53,9 +113,33 @@ class ListenerThread(Thread):
 
 class SocketTransport(TransportBase):
 
-    def __init__(self, port=0):
+    mtu = MTU
+
+    def __init__(self, port=0, reuse_port=False, steering_workers=None, family=socket.AF_INET, pktinfo=False):
+        """Initializes transport.
+
+        Args:
+            port (int): A port number that transport shall use.
+            reuse_port (bool): If True, the port may be shared with other sockets (SO_REUSEPORT),
+                e.g. of other worker processes.
+            steering_workers (int): A number of sockets sharing the port. If given, datagrams are steered
+                to the sockets by their source address (Linux only). May be None for kernel flow hashing.
+            family (int): AF_INET, or AF_INET6 for a dual-stack socket receiving both IPv6 and IPv4 datagrams.
+            pktinfo (bool): If True, the actual destination address of every datagram is reported as local
+                (IP_PKTINFO/IPV6_RECVPKTINFO), and responses are sent from that address. Useful on multi-homed
+                hosts. Otherwise the bound socket address is reported.
+        """
         TransportBase.__init__(self, port)
 
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            raise ValueError("Unsupported address family")
+
+        self._reuse_port = reuse_port
+        self._steering_workers = steering_workers
+        self._family = family
+        self._pktinfo = pktinfo
+        self.source_selection = pktinfo
+        self._own_address = None
         self._sock = None
         self._listener_thread = None
 
@@ -64,16 +148,54 @@ class SocketTransport(TransportBase):
         self._listener_thread.join()
         self._listener_thread = None
 
+    def _recvfrom(self):
+        data, addr = self._sock.recvfrom(MTU)
+        return data, _remote_endpoint(addr), self._own_address
+
+    def _recvmsg(self):
+        data, ancdata, _, addr = self._sock.recvmsg(MTU, _ANCILLARY_SIZE)
+        local = self._own_address
+        for level, ctype, cdata in ancdata:
+            if level == socket.IPPROTO_IPV6 and ctype == socket.IPV6_PKTINFO:
+                packed, index = _IN6_PKTINFO.unpack(cdata[:_IN6_PKTINFO.size])
+                address = ipaddress.IPv6Address(packed)
+                if address.is_link_local or (address.is_multicast and (packed[1] & 0x0F) <= 2):
+                    # Link-local addresses are ambiguous on multi-homed hosts without the interface.
+                    local = endpoint("%s%%%d" % (address, index), local[1])
+                else:
+                    local = endpoint(packed, local[1])
+            elif level == socket.IPPROTO_IP and ctype == IP_PKTINFO:
+                local = endpoint(_IN_PKTINFO.unpack(cdata[:_IN_PKTINFO.size])[2], local[1])
+        return data, _remote_endpoint(addr), local
+
     def open(self):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock.setblocking(0)
-        self._sock.bind(('', self._port))
+        self._sock = socket.socket(self._family, socket.SOCK_DGRAM)
+        # Reads block, so datagrams are handled as soon as they arrive rather than on the next poll.
+        self._sock.settimeout(POLL_INTERVAL)
+        if self._reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self._family == socket.AF_INET6:
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            if self._pktinfo:
+                self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+            self._sock.bind(('::', self._port))
+        else:
+            if self._pktinfo:
+                self._sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            self._sock.bind(('', self._port))
+        if self._reuse_port and self._steering_workers is not None:
+            attach_steering_program(self._sock, source_steering_program(self._steering_workers, self._family))
+
+        # The bound address does not change, so it is looked up once.
+        own_addr = self._sock.getsockname()
+        self._own_address = endpoint(own_addr[0], own_addr[1])
 
         # Start the listener thread.
         if self._listener_thread != None:
             self._close_listener()
 
-        self._listener_thread = ListenerThread(self._sock, self._receive)
+        read = self._recvmsg if self._pktinfo else self._recvfrom
+        self._listener_thread = ListenerThread(self._sock, self._receive, read)
         self._listener_thread.start()
 
     def close(self):
@@ -85,5 +207,130 @@ class SocketTransport(TransportBase):
             self._sock.close()
             self._sock = None
 
-    def send(self, data, dest):
-        self._sock.sendto(data, (str(dest[0]), dest[1]))
+    def _sockaddr(self, address):
+        if self._family == socket.AF_INET6 and address.version == 4:
+            return '::ffff:' + str(address)
+        return str(address)
+
+    def send(self, data, dest, source=None):
+        """Sends data to the specified destination.
+
+        Args:
+            data (bytes): A data to send.
+            dest (piccata.types.Endpoint): A tuple of destination IP address an UDP port.
+            source (piccata.types.Endpoint): A local address to send from (e.g. the destination of the request
+                responded to). May be None to let the system choose. Ignored for multicast addresses.
+        """
+        sockaddr = (self._sockaddr(dest[0]), dest[1])
+        if source is None or not self._pktinfo or source[0].is_multicast or source[0].is_unspecified:
+            self._sock.sendto(data, sockaddr)
+        elif self._family == socket.AF_INET6:
+            address = socket.inet_pton(socket.AF_INET6, self._sockaddr(source[0]).split('%', 1)[0])
+            # The interface of a scoped source (e.g. a link-local address) is kept, so the reply leaves on it.
+            pktinfo = _IN6_PKTINFO.pack(address, _interface_index(source[0]) or _interface_index(dest[0]))
+            self._sock.sendmsg([data], [(socket.IPPROTO_IPV6, socket.IPV6_PKTINFO, pktinfo)], 0, sockaddr)
+        else:
+            pktinfo = _IN_PKTINFO.pack(0, source[0].packed, bytes(4))
+            self._sock.sendmsg([data], [(socket.IPPROTO_IP, IP_PKTINFO, pktinfo)], 0, sockaddr)
+
+
+_IP_MREQN = struct.Struct('=4s4si')
+"""struct ip_mreqn: multicast group, local address, interface index."""
+
+_IPV6_MREQ = struct.Struct('=16sI')
+"""struct ipv6_mreq: multicast group, interface index."""
+
+
+class MulticastSocketTransport(SocketTransport):
+    """A socket transport that is a member of multicast groups (Linux only).
+
+    Received datagrams report their destination address as local, so requests sent to a group
+    can be told apart from unicast ones. Several transports of a host may share the port.
+    """
+
+    def __init__(self, port=0, groups=(), family=socket.AF_INET, interface=0, hop_limit=1, loopback=True):
+        """Initializes transport.
+
+        Args:
+            port (int): A port number that transport shall use.
+            groups (list): Multicast addresses (ipaddress.IPv4Address or ipaddress.IPv6Address) joined when opened.
+            family (int): AF_INET, or AF_INET6 for a dual-stack socket that may join both IPv6 and IPv4 groups.
+            interface (int or str): An index or name of the network interface used for the groups and for sending
+                multicast datagrams. 0 to let the system choose.
+            hop_limit (int): A TTL (IPv4) or hop limit (IPv6) of multicast datagrams sent.
+            loopback (bool): If True, multicast datagrams sent are delivered to group members on this host as well.
+        """
+        SocketTransport.__init__(self, port, reuse_port=True, family=family, pktinfo=True)
+
+        if isinstance(interface, str):
+            interface = socket.if_nametoindex(interface)
+        if not 0 <= hop_limit <= 255:
+            raise ValueError("Hop limit shall be in range 0-255")
+
+        self.interface = interface
+        self.hop_limit = hop_limit
+        self.loopback = loopback
+        self.groups = set()
+        self._initial_groups = list(groups)
+
+    def open(self):
+        SocketTransport.open(self)
+
+        # Only datagrams of the groups joined by this socket are received, not of all groups joined on the host.
+        loop = 1 if self.loopback else 0
+        self._sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+        if self._family == socket.AF_INET6:
+            self._sock.setsockopt(socket.IPPROTO_IPV6, IPV6_MULTICAST_ALL, 0)
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, self.hop_limit)
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, loop)
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, self.interface)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.hop_limit)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, loop)
+        if self.interface:
+            self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, _IP_MREQN.pack(bytes(4), bytes(4), self.interface))
+
+        groups = self._initial_groups + list(self.groups)
+        self.groups = set()
+        for group in groups:
+            self.join(group)
+
+    def close(self):
+        groups = self.groups
+        SocketTransport.close(self)
+        # Closing the socket leaves the groups, they are joined again when reopened.
+        self._initial_groups = list(groups)
+        self.groups = set()
+
+    def _membership(self, group, join):
+        if not group.is_multicast:
+            raise ValueError("%s is not a multicast address" % group)
+        if group.version == 6:
+            if self._family != socket.AF_INET6:
+                raise ValueError("IPv6 groups require an AF_INET6 transport")
+            option = socket.IPV6_JOIN_GROUP if join else socket.IPV6_LEAVE_GROUP
+            self._sock.setsockopt(socket.IPPROTO_IPV6, option, _IPV6_MREQ.pack(group.packed, self.interface))
+        else:
+            option = socket.IP_ADD_MEMBERSHIP if join else socket.IP_DROP_MEMBERSHIP
+            self._sock.setsockopt(socket.IPPROTO_IP, option, _IP_MREQN.pack(group.packed, bytes(4), self.interface))
+
+    def join(self, group):
+        """Join a multicast group. The transport shall be open.
+
+        Args:
+            group (ipaddress.IPv4Address or ipaddress.IPv6Address): A multicast address.
+        """
+        if group in self.groups:
+            return
+        self._membership(group, True)
+        self.groups.add(group)
+
+    def leave(self, group):
+        """Leave a multicast group. The transport shall be open.
+
+        Args:
+            group (ipaddress.IPv4Address or ipaddress.IPv6Address): A multicast address joined before.
+        """
+        if group not in self.groups:
+            return
+        self._membership(group, False)
+        self.groups.discard(group)
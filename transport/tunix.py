@@ -0,0 +1,115 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+CoAP transport implementation based on Unix domain datagram sockets, for communication between processes of a host.
+"""
+import os
+import socket
+import stat
+
+from piccata.types import Endpoint, UnixAddress
+from transport.base import TransportBase
+from transport.tsocket import POLL_INTERVAL, ListenerThread
+
+MTU = 65507
+"""Largest datagram sent, the same as over loopback UDP so the same block sizes may be used."""
+
+
+def unix_endpoint(path):
+    """Get the endpoint of a Unix domain socket.
+
+    Args:
+        path (str or bytes): A filesystem path of the socket, or an abstract address starting with a null character.
+
+    Returns:
+        piccata.types.Endpoint: An endpoint with the path as address and port 0.
+    """
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', 'surrogateescape')
+    return Endpoint(UnixAddress(path), 0)
+
+
+class UnixSocketTransport(TransportBase):
+    """A transport over AF_UNIX SOCK_DGRAM sockets.
+
+    Remote endpoints are (piccata.types.UnixAddress, 0) tuples, so the transport is used by Coap like
+    a UDP one. Datagrams are not lost or reordered by the kernel and skip the IP stack, which lowers latency
+    and CPU usage of services talking to a daemon on the same host. Requests shall be sent from a bound
+    transport, otherwise responses cannot be addressed.
+    """
+
+    mtu = MTU
+
+    def __init__(self, path=None):
+        """Initializes transport.
+
+        Args:
+            path (str): A filesystem path the socket is bound to. A stale socket file is replaced. May be None
+                to bind to an address assigned by the system in the abstract namespace (Linux only).
+        """
+        TransportBase.__init__(self, 0)
+
+        self.path = path
+        self.local = None
+        self._sock = None
+        self._listener_thread = None
+        self._created_path = None
+
+    def _close_listener(self):
+        self._listener_thread.stop()
+        self._listener_thread.join()
+        self._listener_thread = None
+
+    def _recvfrom(self):
+        data, addr = self._sock.recvfrom(MTU)
+        # Unbound senders have no address, they are reported with an empty path.
+        return data, unix_endpoint(addr or ''), self.local
+
+    def open(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Reads block, so datagrams are handled as soon as they arrive rather than on the next poll.
+        self._sock.settimeout(POLL_INTERVAL)
+        if self.path is None:
+            self._sock.bind('')
+        else:
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self._sock.bind(self.path)
+            self._created_path = self.path
+
+        self.local = unix_endpoint(self._sock.getsockname())
+
+        # Start the listener thread.
+        if self._listener_thread != None:
+            self._close_listener()
+
+        self._listener_thread = ListenerThread(self._sock, self._receive, self._recvfrom)
+        self._listener_thread.start()
+
+    def close(self):
+        # Wait for the listener thread to finish
+        if self._listener_thread != None:
+            self._close_listener()
+
+        if self._sock != None:
+            self._sock.close()
+            self._sock = None
+
+        if self._created_path is not None:
+            try:
+                os.unlink(self._created_path)
+            except FileNotFoundError:
+                pass
+            self._created_path = None
+
+    def send(self, data, dest):
+        """Sends data to the specified destination.
+
+        Args:
+            data (bytes): A data to send.
+            dest (piccata.types.Endpoint): A tuple of destination socket path and port 0.
+        """
+        self._sock.sendto(data, str(dest[0]))
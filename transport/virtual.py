@@ -0,0 +1,282 @@
+"""
+Copyright (c) 2017 Nordic Semiconductor ASA
+
+In-memory virtual network for simulating many CoAP endpoints without sockets.
+"""
+import collections
+import logging
+import random
+import threading
+
+from piccata.clock import VirtualClock
+from piccata.types import endpoint
+from transport.base import TransportBase
+
+EPHEMERAL_PORT_START = 49152
+"""First port number assigned to transports opened with port 0."""
+
+
+class LinkProfile(object):
+    """Properties of a simulated link, applied to every datagram sent over it."""
+
+    __slots__ = ('latency', 'jitter', 'loss', 'duplication', 'reordering', 'bandwidth')
+
+    def __init__(self, latency=0.01, jitter=0.0, loss=0.0, duplication=0.0, reordering=0.0, bandwidth=None):
+        """Initialize.
+
+        Args:
+            latency (float): A propagation delay in seconds.
+            jitter (float): A maximum random delay in seconds added to the latency.
+            loss (float): A probability a datagram is lost.
+            duplication (float): A probability a datagram is delivered twice.
+            reordering (float): A probability a datagram is held back by up to twice the latency,
+                so datagrams sent after it may overtake it.
+            bandwidth (float): A link capacity in bytes per second. Datagrams are serialized on the link,
+                so bursts are queued. May be None for unlimited capacity.
+        """
+        for probability in (loss, duplication, reordering):
+            if not 0.0 <= probability <= 1.0:
+                raise ValueError("Probability shall be in range 0-1")
+        if latency < 0 or jitter < 0:
+            raise ValueError("Delays shall not be negative")
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError("Bandwidth shall be positive")
+
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplication = duplication
+        self.reordering = reordering
+        self.bandwidth = bandwidth
+
+
+class VirtualNetwork(object):
+    """A simulated switch connecting VirtualTransport objects, running on a virtual clock.
+
+    Datagrams are delivered by run, which advances the clock and calls due functions in order of their
+    virtual time, so simulated seconds take as long as the processing does. Protocol instances created with
+    the same clock (Coap(transport, clock=network.clock)) have their retransmissions and timeouts run in
+    virtual time as well. Random decisions of the network (loss, duplication, delays) and of the protocol
+    instances (message IDs, ACK timeouts, leisure) come from generators seeded at creation, so a simulation
+    driven only by the clock is reproducible.
+    """
+
+    def __init__(self, seed=None, profile=None, clock=None):
+        """Initialize.
+
+        Args:
+            seed (int): A seed of the random number generator. May be None for a random seed.
+            profile (transport.virtual.LinkProfile): A profile of links without a profile of their own.
+                May be None for default link properties.
+            clock (piccata.clock.VirtualClock): A clock datagrams are delivered by. May be None for a new one,
+                with the generator of protocol timing seeded from the seed.
+        """
+        self.profile = profile if profile is not None else LinkProfile()
+        self.random = random.Random(seed)
+        self.clock = clock if clock is not None else VirtualClock(seed=self.random.getrandbits(64))
+
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.undeliverable = 0
+
+        self._lock = threading.RLock()
+        self._transports = {}  # open transports (identified by endpoint)
+        self._groups = collections.defaultdict(set)  # endpoints of group members (identified by group address)
+        self._links = {}  # link profiles (identified by source and destination address)
+        self._busy_until = {}  # times links finish transmitting queued datagrams (identified by source and destination address)
+        self._next_port = {}  # next ephemeral port (identified by address)
+
+    def __len__(self):
+        return len(self.clock)
+
+    @property
+    def now(self):
+        """Current virtual time in seconds."""
+        return self.clock.now()
+
+    def set_link(self, source, destination, profile):
+        """Set properties of a link in one direction.
+
+        Args:
+            source (str or ipaddress.IPv4Address or ipaddress.IPv6Address): A source address.
+            destination (str or ipaddress.IPv4Address or ipaddress.IPv6Address): A destination address.
+            profile (transport.virtual.LinkProfile): Link properties. May be None to use the default profile.
+        """
+        key = (endpoint(source, 0).addr, endpoint(destination, 0).addr)
+        with self._lock:
+            if profile is None:
+                self._links.pop(key, None)
+            else:
+                self._links[key] = profile
+
+    def run(self, duration=None, max_events=None):
+        """Advance the clock, delivering datagrams and calling other scheduled functions (e.g. protocol timers).
+
+        Args:
+            duration (float): A virtual time in seconds to run for. May be None to run until nothing is scheduled.
+            max_events (int): A maximum number of functions called. May be None for no limit.
+
+        Returns:
+            int: A number of functions called.
+        """
+        return self.clock.run(duration, max_events)
+
+    def stats(self):
+        """Get network statistics.
+
+        Returns:
+            dict: Numbers of datagrams sent, delivered, lost, duplicated and sent to no transport.
+        """
+        return {'sent': self.sent, 'delivered': self.delivered, 'lost': self.lost,
+                'duplicated': self.duplicated, 'undeliverable': self.undeliverable}
+
+    def attach(self, transport, address, port):
+        """Connect a transport to the network. Called by VirtualTransport.open.
+
+        Returns:
+            piccata.types.Endpoint: The endpoint of the transport.
+        """
+        address = endpoint(address, 0).addr
+        with self._lock:
+            if port == 0:
+                port = self._next_port.get(address, EPHEMERAL_PORT_START)
+                while endpoint(address, port) in self._transports:
+                    port += 1
+                self._next_port[address] = port + 1
+            local = endpoint(address, port)
+            if local in self._transports:
+                raise ValueError("Address %s:%d already in use" % local)
+            self._transports[local] = transport
+        return local
+
+    def detach(self, local):
+        """Disconnect a transport from the network. Called by VirtualTransport.close."""
+        with self._lock:
+            self._transports.pop(local, None)
+            for members in self._groups.values():
+                members.discard(local)
+
+    def join(self, local, group):
+        """Add an endpoint to a multicast group."""
+        with self._lock:
+            self._groups[endpoint(group, 0).addr].add(local)
+
+    def leave(self, local, group):
+        """Remove an endpoint from a multicast group."""
+        with self._lock:
+            self._groups[endpoint(group, 0).addr].discard(local)
+
+    def transmit(self, data, source, destination):
+        """Send a datagram over the link between two endpoints.
+
+        Args:
+            data (bytes): A datagram.
+            source (piccata.types.Endpoint): A sending endpoint.
+            destination (piccata.types.Endpoint): A destination endpoint, may be a multicast one.
+        """
+        with self._lock:
+            key = (source.addr, destination.addr)
+            profile = self._links.get(key, self.profile)
+            self.sent += 1
+            if profile.loss and self.random.random() < profile.loss:
+                self.lost += 1
+                return
+
+            delay = profile.latency
+            if profile.bandwidth is not None:
+                start = max(self.now, self._busy_until.get(key, 0.0))
+                self._busy_until[key] = start + len(data) / float(profile.bandwidth)
+                delay += self._busy_until[key] - self.now
+
+            copies = 1
+            if profile.duplication and self.random.random() < profile.duplication:
+                copies = 2
+                self.duplicated += 1
+
+            for _ in range(copies):
+                copy_delay = delay
+                if profile.jitter:
+                    copy_delay += self.random.uniform(0, profile.jitter)
+                if profile.reordering and self.random.random() < profile.reordering:
+                    copy_delay += self.random.uniform(0, 2 * profile.latency)
+                self.clock.call_later(copy_delay, self._deliver, data, source, destination)
+
+    def _deliver(self, data, source, destination):
+        with self._lock:
+            if destination.addr.is_multicast:
+                receivers = [self._transports[member] for member in self._groups.get(destination.addr, ())
+                             if member.port == destination.port and member != source]
+            else:
+                receiver = self._transports.get(destination)
+                receivers = [receiver] if receiver is not None else []
+            if not receivers:
+                self.undeliverable += 1
+            self.delivered += len(receivers)
+
+        for receiver in receivers:
+            try:
+                receiver._receive(data, source, destination)
+            except Exception:
+                logging.exception("Exception in virtual transport receiver")
+
+
+class VirtualTransport(TransportBase):
+    """A transport sending datagrams over a VirtualNetwork."""
+
+    def __init__(self, network, address, port=0):
+        """Initializes transport.
+
+        Args:
+            network (transport.virtual.VirtualNetwork): A network to connect to.
+            address (str or ipaddress.IPv4Address or ipaddress.IPv6Address): An address of the transport.
+            port (int): A port number that transport shall use. 0 to get an ephemeral port when opened.
+        """
+        TransportBase.__init__(self, port)
+
+        self.network = network
+        self.address = address
+        self.local = None
+        self._groups = set()
+
+    def open(self):
+        self.local = self.network.attach(self, self.address, self._port)
+        for group in self._groups:
+            self.network.join(self.local, group)
+
+    def close(self):
+        if self.local is not None:
+            self.network.detach(self.local)
+            self.local = None
+
+    def join(self, group):
+        """Join a multicast group.
+
+        Args:
+            group (str or ipaddress.IPv4Address or ipaddress.IPv6Address): A multicast address.
+        """
+        self._groups.add(group)
+        if self.local is not None:
+            self.network.join(self.local, group)
+
+    def leave(self, group):
+        """Leave a multicast group.
+
+        Args:
+            group (str or ipaddress.IPv4Address or ipaddress.IPv6Address): A multicast address joined before.
+        """
+        self._groups.discard(group)
+        if self.local is not None:
+            self.network.leave(self.local, group)
+
+    def send(self, data, dest):
+        """Sends data to the specified destination.
+
+        Args:
+            data (bytes): A data to send.
+            dest (piccata.types.Endpoint): A tuple of destination IP address an UDP port.
+        """
+        if self.local is None:
+            raise ValueError("Transport is not open")
+        self.network.transmit(data, self.local, endpoint(dest[0], dest[1]))